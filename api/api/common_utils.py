@@ -1,17 +1,22 @@
-import calendar
+import hashlib
+import json
 import logging
+import mimetypes
 import os
+import subprocess
 import sys
+import tempfile
 import time
+from multiprocessing.pool import ThreadPool
 
 import keystoneclient.v2_0.client as keystone_client
-import redis
 from django.conf import settings
 from django.core.management.color import color_style
-from django.http import HttpResponse
+from django.http import HttpResponse, FileResponse
 from rest_framework.renderers import JSONRenderer
 
 from api.exceptions import FileSynchronizationException
+from api.instrumentation import InstrumentedRedis, timed
 from pyactive.controller import init_host, start_controller
 
 host = None
@@ -20,6 +25,9 @@ host = None
 logger = logging.getLogger(__name__)
 
 NODE_STATUS_THRESHOLD = 15  # seconds
+NODE_HEARTBEAT_KEY = 'nodes:heartbeat'  # Sorted set of node names scored by their last_ping
+NODE_HEARTBEAT_REFRESH_KEY = 'nodes:heartbeat:refreshed'
+NODE_HEARTBEAT_REFRESH_INTERVAL = 5  # seconds between refreshes of the heartbeat index from the node:<name> hashes
 
 class LoggingColors(logging.Formatter):
     def __init__(self, *args, **kwargs):
@@ -55,8 +63,39 @@ class JSONResponse(HttpResponse):
         super(JSONResponse, self).__init__(content, **kwargs)
 
 
+def file_response(request, path, etag=None):
+    """
+    Returns a response that sends a file, as an attachment.
+
+    If the md5 of the file is given it is sent as ETag, and requests whose If-None-Match matches it get a
+    304 Not Modified response with no body. Depending on settings.FILE_DOWNLOAD_MODE the file is sent by the
+    fronting web server ('x-sendfile' for Apache/lighttpd, 'x-accel-redirect' for nginx) or by Django through
+    FileResponse, which uses the wsgi.file_wrapper (sendfile) of the WSGI server when it provides one.
+    """
+    quoted_etag = '"' + etag + '"' if etag else None
+    if quoted_etag and quoted_etag in [tag.strip() for tag in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+        response = HttpResponse(status=304)
+        response['ETag'] = quoted_etag
+        return response
+
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    if settings.FILE_DOWNLOAD_MODE == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = path
+    elif settings.FILE_DOWNLOAD_MODE == 'x-accel-redirect':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = settings.X_ACCEL_REDIRECT_PREFIX + path
+    else:
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+    response['Content-Length'] = os.stat(path).st_size
+    response['Content-Disposition'] = "attachment; filename=%s" % os.path.basename(path)
+    if quoted_etag:
+        response['ETag'] = quoted_etag
+    return response
+
+
 def get_redis_connection():
-    return redis.Redis(connection_pool=settings.REDIS_CON_POOL)
+    return InstrumentedRedis(connection_pool=settings.REDIS_CON_POOL)
 
 
 def get_token_connection(request):
@@ -71,10 +110,11 @@ def get_keystone_admin_auth():
 
     keystone = None
     try:
-        keystone = keystone_client.Client(auth_url=keystone_url,
-                                          username=admin_user,
-                                          password=admin_passwd,
-                                          tenant_name=admin_project)
+        with timed('keystone'):
+            keystone = keystone_client.Client(auth_url=keystone_url,
+                                              username=admin_user,
+                                              password=admin_passwd,
+                                              tenant_name=admin_project)
     except Exception as exc:
         print(exc)
 
@@ -118,7 +158,8 @@ def get_keystone_admin_auth():
 
 def get_project_list():
     keystone = get_keystone_admin_auth()
-    tenants = keystone.tenants.list()
+    with timed('keystone'):
+        tenants = keystone.tenants.list()
 
     project_list = {}
     for tenant in tenants:
@@ -127,24 +168,245 @@ def get_project_list():
     return project_list
 
 
-def rsync_dir_with_nodes(directory):
-    # retrieve nodes
-    nodes = get_all_registered_nodes()
-    for node in nodes:
+def md5(fname):
+    hash_md5 = hashlib.md5()
+    with open(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(4096), b""):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
+
+def update_manifest(r, directory):
+    """
+    Updates the manifest of a directory: the md5 of each of its files, plus a version that is increased
+    every time a file is added, changed or removed. Files whose size and mtime did not change are not hashed again.
+
+    :param r: Redis connection
+    :param directory: The directory (e.g. settings.NATIVE_FILTERS_DIR)
+    :return: (dict of file name -> md5, version)
+    """
+    manifest_key = 'manifest:' + directory
+    entries = dict((name, json.loads(entry)) for name, entry in r.hgetall(manifest_key).items())
+
+    new_entries = dict()
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if not os.path.isfile(path):
+                continue
+            st = os.stat(path)
+            entry = entries.get(name)
+            if not entry or entry['size'] != st.st_size or entry['mtime'] != st.st_mtime:
+                entry = {'md5': md5(path), 'size': st.st_size, 'mtime': st.st_mtime}
+            new_entries[name] = entry
+
+    if new_entries != entries:
+        pipe = r.pipeline()
+        pipe.delete(manifest_key)
+        if new_entries:
+            pipe.hmset(manifest_key, dict((name, json.dumps(entry)) for name, entry in new_entries.items()))
+        if dict((name, e['md5']) for name, e in new_entries.items()) != dict((name, e['md5']) for name, e in entries.items()):
+            pipe.incr(manifest_key + ':version')
+        pipe.execute()
+
+    return dict((name, entry['md5']) for name, entry in new_entries.items()), int(r.get(manifest_key + ':version') or 0)
+
+
+def _rsync_dir_with_node(directory, node, files=None):
+    """
+    Synchronizes a directory with one node, killing rsync if it takes longer than RSYNC_NODE_TIMEOUT.
+    If a list of file names is given only these files are pushed, otherwise the whole directory is mirrored.
+    Returns the result of the node: {'ip', 'status' ('ok', 'failed' or 'timeout'), 'time', 'error', 'files'}.
+    """
+    ssh_login = node['ssh_username'] + '@' + node['ip']
+    if files is None:
+        # The basename of the path is not needed because it will be the same as source dir
+        rsync_command = ['sshpass', '-p', node['ssh_password'], 'rsync', '--delete', '-avrz', '-e', 'ssh', directory,
+                         ssh_login + ':' + os.path.dirname(directory)]
+    else:
+        rsync_command = ['sshpass', '-p', node['ssh_password'], 'rsync', '-avz', '-e', 'ssh'] + \
+                        [os.path.join(directory, name) for name in sorted(files)] + [ssh_login + ':' + directory + '/']
+    result = {'ip': node['ip'], 'status': 'ok', 'error': None, 'files': 'all' if files is None else len(files)}
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        stderr = tempfile.TemporaryFile()
+        try:
+            process = subprocess.Popen(rsync_command, stdout=devnull, stderr=stderr)
+            deadline = start + settings.RSYNC_NODE_TIMEOUT
+            while process.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+                result['status'] = 'timeout'
+                result['error'] = 'rsync killed after %d seconds' % settings.RSYNC_NODE_TIMEOUT
+            elif process.returncode != 0:
+                stderr.seek(0)
+                result['status'] = 'failed'
+                result['error'] = stderr.read()[-1024:].strip() or 'rsync exited with code %d' % process.returncode
+        except OSError as e:
+            result['status'] = 'failed'
+            result['error'] = str(e)
+        finally:
+            stderr.close()
+    result['time'] = round(time.time() - start, 3)
+
+    if result['status'] != 'ok':
+        logger.error('Error synchronizing %s with node %s: %s', directory, node['name'], result['error'])
+    return result
+
+
+def rsync_dir_with_nodes(directory, full_sync=False):
+    """
+    Synchronizes a directory with all the UP nodes. Up to RSYNC_MAX_WORKERS nodes are synchronized concurrently.
+
+    The manifest of the directory (see update_manifest) is compared with the manifest last synchronized
+    to each node, and only new or changed files are pushed. Nodes that are already current are skipped.
+    Nodes with files that no longer exist, or all the nodes if full_sync is set, get the whole directory
+    mirrored with rsync --delete. The manifests of a node are forgotten when it comes back after being
+    DOWN (see reset_node_manifests), so all the files are pushed to it again.
+
+    :return: Dict of node name -> result of the node (see _rsync_dir_with_node). Skipped nodes have status 'current'.
+    :raises FileSynchronizationException: if some node is missing its SSH credentials (nothing is synchronized)
+        or the synchronization failed in some node. The results of all the nodes are in its 'results' attribute.
+    """
+    r = get_redis_connection()
+
+    # Directory is only synchronized if node status is UP
+    up_nodes = get_up_nodes(r)
+    for node in up_nodes:
         if not node.viewkeys() & {'ssh_username', 'ssh_password'}:
             raise FileSynchronizationException("SSH credentials missing for some Swift node. Please, set the credentials for all nodes.")
+    if not up_nodes:
+        return {}
+
+    manifest, version = update_manifest(r, directory)
+    node_manifest_key = 'manifest:' + directory + ':node:'
+    pipe = r.pipeline()
+    for node in up_nodes:
+        pipe.hgetall(node_manifest_key + node['name'])
+    node_manifests = pipe.execute()
+
+    results = dict()
+    to_sync = []
+    for node, node_manifest in zip(up_nodes, node_manifests):
+        changed = [name for name, file_md5 in manifest.items() if node_manifest.get(name) != file_md5]
+        removed = [name for name in node_manifest if name not in manifest]
+        if full_sync or removed:
+            to_sync.append((node, None))
+        elif changed:
+            to_sync.append((node, changed))
+        else:
+            results[node['name']] = {'ip': node['ip'], 'status': 'current', 'error': None, 'files': 0, 'time': 0}
+
+    def sync_node(node_files):
+        node, files = node_files
+        result = _rsync_dir_with_node(directory, node, files)
+        if result['status'] == 'ok':
+            # Remember what the node has, so the next synchronization only pushes the differences
+            node_pipe = r.pipeline()
+            node_pipe.delete(node_manifest_key + node['name'])
+            if manifest:
+                node_pipe.hmset(node_manifest_key + node['name'], manifest)
+            node_pipe.execute()
+        return result
+
+    if to_sync:
+        pool = ThreadPool(min(settings.RSYNC_MAX_WORKERS, len(to_sync)))
+        try:
+            node_results = pool.map(sync_node, to_sync)
+        finally:
+            pool.close()
+            pool.join()
+        for (node, _), result in zip(to_sync, node_results):
+            result['version'] = version
+            results[node['name']] = result
+
+    failed = sorted(name for name, result in results.items() if result['status'] not in ('ok', 'current'))
+    if failed:
+        raise FileSynchronizationException("An error occurred copying files to Swift nodes: " + ', '.join(failed), results)
+    return results
+
+
+def reset_node_manifests(r, node_name):
+    """
+    Forgets what was synchronized to a node, so the next rsync_dir_with_nodes() mirrors
+    the whole directories to it. Used when a node comes back after being DOWN, since
+    it may have been re-imaged meanwhile.
+    """
+    manifest_keys = r.keys('manifest:*:node:' + node_name)
+    if manifest_keys:
+        logger.info('Node %s is UP again, its directories will be fully synchronized', node_name)
+        r.delete(*manifest_keys)
+
+
+def _was_down(indexed, last_ping):
+    return indexed is not None and float(last_ping) - indexed > NODE_STATUS_THRESHOLD
+
+
+def record_node_heartbeat(r, node_name, node_data):
+    """
+    Stores the data of a node and indexes its last_ping in the heartbeat sorted set.
+    This is how heartbeats are expected to be written (PUT /swift/nodes/<name>, see
+    doc/api_specification_swift.md); heartbeats written to the node:<name> hash only are
+    indexed by refresh_node_heartbeats().
+    """
+    if _was_down(r.zscore(NODE_HEARTBEAT_KEY, node_name), node_data['last_ping']):
+        reset_node_manifests(r, node_name)
+    pipe = r.pipeline()
+    pipe.hmset('node:' + node_name, node_data)
+    pipe.zadd(NODE_HEARTBEAT_KEY, node_name, float(node_data['last_ping']))
+    pipe.execute()
+
+
+def refresh_node_heartbeats(r):
+    """
+    Copies to the heartbeat sorted set the last_ping of the node:<name> hashes
+    that are newer than the indexed one, at most once every
+    NODE_HEARTBEAT_REFRESH_INTERVAL seconds (among all the processes).
+
+    For the nodes that only update their hash, the index is a cache of this
+    KEYS node:* scan: it costs a scan plus two reads per node every
+    NODE_HEARTBEAT_REFRESH_INTERVAL seconds, and their heartbeats are seen up
+    to NODE_HEARTBEAT_REFRESH_INTERVAL seconds late.
+    """
+    if not r.set(NODE_HEARTBEAT_REFRESH_KEY, time.time(), ex=NODE_HEARTBEAT_REFRESH_INTERVAL, nx=True):
+        return
+    node_names = [key.split(':', 1)[1] for key in r.keys('node:*')]
+    pipe = r.pipeline(transaction=False)
+    for node_name in node_names:
+        pipe.hget('node:' + node_name, 'last_ping')
+        pipe.zscore(NODE_HEARTBEAT_KEY, node_name)
+    values = pipe.execute()
+    pipe = r.pipeline(transaction=False)
+    for node_name, last_ping, indexed in zip(node_names, values[::2], values[1::2]):
+        if last_ping and (indexed is None or float(last_ping) > indexed):
+            if _was_down(indexed, last_ping):
+                reset_node_manifests(r, node_name)
+            pipe.zadd(NODE_HEARTBEAT_KEY, node_name, float(last_ping))
+    pipe.execute()
+
+
+def get_up_node_names(r):
+    """
+    Names of the nodes whose last heartbeat is at most NODE_STATUS_THRESHOLD seconds old.
+    """
+    refresh_node_heartbeats(r)
+    return r.zrangebyscore(NODE_HEARTBEAT_KEY, time.time() - NODE_STATUS_THRESHOLD, '+inf')
+
+
+def get_nodes(r, node_names):
+    """
+    Data of the given nodes, fetched in a single round trip. Nodes that no longer exist are skipped.
+    """
+    pipe = r.pipeline()
+    for node_name in node_names:
+        pipe.hgetall('node:' + node_name)
+    return [node for node in pipe.execute() if node]
+
 
-        # Directory is only synchronized if node status is UP
-        if calendar.timegm(time.gmtime()) - int(float(node['last_ping'])) <= NODE_STATUS_THRESHOLD:
-            # The basename of the path is not needed because it will be the same as source dir
-            dest_directory = os.path.dirname(directory)
-            data = {'directory': directory, 'dest_directory': dest_directory, 'node_ip': node['ip'],
-                    'ssh_username': node['ssh_username'], 'ssh_password': node['ssh_password']}
-            rsync_command = 'sshpass -p {ssh_password} rsync --progress --delete -avrz -e ssh {directory} {ssh_username}@{node_ip}:{dest_directory}'.format(**data)
-            # print "System: %s" % rsync_command
-            ret = os.system(rsync_command)
-            if ret != 0:
-                raise FileSynchronizationException("An error occurred copying files to Swift nodes")
+def get_up_nodes(r):
+    return get_nodes(r, get_up_node_names(r))
 
 
 def get_all_registered_nodes():
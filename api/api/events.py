@@ -0,0 +1,165 @@
+"""
+Change events of the Crystal Controller.
+
+Every write to a static policy, filter, SLO, global filter or any other
+entity managed by the API publishes a compact event::
+
+    {"seq": 42, "type": "static_policy", "id": "3", "target": "0123456789abcdef", "version": 7}
+
+Events are numbered by the ``events:seq`` counter, kept in the ``events:log``
+sorted set (scored by sequence number and capped to ``EVENTS_LOG_SIZE``
+entries) and published on the ``EVENTS_CHANNEL`` pub/sub channel. Readers use
+:class:`EventCache` to keep a local cache that is invalidated by the events,
+catching up from the log after a restart, a lost message or a lost subscription.
+"""
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+EVENTS_SEQ_KEY = 'events:seq'
+EVENTS_LOG_KEY = 'events:log'
+
+
+# Numbers, logs and publishes an event in one step, so that concurrent writers
+# cannot log or publish their events out of sequence order
+PUBLISH_EVENT_SCRIPT = """
+local seq = redis.call('INCR', KEYS[1])
+local event = '{"seq": ' .. seq .. ', ' .. string.sub(ARGV[1], 2)
+redis.call('ZADD', KEYS[2], seq, event)
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -tonumber(ARGV[2]) - 1)
+redis.call('PUBLISH', ARGV[3], event)
+return seq
+"""
+
+
+def publish_event(r, entity_type, entity_id, target=None, version=None):
+    """
+    Publish a change event.
+
+    :param r: Redis connection
+    :param entity_type: Type of the changed entity (e.g. 'filter', 'static_policy', 'slo')
+    :param entity_id: Identifier of the entity within its type
+    :param target: Target (tenant[:container[:object]]) the entity applies to, if any
+    :param version: Version of the entity after the change, if it is versioned
+    :return: The published event
+    """
+    event = {'type': entity_type,
+             'id': str(entity_id),
+             'target': target,
+             'version': version,
+             'time': time.time()}
+    publish = r.register_script(PUBLISH_EVENT_SCRIPT)
+    event['seq'] = publish(keys=[EVENTS_SEQ_KEY, EVENTS_LOG_KEY],
+                           args=[json.dumps(event), settings.EVENTS_LOG_SIZE, settings.EVENTS_CHANNEL])
+    return event
+
+
+def get_events(r, since=0):
+    """
+    Returns the logged events with a sequence number greater than `since`, oldest first.
+    """
+    return [json.loads(event) for event in r.zrangebyscore(EVENTS_LOG_KEY, '(' + str(since), '+inf')]
+
+
+class EventCache(object):
+    """
+    Local cache of Redis entities kept up to date by the change events.
+
+    Entries are loaded on demand with the loader function registered for their
+    type, ``loader(r, entity_id)``, and dropped when an event for them arrives.
+    A sequence number gap (a lost message or events older than the log) clears
+    the whole cache. It can be used from several threads.
+    """
+
+    def __init__(self, r, loaders, since=None):
+        """
+        :param r: Redis connection
+        :param loaders: Dict of entity type -> loader function
+        :param since: Sequence number the cache is up to date with. By default, the current one.
+        """
+        self.r = r
+        self.loaders = loaders
+        self.data = dict()
+        self.last_seq = int(r.get(EVENTS_SEQ_KEY) or 0) if since is None else since
+        self.lock = threading.Lock()
+
+    def get(self, entity_type, entity_id):
+        key = (entity_type, str(entity_id))
+        with self.lock:
+            if key in self.data:
+                return self.data[key]
+            last_seq = self.last_seq
+        value = self.loaders[entity_type](self.r, entity_id)
+        with self.lock:
+            # Not cached if an event was applied while loading it: it may be stale
+            if self.last_seq == last_seq:
+                self.data[key] = value
+        return value
+
+    def apply(self, event):
+        """
+        Apply one event. Already applied events are ignored.
+        """
+        if event['seq'] <= self.last_seq:
+            return
+        if event['seq'] > self.last_seq + 1:
+            # Some events are missing: read them from the log
+            self.catch_up()
+        with self.lock:
+            if event['seq'] <= self.last_seq:
+                return
+            self.data.pop((event['type'], event['id']), None)
+            self.last_seq = event['seq']
+
+    def catch_up(self):
+        """
+        Apply all the logged events after the last applied one.
+        """
+        events = get_events(self.r, self.last_seq)
+        with self.lock:
+            events = [event for event in events if event['seq'] > self.last_seq]
+            if not events:
+                return
+            if events[0]['seq'] > self.last_seq + 1:
+                logger.warning('Event cache: events %d to %d are no longer logged, clearing the cache',
+                               self.last_seq + 1, events[0]['seq'] - 1)
+                self.data.clear()
+            for event in events:
+                self.data.pop((event['type'], event['id']), None)
+                self.last_seq = event['seq']
+
+    def listen(self, stop=None):
+        """
+        Apply the published events until `stop` (a threading Event) is set. Meant to be run in its own thread.
+
+        When the connection is lost, the cache is cleared, since it would miss
+        the changes until it subscribes again, and it subscribes again every
+        EVENTS_RECONNECT_DELAY seconds.
+        """
+        while not (stop and stop.is_set()):
+            try:
+                self._listen(stop)
+            except Exception as e:
+                logger.warning('Event cache: subscription lost (%s), subscribing again in %s seconds', e, settings.EVENTS_RECONNECT_DELAY)
+                with self.lock:
+                    self.data.clear()
+                time.sleep(settings.EVENTS_RECONNECT_DELAY)
+
+    def _listen(self, stop):
+        pubsub = self.r.pubsub()
+        try:
+            pubsub.subscribe(settings.EVENTS_CHANNEL)
+            # Events published before the subscription are read from the log
+            self.catch_up()
+            for message in pubsub.listen():
+                if message['type'] == 'message':
+                    self.apply(json.loads(message['data']))
+                if stop and stop.is_set():
+                    return
+        finally:
+            pubsub.close()
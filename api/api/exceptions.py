@@ -18,7 +18,52 @@ class StorletNotFoundException(CrystalControllerException):
     pass
 
 
+class FilterNotFoundException(CrystalControllerException):
+    """Exception to be raised when a filter to deploy or undeploy does not exist, or is not deployed to the target."""
+    pass
+
+
 class FileSynchronizationException(CrystalControllerException):
     """Exception to be raised when a file synchronization between controller and Swift nodes fails."""
+
+    def __init__(self, message, results=None):
+        super(FileSynchronizationException, self).__init__(message)
+        # Per-node results of the synchronization (node name -> result dict), if it was attempted
+        self.results = results or {}
+
+
+class FileTooLargeException(CrystalControllerException):
+    """Exception to be raised when an uploaded file is bigger than settings.MAX_UPLOAD_SIZE."""
     pass
 
+
+class JobLockedException(CrystalControllerException):
+    """Exception to be raised when a job is submitted for a resource locked by another job."""
+
+    def __init__(self, resource, job_id):
+        super(JobLockedException, self).__init__('Resource ' + str(resource) + ' is locked by job ' + str(job_id))
+        self.resource = resource
+        self.job_id = job_id
+
+
+class JobFailedException(CrystalControllerException):
+    """Exception to be raised by a job handler that failed but has a (partial) result to report."""
+
+    def __init__(self, message, result=None):
+        super(JobFailedException, self).__init__(message)
+        self.result = result
+
+
+class JobCancelledException(CrystalControllerException):
+    """Exception raised inside a running job when its cancellation has been requested."""
+    pass
+
+
+class ProcessFailedException(CrystalControllerException):
+    """Exception to be raised when an external process fails, times out or reports a fatal error."""
+
+    def __init__(self, message, returncode=None, output=None):
+        super(ProcessFailedException, self).__init__(message)
+        self.returncode = returncode
+        # Last output lines of the process
+        self.output = output or []
@@ -0,0 +1,228 @@
+"""
+Per-request instrumentation of the Crystal Controller.
+
+Counts the Redis commands and round trips issued while serving an HTTP request
+and measures the time spent in Redis, Keystone and Swift. The numbers are
+collected in a thread-local :class:`RequestStats` object that is started and
+finished by :class:`api.middleware.InstrumentationMiddleware`.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import redis
+from redis.client import Pipeline
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class RequestStats(object):
+    """
+    Counters of a single HTTP request.
+    """
+
+    def __init__(self, max_sampled_commands=0):
+        self.start = time.time()
+        self.redis_commands = 0
+        self.redis_round_trips = 0
+        self.redis_time = 0.0
+        self.calls = {'keystone': 0, 'swift': 0}
+        self.times = {'keystone': 0.0, 'swift': 0.0}
+        self.max_sampled_commands = max_sampled_commands
+        self.sampled_commands = []
+
+    def add_redis(self, commands, elapsed):
+        """
+        Record one round trip to Redis.
+
+        :param commands: The list of commands (argument tuples) sent in this round trip.
+        :param elapsed: Seconds spent waiting for Redis.
+        """
+        self.redis_commands += len(commands)
+        self.redis_round_trips += 1
+        self.redis_time += elapsed
+        for args in commands:
+            if len(self.sampled_commands) >= self.max_sampled_commands:
+                break
+            self.sampled_commands.append(' '.join(str(arg) for arg in args[:2]))
+
+    def add_call(self, service, elapsed):
+        self.calls[service] = self.calls.get(service, 0) + 1
+        self.times[service] = self.times.get(service, 0.0) + elapsed
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def server_timing(self):
+        """
+        Value of the ``Server-Timing`` response header. Durations are in milliseconds.
+        """
+        metrics = ['redis;dur=%.2f;desc="%d cmds, %d round trips"' % (self.redis_time * 1000, self.redis_commands, self.redis_round_trips)]
+        for service in sorted(self.times):
+            metrics.append('%s;dur=%.2f;desc="%d calls"' % (service, self.times[service] * 1000, self.calls[service]))
+        metrics.append('total;dur=%.2f' % (self.elapsed() * 1000))
+        return ', '.join(metrics)
+
+    def to_dict(self):
+        data = {'redis_commands': self.redis_commands,
+                'redis_round_trips': self.redis_round_trips,
+                'redis_ms': round(self.redis_time * 1000, 2),
+                'total_ms': round(self.elapsed() * 1000, 2)}
+        for service in self.times:
+            data[service + '_calls'] = self.calls[service]
+            data[service + '_ms'] = round(self.times[service] * 1000, 2)
+        return data
+
+
+def start_request(max_sampled_commands=0):
+    """
+    Start collecting stats for the request served by the current thread.
+    """
+    _local.stats = RequestStats(max_sampled_commands)
+    return _local.stats
+
+
+def end_request():
+    """
+    Stop collecting stats for the current thread and return them (None if no request was started).
+    """
+    stats = getattr(_local, 'stats', None)
+    _local.stats = None
+    return stats
+
+
+def get_current_stats():
+    return getattr(_local, 'stats', None)
+
+
+@contextmanager
+def timed(service):
+    """
+    Context manager that adds the time spent in the block to the given
+    external service ('keystone' or 'swift') of the current request.
+    """
+    stats = get_current_stats()
+    start = time.time()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stats.add_call(service, time.time() - start)
+
+
+class InstrumentedPipeline(Pipeline):
+    """
+    Pipeline that records all its buffered commands as a single round trip.
+    """
+
+    def execute(self, raise_on_error=True):
+        stats = get_current_stats()
+        if stats is None:
+            return super(InstrumentedPipeline, self).execute(raise_on_error)
+        commands = [args for args, _ in self.command_stack]
+        start = time.time()
+        try:
+            return super(InstrumentedPipeline, self).execute(raise_on_error)
+        finally:
+            stats.add_redis(commands, time.time() - start)
+
+
+class InstrumentedRedis(redis.Redis):
+    """
+    Redis client that reports every command to the stats of the current request.
+    When no request is being instrumented it behaves as a plain redis.Redis client.
+    """
+
+    def execute_command(self, *args, **options):
+        stats = get_current_stats()
+        if stats is None:
+            return super(InstrumentedRedis, self).execute_command(*args, **options)
+        start = time.time()
+        try:
+            return super(InstrumentedRedis, self).execute_command(*args, **options)
+        finally:
+            stats.add_redis([args], time.time() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class MonitoredConnectionPool(redis.BlockingConnectionPool):
+    """
+    Bounded Redis connection pool shared by the views and the actors of a process.
+
+    When the ``max_connections`` connections are in use, clients wait up to
+    ``timeout`` seconds for a free one. Connections that were idle for more than
+    ``health_check_interval`` seconds are checked with a PING before they are
+    handed out, and dropped (reconnected on their next command) if it fails.
+    The usage of the pool is returned by :meth:`stats`.
+    """
+
+    def __init__(self, max_connections=50, timeout=20, health_check_interval=30, **kwargs):
+        self.health_check_interval = health_check_interval
+        self._stats_lock = threading.Lock()
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.health_check_failures = 0
+        super(MonitoredConnectionPool, self).__init__(max_connections=max_connections, timeout=timeout, **kwargs)
+
+    def get_connection(self, command_name, *keys, **options):
+        start = time.time()
+        try:
+            connection = super(MonitoredConnectionPool, self).get_connection(command_name, *keys, **options)
+        except redis.ConnectionError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        waited = time.time() - start
+        with self._stats_lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+        self._check_health(connection)
+        return connection
+
+    def release(self, connection):
+        connection.last_used = time.time()
+        with self._stats_lock:
+            self.in_use -= 1
+        super(MonitoredConnectionPool, self).release(connection)
+
+    def _check_health(self, connection):
+        last_used = getattr(connection, 'last_used', None)
+        if last_used is None or time.time() - last_used < self.health_check_interval:
+            return
+        try:
+            connection.send_command('PING')
+            connection.read_response()
+        except redis.RedisError:
+            logger.warning('Redis connection pool: a connection idle for %.0f seconds failed its health check', time.time() - last_used)
+            with self._stats_lock:
+                self.health_check_failures += 1
+            connection.disconnect()
+
+    def reinstantiate(self):
+        self.__init__(max_connections=self.max_connections, timeout=self.timeout,
+                      health_check_interval=self.health_check_interval, connection_class=self.connection_class,
+                      queue_class=self.queue_class, **self.connection_kwargs)
+
+    def stats(self):
+        with self._stats_lock:
+            return {'max_connections': self.max_connections,
+                    'connections': len(self._connections),
+                    'in_use': self.in_use,
+                    'peak_in_use': self.peak_in_use,
+                    'checkouts': self.checkouts,
+                    'timeouts': self.timeouts,
+                    'wait_ms': round(self.wait_time * 1000, 2),
+                    'max_wait_ms': round(self.max_wait_time * 1000, 2),
+                    'health_check_failures': self.health_check_failures}
@@ -0,0 +1,309 @@
+"""
+Background jobs of the Crystal Controller.
+
+Long-running operations (ansible playbooks, project creation, node restarts)
+are not executed inside the HTTP request. The view submits a job and returns
+``202 Accepted`` with its id; a worker process (``manage.py run_job_worker``)
+executes it and the client follows it through the ``/controller/jobs`` API.
+
+Redis keys:
+
+* ``jobs:id``: job id counter
+* ``jobs``: sorted set of job ids, scored by submission time
+* ``jobs:queue``: list of pending job ids (LPUSH / BRPOP)
+* ``job:<id>``: job hash (type, status, progress, data, resource, timings, result/error)
+* ``job:<id>:log``: output lines of the job, capped to ``JOB_LOG_SIZE``
+* ``job_lock:<resource>``: id of the job that holds the resource
+
+A job that changes a resource (a storage policy ring, a project, a node) reserves
+it when it is submitted, so a second job on the same resource is rejected while
+the first one is pending. The worker takes the lock again when the job starts
+and extends its TTL (``JOB_LOCK_TIMEOUT``) while the job runs, so two jobs on the
+same resource never run concurrently, while jobs on different resources run in
+parallel. A job whose resource is held by another one when it starts goes back
+to the queue. The lock is released when the job finishes; its TTL frees it if
+the worker dies.
+"""
+import importlib
+import json
+import logging
+import threading
+import time
+import traceback
+
+from django.conf import settings
+from redis.exceptions import WatchError
+
+from api.exceptions import JobLockedException, JobCancelledException, JobFailedException
+
+logger = logging.getLogger(__name__)
+
+JOBS_ID_KEY = 'jobs:id'
+JOBS_KEY = 'jobs'
+JOBS_QUEUE_KEY = 'jobs:queue'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED_STATUSES = (SUCCEEDED, FAILED, CANCELLED)
+
+LOCKED_RETRY_DELAY = 1  # seconds before a job whose resource is locked is taken from the queue again
+
+
+def job_key(job_id):
+    return 'job:' + str(job_id)
+
+
+def job_log_key(job_id):
+    return 'job:' + str(job_id) + ':log'
+
+
+def job_lock_key(resource):
+    return 'job_lock:' + str(resource)
+
+
+def submit_job(r, job_type, data, resource=None):
+    """
+    Queue a job.
+
+    :param r: Redis connection
+    :param job_type: One of the types of settings.JOB_HANDLERS
+    :param data: JSON serializable parameters of the job
+    :param resource: Resource locked while the job is pending or running, if any
+    :raises JobLockedException: if another job holds the resource
+    :return: The job id
+    """
+    if job_type not in settings.JOB_HANDLERS:
+        raise ValueError('Unknown job type: ' + str(job_type))
+
+    job_id = r.incr(JOBS_ID_KEY)
+    if resource is not None:
+        if not r.set(job_lock_key(resource), job_id, ex=settings.JOB_LOCK_TIMEOUT, nx=True):
+            raise JobLockedException(resource, r.get(job_lock_key(resource)))
+
+    now = time.time()
+    pipe = r.pipeline()
+    pipe.hmset(job_key(job_id), {'id': job_id, 'type': job_type, 'status': QUEUED, 'data': json.dumps(data),
+                                 'resource': resource or '', 'created_at': now})
+    pipe.zadd(JOBS_KEY, job_id, now)
+    pipe.lpush(JOBS_QUEUE_KEY, job_id)
+    pipe.execute()
+    logger.info('Job %s (%s) queued', job_id, job_type)
+    return job_id
+
+
+def get_job(r, job_id):
+    """
+    Returns the job as a dict, or None if it does not exist.
+    """
+    job = r.hgetall(job_key(job_id))
+    if not job:
+        return None
+    job['data'] = json.loads(job['data'])
+    if 'result' in job:
+        job['result'] = json.loads(job['result'])
+    job['log_length'] = r.llen(job_log_key(job_id))
+    return job
+
+
+def list_jobs(r, count=100):
+    """
+    Returns the last `count` jobs, newest first.
+    """
+    jobs = []
+    for job_id in r.zrevrange(JOBS_KEY, 0, count - 1):
+        job = get_job(r, job_id)
+        if job:
+            jobs.append(job)
+        else:
+            # Expired
+            r.zrem(JOBS_KEY, job_id)
+    return jobs
+
+
+def get_job_log(r, job_id, offset=0):
+    """
+    Returns the log lines of the job from `offset` on, and the offset of the next line,
+    so that a client can tail the log by passing it back.
+    """
+    lines = r.lrange(job_log_key(job_id), offset, -1)
+    return lines, offset + len(lines)
+
+
+def append_job_log(r, job_id, *lines):
+    pipe = r.pipeline()
+    pipe.rpush(job_log_key(job_id), *lines)
+    pipe.ltrim(job_log_key(job_id), -settings.JOB_LOG_SIZE, -1)
+    pipe.execute()
+
+
+def cancel_job(r, job_id):
+    """
+    Cancel a job. A queued job is removed from the queue; a running job is
+    asked to stop, and stops the next time it checks Job.cancelled().
+
+    :return: The job status after the cancellation request
+    """
+    job = r.hgetall(job_key(job_id))
+    if job['status'] == QUEUED and r.lrem(JOBS_QUEUE_KEY, job_id, 0):
+        _finish_job(r, job_id, job, CANCELLED)
+        return CANCELLED
+    if job['status'] == RUNNING:
+        r.hset(job_key(job_id), 'cancel_requested', 'True')
+    return job['status']
+
+
+def _lock_resource(r, job_id, resource, extend=False):
+    """
+    Takes the lock of the resource for the job (or extends it, if the job holds
+    it already) for JOB_LOCK_TIMEOUT seconds.
+
+    :param extend: Only extend the lock, if the job still holds it
+    :return: False if the job does not hold the lock
+    """
+    lock_key = job_lock_key(resource)
+    with r.pipeline() as pipe:
+        try:
+            pipe.watch(lock_key)
+            holder = pipe.get(lock_key)
+            if holder != str(job_id) and (extend or holder is not None):
+                return False
+            pipe.multi()
+            pipe.set(lock_key, job_id, ex=settings.JOB_LOCK_TIMEOUT)
+            pipe.execute()
+            return True
+        except WatchError:
+            return False
+
+
+def _keep_lock(r, job_id, resource, stop):
+    """
+    Extends the lock of the resource until `stop` is set, while the job runs.
+    """
+    while not stop.wait(settings.JOB_LOCK_TIMEOUT / 3.0):
+        try:
+            if not _lock_resource(r, job_id, resource, extend=True) and not stop.is_set():
+                logger.warning('Job %s: the lock of %s was lost', job_id, resource)
+        except Exception as e:
+            logger.warning('Job %s: the lock of %s could not be extended: %s', job_id, resource, e)
+
+
+def _finish_job(r, job_id, job, status, result=None, error=None):
+    fields = {'status': status, 'finished_at': time.time()}
+    if result is not None:
+        fields['result'] = json.dumps(result)
+    if error is not None:
+        fields['error'] = error
+    pipe = r.pipeline()
+    pipe.hmset(job_key(job_id), fields)
+    pipe.expire(job_key(job_id), settings.JOB_TTL)
+    pipe.expire(job_log_key(job_id), settings.JOB_TTL)
+    pipe.execute()
+
+    if job.get('resource'):
+        # Release the lock only if it is still ours
+        lock_key = job_lock_key(job['resource'])
+        with r.pipeline() as pipe:
+            try:
+                pipe.watch(lock_key)
+                if pipe.get(lock_key) == str(job_id):
+                    pipe.multi()
+                    pipe.delete(lock_key)
+                    pipe.execute()
+            except Exception:
+                logger.warning('Job %s: the lock of %s could not be released', job_id, job['resource'])
+
+
+class Job(object):
+    """
+    Running job, as seen by its handler.
+    """
+
+    def __init__(self, r, job_id, job_type, data):
+        self.r = r
+        self.id = job_id
+        self.type = job_type
+        self.data = data
+
+    def log(self, line):
+        append_job_log(self.r, self.id, line.rstrip('\n'))
+
+    def log_lines(self, lines):
+        """
+        Appends several output lines at once. Used as the on_output callback of a ProcessRunner.
+        """
+        if lines:
+            append_job_log(self.r, self.id, *lines)
+
+    def set_progress(self, progress):
+        """
+        Short description of the current step, returned with the job status.
+        """
+        self.r.hset(job_key(self.id), 'progress', progress)
+
+    def cancelled(self):
+        return self.r.hget(job_key(self.id), 'cancel_requested') == 'True'
+
+    def check_cancelled(self):
+        if self.cancelled():
+            raise JobCancelledException('Job ' + str(self.id) + ' was cancelled')
+
+
+def get_job_handler(job_type):
+    module_name, function_name = settings.JOB_HANDLERS[job_type].rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def execute_job(r, job_id):
+    """
+    Run a queued job with its handler, ``handler(job)``. The value returned by
+    the handler is stored as the result of the job.
+    """
+    job = r.hgetall(job_key(job_id))
+    if not job or job['status'] != QUEUED:
+        return
+
+    resource = job.get('resource')
+    if resource and not _lock_resource(r, job_id, resource):
+        logger.info('Job %s: %s is locked by another job, queued again', job_id, resource)
+        r.lpush(JOBS_QUEUE_KEY, job_id)
+        time.sleep(LOCKED_RETRY_DELAY)
+        return
+
+    r.hmset(job_key(job_id), {'status': RUNNING, 'started_at': time.time()})
+    logger.info('Job %s (%s) started', job_id, job['type'])
+    running_job = Job(r, job_id, job['type'], json.loads(job['data']))
+    stop_lock = threading.Event()
+    if resource:
+        lock_thread = threading.Thread(target=_keep_lock, args=(r, job_id, resource, stop_lock), name='job_lock_' + str(job_id))
+        lock_thread.daemon = True
+        lock_thread.start()
+    try:
+        result = get_job_handler(job['type'])(running_job)
+    except JobCancelledException:
+        logger.info('Job %s cancelled', job_id)
+        _finish_job(r, job_id, job, CANCELLED)
+    except JobFailedException as e:
+        logger.error('Job %s failed: %s', job_id, e)
+        _finish_job(r, job_id, job, FAILED, result=e.result, error=str(e))
+    except Exception as e:
+        logger.error('Job %s failed: %s', job_id, e)
+        running_job.log(traceback.format_exc())
+        _finish_job(r, job_id, job, FAILED, error=str(e))
+    else:
+        logger.info('Job %s finished', job_id)
+        _finish_job(r, job_id, job, SUCCEEDED, result=result)
+    finally:
+        stop_lock.set()
+
+
+def run_worker(r, stop=None):
+    """
+    Execute queued jobs until `stop` (a threading/multiprocessing Event) is set.
+    """
+    while not (stop and stop.is_set()):
+        item = r.brpop(JOBS_QUEUE_KEY, timeout=1)
+        if item:
+            execute_job(r, item[1])
@@ -1,9 +1,12 @@
+import json
 import logging
 from datetime import datetime
 
+from django.conf import settings
 from keystoneauth1 import exceptions
 from rest_framework import status
 
+from api import instrumentation
 from api.common_utils import JSONResponse, get_keystone_admin_auth
 
 logger = logging.getLogger(__name__)
@@ -11,6 +14,40 @@ logger = logging.getLogger(__name__)
 valid_tokens = dict()
 
 
+class InstrumentationMiddleware(object):
+    """
+    Measures the Redis, Keystone and Swift usage of each request. The numbers are
+    returned in the Server-Timing header and logged in a structured (JSON) line.
+    Requests slower than SLOW_REQUEST_THRESHOLD also dump their Redis command list.
+    """
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def process_request(request):
+        if settings.REQUEST_INSTRUMENTATION:
+            max_sampled_commands = settings.SLOW_REQUEST_MAX_COMMANDS if settings.SLOW_REQUEST_THRESHOLD is not None else 0
+            instrumentation.start_request(max_sampled_commands)
+        return None
+
+    @staticmethod
+    def process_response(request, response):
+        stats = instrumentation.end_request()
+        if stats is None:
+            return response
+
+        response['Server-Timing'] = stats.server_timing()
+
+        log_data = stats.to_dict()
+        log_data.update({'method': request.method, 'path': request.path, 'status': response.status_code})
+        logger.info('Request stats: ' + json.dumps(log_data, sort_keys=True))
+
+        if settings.SLOW_REQUEST_THRESHOLD is not None and stats.elapsed() >= settings.SLOW_REQUEST_THRESHOLD:
+            logger.warning('Slow request ' + request.method + ' ' + request.path + ' (' + str(stats.redis_commands) +
+                           ' Redis commands): ' + json.dumps(stats.sampled_commands))
+        return response
+
+
 class CrystalMiddleware(object):
     def __init__(self):
         pass
@@ -35,7 +72,8 @@ class CrystalMiddleware(object):
             keystone = get_keystone_admin_auth()
 
             try:
-                token_data = keystone.tokens.validate(token)
+                with instrumentation.timed('keystone'):
+                    token_data = keystone.tokens.validate(token)
             except exceptions.base.ClientException:
                 return JSONResponse('You must be authenticated as admin.', status=status.HTTP_401_UNAUTHORIZED)
 
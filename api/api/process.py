@@ -0,0 +1,136 @@
+"""
+Monitoring of the external processes run by the controller (ansible
+playbooks, ssh commands, project creation scripts).
+"""
+import collections
+import errno
+import fcntl
+import logging
+import os
+import select
+import signal
+import subprocess
+import time
+
+from django.conf import settings
+
+from api.exceptions import JobCancelledException, ProcessFailedException
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 64 * 1024
+CANCEL_CHECK_INTERVAL = 1  # seconds
+
+
+class ProcessRunner(object):
+    """
+    Runs a command and follows its stdout and stderr without blocking on partial lines.
+
+    Output lines are kept in a bounded ring buffer (`tail`) and handed to
+    `on_output(lines)` as they arrive, so they can be persisted incrementally.
+    The process is terminated (and killed if it does not exit within
+    PROCESS_KILL_GRACE seconds) when it times out, when `cancelled()` returns
+    True or when a line contains one of `fail_patterns`.
+    """
+
+    def __init__(self, command, env=None, on_output=None, timeout=None, cancelled=None, fail_patterns=(), buffer_size=None):
+        self.command = command
+        self.env = env
+        self.on_output = on_output
+        self.timeout = timeout
+        self.cancelled = cancelled
+        self.fail_patterns = fail_patterns
+        self.tail = collections.deque(maxlen=buffer_size or settings.PROCESS_OUTPUT_BUFFER_LINES)
+        self.line_count = 0
+        self.returncode = None
+        self.process = None
+
+    def run(self):
+        """
+        Runs the command until it exits.
+
+        :raises ProcessFailedException: if the command exits with a non-zero status, times out or prints a fail pattern
+        :raises JobCancelledException: if it was cancelled
+        :return: The output lines in the ring buffer
+        """
+        start = time.time()
+        self.process = subprocess.Popen(self.command, env=self.env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+        partial = dict()
+        for pipe in (self.process.stdout, self.process.stderr):
+            fcntl.fcntl(pipe, fcntl.F_SETFL, fcntl.fcntl(pipe, fcntl.F_GETFL) | os.O_NONBLOCK)
+            partial[pipe.fileno()] = ''
+        open_fds = set(partial)
+        last_cancel_check = start
+
+        try:
+            while open_fds:
+                readable, _, _ = select.select(list(open_fds), [], [], 0.5)
+                lines = []
+                for fd in readable:
+                    try:
+                        data = os.read(fd, READ_SIZE)
+                    except OSError as e:
+                        if e.errno == errno.EAGAIN:
+                            continue
+                        raise
+                    if not data:
+                        # EOF: flush the last line, even without a newline
+                        open_fds.discard(fd)
+                        if partial[fd]:
+                            lines.append(partial[fd])
+                            partial[fd] = ''
+                        continue
+                    chunks = (partial[fd] + data).split('\n')
+                    partial[fd] = chunks.pop()
+                    lines.extend(chunks)
+                if lines:
+                    self._output(lines)
+
+                now = time.time()
+                if self.timeout and now - start > self.timeout:
+                    self._stop()
+                    raise ProcessFailedException(self._name() + ' timed out after ' + str(self.timeout) + ' seconds', None, list(self.tail))
+                if self.cancelled and now - last_cancel_check >= CANCEL_CHECK_INTERVAL:
+                    last_cancel_check = now
+                    if self.cancelled():
+                        self._stop()
+                        raise JobCancelledException(self._name() + ' was cancelled')
+
+            self.returncode = self.process.wait()
+        finally:
+            self.process.stdout.close()
+            self.process.stderr.close()
+
+        if self.returncode != 0:
+            raise ProcessFailedException(self._name() + ' exited with status ' + str(self.returncode), self.returncode, list(self.tail))
+        return list(self.tail)
+
+    def _output(self, lines):
+        self.tail.extend(lines)
+        self.line_count += len(lines)
+        if self.on_output:
+            self.on_output(lines)
+        for line in lines:
+            for pattern in self.fail_patterns:
+                if pattern in line:
+                    self._stop()
+                    raise ProcessFailedException(self._name() + ' failed: ' + line.strip(), None, list(self.tail))
+
+    def _stop(self):
+        """
+        Terminates the process, and kills it if it does not exit within PROCESS_KILL_GRACE seconds.
+        """
+        if self.process.poll() is not None:
+            return
+        logger.warning('Stopping ' + self._name() + ' (pid ' + str(self.process.pid) + ')')
+        self.process.terminate()
+        deadline = time.time() + settings.PROCESS_KILL_GRACE
+        while self.process.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        if self.process.poll() is None:
+            os.kill(self.process.pid, signal.SIGKILL)
+            self.process.wait()
+        self.returncode = self.process.returncode
+
+    def _name(self):
+        return os.path.basename(self.command[0])
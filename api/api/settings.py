@@ -13,7 +13,7 @@ https://docs.djangoproject.com/en/1.8/ref/settings/
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
 
-import redis
+from api.instrumentation import MonitoredConnectionPool
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -52,6 +52,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'api.middleware.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -139,7 +140,81 @@ SWIFT_API_VERSION = 'v1'
 REDIS_HOST = 'localhost'
 REDIS_PORT = 6379
 REDIS_DATABASE = 0
-REDIS_CON_POOL = redis.ConnectionPool(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DATABASE)
+# A single bounded pool per process, shared by the views and the actors (see GET /controller/redis_pool)
+REDIS_MAX_CONNECTIONS = 100
+REDIS_POOL_TIMEOUT = 20  # seconds waiting for a free connection
+REDIS_HEALTH_CHECK_INTERVAL = 30  # idle seconds after which a connection is checked with a PING
+REDIS_CON_POOL = MonitoredConnectionPool(max_connections=REDIS_MAX_CONNECTIONS, timeout=REDIS_POOL_TIMEOUT,
+                                         health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+                                         host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DATABASE)
+
+# Request instrumentation (Server-Timing header and per-request stats log line)
+REQUEST_INSTRUMENTATION = True
+SLOW_REQUEST_THRESHOLD = None  # seconds. When set, slower requests log the Redis commands they issued
+SLOW_REQUEST_MAX_COMMANDS = 500
+
+# Concurrent storlet uploads when a filter is deployed to many accounts
+SWIFT_DEPLOY_MAX_WORKERS = 10
+SWIFT_DEPLOY_TIMEOUT = 600  # seconds waiting for the next result of a batch deployment
+STORLET_DEPLOYED_CACHE_TTL = 3600  # seconds a storlet upload is remembered, to skip the HEAD on the next deployment
+
+# Uploaded filters, dependencies, metrics and controllers
+MAX_UPLOAD_SIZE = 100 * 1024 * 1024  # bytes
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # bytes
+
+# Downloads of filters, metrics and controllers: None (served by Django), 'x-sendfile' or 'x-accel-redirect'.
+# With 'x-accel-redirect' the nginx location X_ACCEL_REDIRECT_PREFIX must be an internal alias of '/'.
+FILE_DOWNLOAD_MODE = None
+X_ACCEL_REDIRECT_PREFIX = '/crystal_files'
+
+# File synchronization with the Swift nodes (rsync_dir_with_nodes)
+RSYNC_MAX_WORKERS = 10  # Nodes synchronized concurrently
+RSYNC_NODE_TIMEOUT = 120  # seconds
+
+# Directories synchronized with the Swift nodes, by collection name (/controller/artifacts/<collection>)
+ARTIFACT_COLLECTIONS = {'workload_metrics': WORKLOAD_METRICS_DIR,
+                        'native_filters': NATIVE_FILTERS_DIR,
+                        'global_native_filters': GLOBAL_NATIVE_FILTERS_DIR,
+                        'global_controllers': GLOBAL_CONTROLLERS_DIR}
+
+# Background jobs (see api/jobs.py), executed by 'manage.py run_job_worker'
+JOB_HANDLERS = {'create_storage_policy': 'swift.jobs.create_storage_policy',
+                'create_project': 'swift.jobs.create_project',
+                'restart_node': 'swift.jobs.restart_node',
+                'restart_cluster': 'swift.jobs.restart_cluster'}
+JOB_WORKERS = 4  # Worker processes started by run_job_worker
+JOB_LOG_SIZE = 10000  # Output lines kept per job
+JOB_TTL = 7 * 24 * 3600  # seconds a finished job is kept
+JOB_LOCK_TIMEOUT = 3600  # seconds. Locks of jobs whose worker died are freed after this time
+
+# External processes (ansible playbooks, ssh commands) run by the jobs
+PROCESS_OUTPUT_BUFFER_LINES = 1000  # Last output lines kept in memory and reported on failure
+PROCESS_KILL_GRACE = 10  # seconds between SIGTERM and SIGKILL when a process is stopped
+ANSIBLE_PLAYBOOK_TIMEOUT = 3600  # seconds
+NODE_RESTART_TIMEOUT = 300  # seconds
+
+# Cluster restarts: nodes restarted in parallel per batch, and how long to wait for their heartbeat (last_ping) afterwards
+CLUSTER_RESTART_BATCH_SIZE = 2
+NODE_HEALTH_CHECK_TIMEOUT = 120  # seconds
+NODE_HEALTH_CHECK_INTERVAL = 2  # seconds
+
+# Change events published on every policy/filter write (see api/events.py)
+EVENTS_CHANNEL = 'crystal:events'
+EVENTS_LOG_SIZE = 10000  # Number of past events kept for catch-up
+EVENTS_RECONNECT_DELAY = 5  # seconds before subscribing again to the events after a connection error
+
+# Actor restoration after a restart (api/startup.py). Only enable it in the process that hosts the actors.
+RESTORE_ACTORS_ON_STARTUP = False
+ACTOR_SPAWN_WORKERS = 4  # Actors started concurrently
+ACTOR_SPAWN_RATE = 50  # Actors started per second at most
+
+# Actor supervision (controller/supervisor.py): the metric and global controller actors are pinged every
+# SUPERVISOR_INTERVAL seconds, and the failed ones are restarted after SUPERVISOR_BACKOFF_MIN seconds,
+# doubled after each consecutive failure up to SUPERVISOR_BACKOFF_MAX. Only enable it in the process that hosts the actors.
+SUPERVISE_ACTORS = False
+SUPERVISOR_INTERVAL = 10
+SUPERVISOR_BACKOFF_MIN = 5
+SUPERVISOR_BACKOFF_MAX = 300
 
 # SDS Project
 STORLET_BIN_DIR = '/opt/ibm'
@@ -160,12 +235,33 @@ PYACTIVE_URL = PYACTIVE_TRANSPORT + '://' + PYACTIVE_IP + ':' + str(PYACTIVE_POR
 # Metrics
 METRIC_MODULE = 'controller.dynamic_policies.metrics.swift_metric'
 METRIC_CLASS = 'SwiftMetric'
+# Recent values of the metrics (see controller/timeseries.py): (step seconds, points) of each tier,
+# series kept at most, and the file where they are saved when the process exits (None to disable it).
+# A series takes 40 bytes per point (230 KB with these tiers), so 1000 series take about 230 MB per process
+METRIC_SERIES_TIERS = [(1, 3600), (60, 1440), (3600, 720)]
+METRIC_SERIES_MAX_SERIES = 1000
+METRIC_SERIES_SNAPSHOT_FILE = None
 
 # Rules
 RULE_MODULE = 'controller.dynamic_policies.rules.rule'
 RULE_CLASS = 'Rule'
 RULE_TRANSIENT_MODULE = 'controller.dynamic_policies.rules.rule_transient'
 RULE_TRANSIENT_CLASS = 'TransientRule'
+RULE_ENGINE_MODULE = 'controller.dynamic_policies.rules.rule_engine'
+RULE_ENGINE_CLASS = 'RuleEngine'
+# The rule engine of each metric loads the rules of a tenant with its first value (see controller/rule_table.py),
+# and discards them when no value arrives for RULE_IDLE_TIMEOUT seconds (checked every RULE_PASSIVATION_INTERVAL)
+RULE_IDLE_TIMEOUT = 600
+RULE_PASSIVATION_INTERVAL = 60
+# A metric fails its health check when its rule engine processes none of its values for RULE_ENGINE_TIMEOUT seconds
+RULE_ENGINE_TIMEOUT = 60
+# Values kept by each window of the window functions of the conditions (e.g. avg(get_ops, 30s))
+WINDOW_MAX_SAMPLES = 3600
+# Activation URLs of the DSL filters served by this controller: the rules deploy them in-process instead
+# of with an HTTP request. The others are requested with a pooled session (ACTIVATION_POOL_SIZE connections per host).
+LOCAL_ACTIVATION_URLS = ['http://localhost:8000/filters', 'http://127.0.0.1:8000/filters']
+ACTIVATION_POOL_SIZE = 10
+ACTIVATION_TIMEOUT = 10  # Seconds
 
 # Global controllers
 GLOBAL_CONTROLLERS_BASE_MODULE = 'controller.dynamic_policies.rules'
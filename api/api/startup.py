@@ -1,11 +1,25 @@
-from api.common_utils import get_redis_connection
+from api.common_utils import get_redis_connection, NODE_HEARTBEAT_KEY
+from api.events import publish_event
+import atexit
+import json
+import logging
 import sys
+import threading
+import time
 import settings
 
+logger = logging.getLogger(__name__)
+
+
 def run():
     """
     When the controller is started (or restarted) all the actors
     are stopped, so we need to ensure the correct values in redis.
+    With RESTORE_ACTORS_ON_STARTUP, the actors that were running are
+    started again in the background (see controller.views.restore_actors).
+
+    All the resets are sent in pipelines: one round trip per step
+    instead of one per key.
     """
 
     # Add source directories to sys path
@@ -13,18 +27,120 @@ def run():
 
     r = get_redis_connection()
 
+    # Workload metrics and dynamic policies running before the restart
+    metric_keys = r.keys('workload_metric:*')
+    policy_keys = r.keys('policy:*')
+    pipe = r.pipeline(transaction=False)
+    for key in metric_keys:
+        pipe.hget(key, 'enabled')
+    for key in policy_keys:
+        pipe.hget(key, 'alive')
+    flags = pipe.execute()
+    enabled_metrics = [key for key, enabled in zip(metric_keys, flags[:len(metric_keys)]) if enabled == 'True']
+    alive_policies = [key for key, alive in zip(policy_keys, flags[len(metric_keys):]) if alive == 'True']
+
+    pipe = r.pipeline(transaction=False)
     # Workload metric definitions
-    for key in r.keys('workload_metric:*'):
-        r.hset(key, 'enabled', False)
+    for key in metric_keys:
+        pipe.hset(key, 'enabled', False)
 
     # Workload metric Actors
-    for key in r.keys('metric:*'):
-        r.delete(key)
+    metric_actor_keys = r.keys('metric:*')
+    if metric_actor_keys:
+        pipe.delete(*metric_actor_keys)
 
-    # Dynamic policies
-    for key in r.keys('policy:*'):
-        r.hset(key, 'alive', 'False')
+    # Dynamic policies. The rule table is only rebuilt by the process that hosts the
+    # actors (restore_actors registers the alive rules again): the table is shared with
+    # the rule engines, so the other processes must not clear it
+    for key in policy_keys:
+        pipe.hset(key, 'alive', 'False')
+    if settings.RESTORE_ACTORS_ON_STARTUP:
+        rule_table_keys = r.keys('rules:*')
+        if rule_table_keys:
+            pipe.delete(*rule_table_keys)
 
     # Global controllers
     for key in r.keys('controller:*'):
-        r.hset(key, 'enabled', 'False')
+        pipe.hset(key, 'enabled', 'False')
+    pipe.execute()
+    # The rule grammar is rebuilt without the stopped metrics
+    for key in metric_actor_keys:
+        publish_event(r, 'metric', key.split(':', 1)[1])
+
+    # Reverse index of static policies (filter name -> target:policy_id)
+    pipeline_keys = r.keys('pipeline:AUTH_*')
+    pipe = r.pipeline(transaction=False)
+    for key in pipeline_keys:
+        pipe.hgetall(key)
+    pipelines = pipe.execute()
+    pipe = r.pipeline()
+    for key in r.keys('filter_policies:*'):
+        pipe.delete(key)
+    for key, policies in zip(pipeline_keys, pipelines):
+        target = key.replace('pipeline:AUTH_', '', 1)
+        for policy_id, policy in policies.items():
+            pipe.sadd('filter_policies:' + str(json.loads(policy)['filter_name']), target + ':' + policy_id)
+    pipe.execute()
+
+    # Precompiled pipeline documents read by the Swift middleware
+    from filters.views import compile_pipeline
+    for key in pipeline_keys:
+        compile_pipeline(r, key.replace('pipeline:AUTH_', '', 1))
+
+    # Deployed dependencies used to be stored in lists, which could hold the same name twice
+    dependency_keys = r.keys('AUTH_*:dependencies')
+    pipe = r.pipeline(transaction=False)
+    for key in dependency_keys:
+        pipe.type(key)
+    list_keys = [key for key, key_type in zip(dependency_keys, pipe.execute()) if key_type == 'list']
+    pipe = r.pipeline(transaction=False)
+    for key in list_keys:
+        pipe.lrange(key, 0, -1)
+    list_names = pipe.execute()
+    pipe = r.pipeline()
+    for key, names in zip(list_keys, list_names):
+        pipe.delete(key)
+        if names:
+            pipe.sadd(key, *names)
+    pipe.execute()
+
+    # Heartbeat index of the nodes (node name scored by last_ping)
+    node_keys = r.keys('node:*')
+    pipe = r.pipeline(transaction=False)
+    for key in node_keys:
+        pipe.hget(key, 'last_ping')
+    last_pings = pipe.execute()
+    pipe = r.pipeline()
+    pipe.delete(NODE_HEARTBEAT_KEY)
+    for key, last_ping in zip(node_keys, last_pings):
+        if last_ping:
+            pipe.zadd(NODE_HEARTBEAT_KEY, key.split(':', 1)[1], float(last_ping))
+    pipe.execute()
+
+    # Recent values of the metrics, saved when the process exits
+    if settings.METRIC_SERIES_SNAPSHOT_FILE:
+        from controller import timeseries
+        try:
+            timeseries.store.load(settings.METRIC_SERIES_SNAPSHOT_FILE)
+        except (IOError, ValueError) as e:
+            logger.error('Error loading the metric series snapshot: ' + str(e))
+        atexit.register(timeseries.store.save, settings.METRIC_SERIES_SNAPSHOT_FILE)
+
+    # Actor restoration, followed by the readiness endpoint (/controller/ready).
+    # Only the process that restores the actors resets the startup status of its host
+    if settings.RESTORE_ACTORS_ON_STARTUP:
+        from controller.views import STARTUP_STATUS_KEY, restore_actors
+        restoring = bool(enabled_metrics or alive_policies)
+        pipe = r.pipeline()
+        pipe.delete(STARTUP_STATUS_KEY)
+        pipe.hmset(STARTUP_STATUS_KEY, {'state': 'restoring' if restoring else 'ready', 'started_at': time.time()})
+        pipe.execute()
+        if restoring:
+            restore_thread = threading.Thread(target=restore_actors, args=(enabled_metrics, alive_policies), name='restore_actors')
+            restore_thread.daemon = True
+            restore_thread.start()
+
+    # Restart of the actors that fail (/controller/supervisor)
+    if settings.SUPERVISE_ACTORS:
+        from controller.supervisor import supervisor
+        supervisor.start()
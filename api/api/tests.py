@@ -1,15 +1,41 @@
 import calendar
+import json
+import os
+import shutil
+import threading
 import time
 import mock
 import redis
 from django.conf import settings
 from django.core.urlresolvers import resolve
+from django.http import HttpResponse
 from django.test import TestCase, override_settings
 from rest_framework.test import APIRequestFactory
 
-from .common_utils import get_all_registered_nodes, remove_extra_whitespaces, to_json_bools, rsync_dir_with_nodes, get_project_list, get_keystone_admin_auth
-from .exceptions import FileSynchronizationException
-from .startup import run as startup_run
+from . import instrumentation, jobs
+from .events import publish_event, get_events, EventCache
+from .common_utils import get_all_registered_nodes, remove_extra_whitespaces, to_json_bools, rsync_dir_with_nodes, get_project_list, get_keystone_admin_auth, \
+    get_redis_connection, update_manifest, record_node_heartbeat, get_up_node_names, get_up_nodes
+from .exceptions import FileSynchronizationException, JobLockedException, JobCancelledException, ProcessFailedException
+from .middleware import InstrumentationMiddleware
+from .process import ProcessRunner
+from .startup import run as startup_run, settings as startup_settings
+from controller.views import STARTUP_STATUS_KEY
+
+
+SYNC_DIR = os.path.join("/tmp", "crystal", "sync_test")
+
+
+def fake_job(job):
+    job.log('Working on ' + job.data['name'] + '\n')
+    if job.data.get('fail'):
+        raise Exception('Fake job failed')
+    return {'done': job.data['name']}
+
+
+def slow_job(job):
+    time.sleep(job.data['seconds'])
+    return {'lock': job.r.get('job_lock:' + job.data['resource'])}
 
 
 # Tests use database=10 instead of 0.
@@ -22,6 +48,7 @@ class MainTestCase(TestCase):
 
     def tearDown(self):
         self.r.flushdb()
+        shutil.rmtree(SYNC_DIR, ignore_errors=True)
 
     def test_remove_extra_whitespaces_ok(self):
         ret = remove_extra_whitespaces("a  b c   d e     f")
@@ -50,30 +77,147 @@ class MainTestCase(TestCase):
         self.assertEqual(bdict['d'], 'False')
         self.assertNotEqual(bdict['d'], False)
 
-    @mock.patch('api.common_utils.os.system')
-    def test_rsync_dir_with_nodes_ok(self, mock_os_system):
-        mock_os_system.return_value = 0  # return value when rsync succeeds
+    @mock.patch('api.common_utils.subprocess.Popen')
+    def test_rsync_dir_with_nodes_ok(self, mock_popen):
+        mock_popen.return_value.poll.return_value = 0  # return value when rsync succeeds
+        mock_popen.return_value.returncode = 0
+
+        self.configure_usernames_and_passwords_for_nodes()
+        self.create_sync_dir()
+        results = rsync_dir_with_nodes(SYNC_DIR)
+
+        # test that rsync_dir_with_nodes() called rsync with the right parameters
+        calls = [mock.call(['sshpass', '-p', 's3cr3t', 'rsync', '-avz', '-e', 'ssh', SYNC_DIR + '/m1.py', SYNC_DIR + '/m2.py', 'user1@192.168.2.1:' + SYNC_DIR + '/'],
+                           stdout=mock.ANY, stderr=mock.ANY),
+                 mock.call(['sshpass', '-p', 's3cr3t', 'rsync', '-avz', '-e', 'ssh', SYNC_DIR + '/m1.py', SYNC_DIR + '/m2.py', 'user1@192.168.2.2:' + SYNC_DIR + '/'],
+                           stdout=mock.ANY, stderr=mock.ANY),
+                 mock.call(['sshpass', '-p', 's3cr3t', 'rsync', '-avz', '-e', 'ssh', SYNC_DIR + '/m1.py', SYNC_DIR + '/m2.py', 'user1@192.168.2.3:' + SYNC_DIR + '/'],
+                           stdout=mock.ANY, stderr=mock.ANY)]
+        mock_popen.assert_has_calls(calls, any_order=True)
+        self.assertEqual(sorted(results.keys()), ['controller', 'storagenode1', 'storagenode2'])
+        self.assertEqual(results['storagenode1']['status'], 'ok')
+        self.assertEqual(results['storagenode1']['files'], 2)
+
+    @mock.patch('api.common_utils.subprocess.Popen')
+    def test_rsync_dir_with_nodes_only_pushes_changes(self, mock_popen):
+        mock_popen.return_value.poll.return_value = 0
+        mock_popen.return_value.returncode = 0
+
+        self.configure_usernames_and_passwords_for_nodes()
+        self.create_sync_dir()
+        rsync_dir_with_nodes(SYNC_DIR)
+        version = update_manifest(self.r, SYNC_DIR)[1]
+
+        # Nothing changed: nodes are skipped
+        mock_popen.reset_mock()
+        results = rsync_dir_with_nodes(SYNC_DIR)
+        self.assertFalse(mock_popen.called)
+        self.assertEqual(results['controller']['status'], 'current')
+        self.assertEqual(update_manifest(self.r, SYNC_DIR)[1], version)
+
+        # One file changed: only this file is pushed
+        with open(os.path.join(SYNC_DIR, 'm2.py'), 'w') as f:
+            f.write('class Metric2(object):\n    pass\n')
+        rsync_dir_with_nodes(SYNC_DIR)
+        mock_popen.assert_called_with(['sshpass', '-p', 's3cr3t', 'rsync', '-avz', '-e', 'ssh', SYNC_DIR + '/m2.py', mock.ANY],
+                                      stdout=mock.ANY, stderr=mock.ANY)
+        self.assertEqual(update_manifest(self.r, SYNC_DIR)[1], version + 1)
+
+        # One file removed: the directory is mirrored
+        os.remove(os.path.join(SYNC_DIR, 'm1.py'))
+        rsync_dir_with_nodes(SYNC_DIR)
+        mock_popen.assert_called_with(['sshpass', '-p', 's3cr3t', 'rsync', '--delete', '-avrz', '-e', 'ssh', SYNC_DIR, mock.ANY],
+                                      stdout=mock.ANY, stderr=mock.ANY)
+
+    @mock.patch('api.common_utils.subprocess.Popen')
+    def test_rsync_dir_with_nodes_pushes_everything_to_nodes_back_from_down(self, mock_popen):
+        mock_popen.return_value.poll.return_value = 0
+        mock_popen.return_value.returncode = 0
 
         self.configure_usernames_and_passwords_for_nodes()
-        rsync_dir_with_nodes(settings.WORKLOAD_METRICS_DIR)
+        self.create_sync_dir()
+        rsync_dir_with_nodes(SYNC_DIR)
 
-        # test that rsync_dir_with_nodes() called os.system with the right parameters
-        calls = [mock.call("sshpass -p s3cr3t rsync --progress --delete -avrz -e ssh /opt/crystal/workload_metrics user1@192.168.2.1:/opt/crystal"),
-                 mock.call("sshpass -p s3cr3t rsync --progress --delete -avrz -e ssh /opt/crystal/workload_metrics user1@192.168.2.2:/opt/crystal"),
-                 mock.call("sshpass -p s3cr3t rsync --progress --delete -avrz -e ssh /opt/crystal/workload_metrics user1@192.168.2.3:/opt/crystal")]
-        mock_os_system.assert_has_calls(calls, any_order=True)
+        # storagenode1 was DOWN (and maybe re-imaged): its next heartbeat resets what it is known to have
+        self.r.zadd('nodes:heartbeat', 'storagenode1', time.time() - 60)
+        record_node_heartbeat(self.r, 'storagenode1', {'last_ping': time.time()})
+        self.assertFalse(self.r.exists('manifest:' + SYNC_DIR + ':node:storagenode1'))
+        self.assertTrue(self.r.exists('manifest:' + SYNC_DIR + ':node:controller'))
+
+        mock_popen.reset_mock()
+        results = rsync_dir_with_nodes(SYNC_DIR)
+        mock_popen.assert_called_once_with(['sshpass', '-p', 's3cr3t', 'rsync', '-avz', '-e', 'ssh', SYNC_DIR + '/m1.py', SYNC_DIR + '/m2.py',
+                                            'user1@192.168.2.2:' + SYNC_DIR + '/'], stdout=mock.ANY, stderr=mock.ANY)
+        self.assertEqual(results['controller']['status'], 'current')
 
     def test_rsync_dir_with_nodes_when_username_and_password_not_present(self):
         with self.assertRaises(FileSynchronizationException):
             rsync_dir_with_nodes(settings.WORKLOAD_METRICS_DIR)
 
-    @mock.patch('api.common_utils.os.system')
-    def test_rsync_dir_with_nodes_when_rsync_fails(self, mock_os_system):
-        mock_os_system.return_value = 1  # return value when rsync fails
+    @mock.patch('api.common_utils.subprocess.Popen')
+    def test_rsync_dir_with_nodes_when_rsync_fails(self, mock_popen):
+        mock_popen.return_value.poll.return_value = 1  # return value when rsync fails
+        mock_popen.return_value.returncode = 1
 
         self.configure_usernames_and_passwords_for_nodes()
-        with self.assertRaises(FileSynchronizationException):
-            rsync_dir_with_nodes(settings.WORKLOAD_METRICS_DIR)
+        self.create_sync_dir()
+        with self.assertRaises(FileSynchronizationException) as cm:
+            rsync_dir_with_nodes(SYNC_DIR)
+        self.assertEqual(cm.exception.results['controller']['status'], 'failed')
+        # Failed nodes are retried in the next synchronization
+        self.assertFalse(self.r.exists('manifest:' + SYNC_DIR + ':node:controller'))
+
+    @mock.patch('api.common_utils.subprocess.Popen')
+    def test_rsync_dir_with_nodes_partial_failure(self, mock_popen):
+        def popen(args, stdout, stderr):
+            process = mock.Mock()
+            process.returncode = 1 if args[-1].startswith('user1@192.168.2.2:') else 0
+            process.poll.return_value = process.returncode
+            return process
+        mock_popen.side_effect = popen
+
+        self.configure_usernames_and_passwords_for_nodes()
+        self.create_sync_dir()
+        with self.assertRaises(FileSynchronizationException) as cm:
+            rsync_dir_with_nodes(SYNC_DIR, full_sync=True)
+        results = cm.exception.results
+        self.assertEqual(results['storagenode1']['status'], 'failed')
+        self.assertEqual(results['controller']['status'], 'ok')
+        self.assertEqual(results['storagenode2']['status'], 'ok')
+
+    @override_settings(RSYNC_NODE_TIMEOUT=0)
+    @mock.patch('api.common_utils.subprocess.Popen')
+    def test_rsync_dir_with_nodes_timeout(self, mock_popen):
+        mock_popen.return_value.poll.return_value = None  # rsync never ends
+
+        self.configure_usernames_and_passwords_for_nodes()
+        self.create_sync_dir()
+        with self.assertRaises(FileSynchronizationException) as cm:
+            rsync_dir_with_nodes(SYNC_DIR)
+        self.assertTrue(mock_popen.return_value.kill.called)
+        self.assertEqual(cm.exception.results['storagenode2']['status'], 'timeout')
+
+    def test_rsync_dir_with_nodes_skips_down_nodes(self):
+        self.configure_usernames_and_passwords_for_nodes()
+        for node_name in ('controller', 'storagenode1', 'storagenode2'):
+            record_node_heartbeat(self.r, node_name, {'last_ping': '1467623304.332646'})
+        self.assertEqual(rsync_dir_with_nodes(settings.WORKLOAD_METRICS_DIR), {})
+
+    def test_get_up_nodes_ok(self):
+        record_node_heartbeat(self.r, 'storagenode1', {'last_ping': '1467623304.332646'})
+        self.assertEqual(sorted(get_up_node_names(self.r)), ['controller', 'storagenode2'])
+        self.assertEqual(sorted(node['ip'] for node in get_up_nodes(self.r)), ['192.168.2.1', '192.168.2.3'])
+        self.assertEqual(self.r.hget('node:storagenode1', 'last_ping'), '1467623304.332646')
+
+    def test_get_up_nodes_with_heartbeats_of_the_nodes(self):
+        record_node_heartbeat(self.r, 'storagenode1', {'last_ping': '1467623304.332646'})
+        # The heartbeats of the Swift nodes only update their hash
+        self.r.hset('node:storagenode1', 'last_ping', time.time())
+        self.assertEqual(sorted(get_up_node_names(self.r)), ['controller', 'storagenode1', 'storagenode2'])
+        # Older values of the hashes do not replace the indexed ones
+        self.r.hset('node:storagenode2', 'last_ping', '1467623304.332646')
+        self.r.delete('nodes:heartbeat:refreshed')
+        self.assertIn('storagenode2', get_up_node_names(self.r))
 
     # @mock.patch('api.common_utils.get_keystone_admin_auth')
     # def test_is_valid_request_new_valid_token(self, mock_keystone_admin_auth):
@@ -137,20 +281,345 @@ class MainTestCase(TestCase):
         get_keystone_admin_auth()
         mock_keystone_client.assert_called_with(username='mng_username', tenant_name='mng_account', password='mng_pw', auth_url='http://localhost:35357/v2.0')
 
+    @mock.patch('api.startup.threading.Thread')
+    @mock.patch.object(startup_settings, 'RESTORE_ACTORS_ON_STARTUP', True)
+    def test_startup_run_restores_actors(self, mock_thread):
+        self.create_startup_fixtures()
+        startup_run()
+        metric_keys, policy_keys = mock_thread.call_args[1]['args']
+        self.assertEqual(sorted(metric_keys), ['workload_metric:1', 'workload_metric:2'])
+        self.assertEqual(sorted(policy_keys), ['policy:1', 'policy:2'])
+        self.assertTrue(mock_thread.return_value.start.called)
+        self.assertEqual(self.r.hget(STARTUP_STATUS_KEY, 'state'), 'restoring')
+        # The rule table is rebuilt by the restoration
+        self.assertFalse(self.r.exists('rules:metric1:0123456789abcdef'))
+
     def test_startup_run_ok(self):
         self.create_startup_fixtures()
+        # The status of the restoration is only reset by the process that restores the actors
+        self.r.hset(STARTUP_STATUS_KEY, 'state', 'restoring')
         startup_run()
+        self.assertEqual(self.r.hget(STARTUP_STATUS_KEY, 'state'), 'restoring')
         self.assertEquals(self.r.hget('workload_metric:1', 'enabled'), 'False')
         self.assertEquals(self.r.hget('workload_metric:2', 'enabled'), 'False')
         self.assertFalse(self.r.exists('metric:metric1'))
         self.assertFalse(self.r.exists('metric:metric2'))
         self.assertEquals(self.r.hget('policy:1', 'alive'), 'False')
         self.assertEquals(self.r.hget('policy:2', 'alive'), 'False')
+        # The rule table is left to the process that hosts the actors
+        self.assertEqual(self.r.smembers('rules:metric1:0123456789abcdef'), {'policy:1'})
+        self.assertEquals(self.r.smembers('filter_policies:compression-1.0.jar'), {'0123456789abcdef:1', '0123456789abcdef:container1:3'})
+        self.assertEquals(self.r.smembers('filter_policies:crypto-1.0.jar'), {'0123456789abcdef:2'})
+        self.assertFalse(self.r.exists('filter_policies:stale-1.0.jar'))
+        self.assertEquals(self.r.type('AUTH_0123456789abcdef:dependencies'), 'set')
+        self.assertEquals(self.r.smembers('AUTH_0123456789abcdef:dependencies'), {'dep1', 'dep2'})
+        self.assertEquals(self.r.zrange('nodes:heartbeat', 0, -1, withscores=True), [('stalenode', 1467623304.0)])
+
+    #
+    # Request instrumentation
+    #
+
+    def test_monitored_connection_pool(self):
+        pool = instrumentation.MonitoredConnectionPool(max_connections=2, timeout=0.1, health_check_interval=0,
+                                                       host='localhost', port=6379, db=10)
+        r = redis.Redis(connection_pool=pool)
+        r.set('pool:key', 'value')
+        self.assertEqual(r.get('pool:key'), 'value')
+        stats = pool.stats()
+        self.assertEqual((stats['connections'], stats['checkouts'], stats['in_use']), (1, 2, 0))
+
+        # When all the connections are in use, the next client waits and gives up
+        connection1 = pool.get_connection('GET')
+        connection2 = pool.get_connection('GET')
+        self.assertRaises(redis.ConnectionError, pool.get_connection, 'GET')
+        stats = pool.stats()
+        self.assertEqual((stats['in_use'], stats['peak_in_use'], stats['timeouts']), (2, 2, 1))
+        pool.release(connection2)
+
+        # Idle connections are checked before they are reused
+        connection2.send_command = mock.Mock(side_effect=redis.ConnectionError)
+        connection = pool.get_connection('GET')
+        self.assertIs(connection, connection2)
+        self.assertEqual(pool.stats()['health_check_failures'], 1)
+        pool.release(connection)
+        pool.release(connection1)
+        self.assertEqual(pool.stats()['in_use'], 0)
+
+    def test_instrumented_redis_counts_commands_and_round_trips(self):
+        stats = instrumentation.start_request()
+        r = get_redis_connection()
+        r.set('instrumentation:key', 'value')
+        r.get('instrumentation:key')
+        r.pipeline().get('instrumentation:key').get('instrumentation:key').execute()
+        self.assertEqual(instrumentation.end_request(), stats)
+
+        self.assertEqual(stats.redis_commands, 4)
+        self.assertEqual(stats.redis_round_trips, 3)
+        self.assertIsNone(instrumentation.get_current_stats())
+
+    def test_instrumented_redis_without_request(self):
+        r = get_redis_connection()
+        r.set('instrumentation:key', 'value')
+        self.assertEqual(r.get('instrumentation:key'), 'value')
+        self.assertIsNone(instrumentation.get_current_stats())
+
+    def test_instrumentation_timed_external_calls(self):
+        stats = instrumentation.start_request()
+        with instrumentation.timed('keystone'):
+            pass
+        with instrumentation.timed('swift'):
+            pass
+        with instrumentation.timed('swift'):
+            pass
+        instrumentation.end_request()
+        self.assertEqual(stats.calls['keystone'], 1)
+        self.assertEqual(stats.calls['swift'], 2)
+
+    @override_settings(REQUEST_INSTRUMENTATION=True, SLOW_REQUEST_THRESHOLD=0, SLOW_REQUEST_MAX_COMMANDS=1)
+    def test_instrumentation_middleware_ok(self):
+        request = self.factory.get('/controller/static_policy')
+        middleware = InstrumentationMiddleware()
+        middleware.process_request(request)
+        r = get_redis_connection()
+        r.keys('pipeline:AUTH_*')
+        r.get('instrumentation:key')
+        stats = instrumentation.get_current_stats()
+        response = middleware.process_response(request, HttpResponse())
+
+        self.assertIn('redis;dur=', response['Server-Timing'])
+        self.assertIn('2 cmds, 2 round trips', response['Server-Timing'])
+        self.assertIn('total;dur=', response['Server-Timing'])
+        self.assertEqual(stats.sampled_commands, ['KEYS pipeline:AUTH_*'])
+
+    @override_settings(REQUEST_INSTRUMENTATION=False)
+    def test_instrumentation_middleware_disabled(self):
+        request = self.factory.get('/controller/static_policy')
+        middleware = InstrumentationMiddleware()
+        middleware.process_request(request)
+        response = middleware.process_response(request, HttpResponse())
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    #
+    # Change events
+    #
+
+    def test_publish_event_ok(self):
+        event = publish_event(self.r, 'static_policy', 3, '0123456789abcdef', 7)
+        self.assertEqual(event['seq'], 1)
+        publish_event(self.r, 'filter', 1)
+        events = get_events(self.r)
+        self.assertEqual([(e['seq'], e['type'], e['id']) for e in events], [(1, 'static_policy', '3'), (2, 'filter', '1')])
+        self.assertEqual(events[0]['target'], '0123456789abcdef')
+        self.assertEqual(events[0]['version'], 7)
+        self.assertEqual([e['seq'] for e in get_events(self.r, 1)], [2])
+
+    def test_publish_event_from_many_threads_publishes_in_seq_order(self):
+        pubsub = self.r.pubsub()
+        pubsub.subscribe(settings.EVENTS_CHANNEL)
+        messages = pubsub.listen()
+        next(messages)  # Subscription confirmation
+
+        def publish(filter_id):
+            for _ in range(10):
+                publish_event(self.r, 'filter', filter_id)
+        threads = [threading.Thread(target=publish, args=(filter_id,)) for filter_id in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        published = [json.loads(next(messages)['data'])['seq'] for _ in range(40)]
+        pubsub.close()
+        self.assertEqual(published, range(1, 41))
+        self.assertEqual([e['seq'] for e in get_events(self.r)], range(1, 41))
+
+    @override_settings(EVENTS_LOG_SIZE=2)
+    def test_publish_event_caps_the_log(self):
+        for filter_id in range(5):
+            publish_event(self.r, 'filter', filter_id)
+        self.assertEqual([e['seq'] for e in get_events(self.r)], [4, 5])
+
+    def test_event_cache_ok(self):
+        loader = mock.Mock(side_effect=lambda r, entity_id: r.hgetall('filter:' + str(entity_id)))
+        self.r.hmset('filter:1', {'filter_name': 'compression-1.0.jar'})
+        cache = EventCache(self.r, {'filter': loader})
+        self.assertEqual(cache.get('filter', 1)['filter_name'], 'compression-1.0.jar')
+        self.assertEqual(cache.get('filter', 1)['filter_name'], 'compression-1.0.jar')
+        self.assertEqual(loader.call_count, 1)
+
+        self.r.hmset('filter:1', {'filter_name': 'compression-2.0.jar'})
+        cache.apply(publish_event(self.r, 'filter', 1))
+        self.assertEqual(cache.last_seq, 1)
+        self.assertEqual(cache.get('filter', 1)['filter_name'], 'compression-2.0.jar')
+        self.assertEqual(loader.call_count, 2)
+
+    def test_event_cache_does_not_keep_values_invalidated_while_loading(self):
+        def loader(r, entity_id):
+            value = r.hgetall('filter:' + str(entity_id))
+            # The filter changes before the loaded value is stored
+            r.hmset('filter:1', {'filter_name': 'compression-2.0.jar'})
+            cache.apply(publish_event(r, 'filter', 1))
+            return value
+        self.r.hmset('filter:1', {'filter_name': 'compression-1.0.jar'})
+        cache = EventCache(self.r, {'filter': loader})
+        self.assertEqual(cache.get('filter', 1)['filter_name'], 'compression-1.0.jar')
+        self.assertNotIn(('filter', '1'), cache.data)
+
+    def test_event_cache_catch_up(self):
+        loader = mock.Mock(return_value={})
+        cache = EventCache(self.r, {'filter': loader, 'slo': loader})
+        cache.get('filter', 1)
+        cache.get('filter', 2)
+        publish_event(self.r, 'filter', 1)
+        publish_event(self.r, 'slo', 'bandwidth:get_bw', '0123456789abcdef')
+        # A message with a gap in the sequence reads the missing events from the log
+        cache.apply(publish_event(self.r, 'slo', 'bandwidth:put_bw', '0123456789abcdef'))
+        self.assertEqual(cache.last_seq, 3)
+        self.assertNotIn(('filter', '1'), cache.data)
+        self.assertIn(('filter', '2'), cache.data)
+
+    @override_settings(EVENTS_LOG_SIZE=1)
+    def test_event_cache_catch_up_after_trimmed_log(self):
+        cache = EventCache(self.r, {'filter': mock.Mock(return_value={})})
+        cache.get('filter', 2)
+        publish_event(self.r, 'filter', 1)
+        publish_event(self.r, 'filter', 1)
+        cache.catch_up()
+        self.assertEqual(cache.last_seq, 2)
+        self.assertEqual(cache.data, {})
+
+    @override_settings(EVENTS_RECONNECT_DELAY=0)
+    def test_event_cache_listen_subscribes_again(self):
+        cache = EventCache(self.r, {'filter': mock.Mock(return_value={})})
+        cache.get('filter', 1)
+        stop = threading.Event()
+        lost_pubsub = mock.Mock()
+        lost_pubsub.listen.side_effect = redis.ConnectionError('Connection closed by server')
+
+        def listen():
+            yield {'type': 'subscribe', 'data': 1}
+            cache.get('filter', 2)
+            stop.set()
+            yield {'type': 'message', 'data': json.dumps(publish_event(self.r, 'filter', 2))}
+        pubsub = mock.Mock()
+        pubsub.listen.side_effect = listen
+        with mock.patch.object(self.r, 'pubsub', side_effect=[lost_pubsub, pubsub]):
+            cache.listen(stop)
+        # The entries loaded before the connection was lost are discarded
+        self.assertEqual(cache.data, {})
+        self.assertEqual(cache.last_seq, 1)
+        self.assertTrue(lost_pubsub.close.called)
 
     #
     # URL tests
     #
 
+    #
+    # Background jobs
+    #
+
+    @override_settings(JOB_HANDLERS={'fake': 'api.tests.fake_job'})
+    def test_execute_job_ok(self):
+        job_id = jobs.submit_job(self.r, 'fake', {'name': 'job1'}, 'resource1')
+        self.assertEqual(jobs.get_job(self.r, job_id)['status'], jobs.QUEUED)
+        self.assertEqual(self.r.get('job_lock:resource1'), str(job_id))
+
+        jobs.execute_job(self.r, self.r.rpop('jobs:queue'))
+        job = jobs.get_job(self.r, job_id)
+        self.assertEqual(job['status'], jobs.SUCCEEDED)
+        self.assertEqual(job['result'], {'done': 'job1'})
+        self.assertEqual(jobs.get_job_log(self.r, job_id), (['Working on job1'], 1))
+        self.assertEqual(jobs.get_job_log(self.r, job_id, 1), ([], 1))
+        self.assertFalse(self.r.exists('job_lock:resource1'))
+        self.assertTrue(self.r.ttl('job:' + str(job_id)) > 0)
+
+    @override_settings(JOB_HANDLERS={'fake': 'api.tests.fake_job'})
+    def test_execute_job_fails(self):
+        job_id = jobs.submit_job(self.r, 'fake', {'name': 'job1', 'fail': True}, 'resource1')
+        jobs.execute_job(self.r, job_id)
+        job = jobs.get_job(self.r, job_id)
+        self.assertEqual(job['status'], jobs.FAILED)
+        self.assertEqual(job['error'], 'Fake job failed')
+        self.assertFalse(self.r.exists('job_lock:resource1'))
+
+    @override_settings(JOB_HANDLERS={'fake': 'api.tests.fake_job'})
+    def test_submit_job_to_locked_resource(self):
+        job_id = jobs.submit_job(self.r, 'fake', {'name': 'job1'}, 'resource1')
+        with self.assertRaises(JobLockedException) as cm:
+            jobs.submit_job(self.r, 'fake', {'name': 'job2'}, 'resource1')
+        self.assertEqual(cm.exception.job_id, str(job_id))
+        # Other resources are not locked
+        jobs.submit_job(self.r, 'fake', {'name': 'job3'}, 'resource2')
+        self.assertEqual(self.r.llen('jobs:queue'), 2)
+
+    @override_settings(JOB_HANDLERS={'fake': 'api.tests.fake_job'})
+    @mock.patch('api.jobs.LOCKED_RETRY_DELAY', 0)
+    def test_execute_job_with_resource_locked_by_another_job(self):
+        job_id = jobs.submit_job(self.r, 'fake', {'name': 'job1'}, 'resource1')
+        # The reservation expired while the job was queued, and another job took the resource
+        self.r.set('job_lock:resource1', 'other')
+        jobs.execute_job(self.r, self.r.rpop('jobs:queue'))
+        self.assertEqual(jobs.get_job(self.r, job_id)['status'], jobs.QUEUED)
+        self.assertEqual(self.r.lrange('jobs:queue', 0, -1), [str(job_id)])
+
+        self.r.delete('job_lock:resource1')
+        jobs.execute_job(self.r, self.r.rpop('jobs:queue'))
+        self.assertEqual(jobs.get_job(self.r, job_id)['status'], jobs.SUCCEEDED)
+        self.assertFalse(self.r.exists('job_lock:resource1'))
+
+    @override_settings(JOB_HANDLERS={'slow': 'api.tests.slow_job'}, JOB_LOCK_TIMEOUT=1)
+    def test_job_lock_is_extended_while_running(self):
+        job_id = jobs.submit_job(self.r, 'slow', {'seconds': 2, 'resource': 'resource1'}, 'resource1')
+        jobs.execute_job(self.r, self.r.rpop('jobs:queue'))
+        self.assertEqual(jobs.get_job(self.r, job_id)['result'], {'lock': str(job_id)})
+        self.assertFalse(self.r.exists('job_lock:resource1'))
+
+    @override_settings(JOB_HANDLERS={'fake': 'api.tests.fake_job'})
+    def test_cancel_queued_job(self):
+        job_id = jobs.submit_job(self.r, 'fake', {'name': 'job1'}, 'resource1')
+        self.assertEqual(jobs.cancel_job(self.r, job_id), jobs.CANCELLED)
+        self.assertEqual(self.r.llen('jobs:queue'), 0)
+        self.assertFalse(self.r.exists('job_lock:resource1'))
+        self.assertEqual([job['status'] for job in jobs.list_jobs(self.r)], [jobs.CANCELLED])
+
+    #
+    # Process runner
+    #
+
+    @override_settings(PROCESS_OUTPUT_BUFFER_LINES=3)
+    def test_process_runner_ok(self):
+        output = []
+        runner = ProcessRunner(['sh', '-c', 'printf "a\\nb"; sleep 0.2; printf "c\\n" >&2; sleep 0.2; echo d; printf e'], on_output=output.extend)
+        self.assertEqual(runner.run(), ['c', 'bd', 'e'])
+        # Partial lines are joined, stderr lines are kept apart
+        self.assertEqual(output, ['a', 'c', 'bd', 'e'])
+        self.assertEqual(runner.line_count, 4)
+        self.assertEqual(runner.returncode, 0)
+
+    def test_process_runner_stops_on_fail_pattern(self):
+        runner = ProcessRunner(['sh', '-c', 'echo "FATAL: unreachable"; sleep 30'], fail_patterns=('FATAL',))
+        with self.assertRaises(ProcessFailedException) as cm:
+            runner.run()
+        self.assertEqual(cm.exception.output, ['FATAL: unreachable'])
+        self.assertIsNotNone(runner.process.poll())
+
+    @override_settings(PROCESS_KILL_GRACE=0.5)
+    def test_process_runner_timeout_kills_the_process(self):
+        runner = ProcessRunner(['sh', '-c', 'trap "" TERM; sleep 30'], timeout=0.5)
+        self.assertRaises(ProcessFailedException, runner.run)
+        self.assertIsNotNone(runner.process.poll())
+
+    @mock.patch('api.process.CANCEL_CHECK_INTERVAL', 0)
+    def test_process_runner_cancelled(self):
+        runner = ProcessRunner(['sleep', '30'], cancelled=lambda: True)
+        self.assertRaises(JobCancelledException, runner.run)
+        self.assertIsNotNone(runner.process.poll())
+
+    def test_process_runner_with_non_zero_exit_status(self):
+        with self.assertRaises(ProcessFailedException) as cm:
+            ProcessRunner(['sh', '-c', 'echo error; exit 3']).run()
+        self.assertEqual(cm.exception.returncode, 3)
+        self.assertEqual(cm.exception.output, ['error'])
+
     def test_urls(self):
         resolver = resolve('/filters/')
         self.assertEqual(resolver.view_name, 'filters.views.storlet_list')
@@ -184,6 +653,16 @@ class MainTestCase(TestCase):
         self.r.hmset('node:storagenode2',
                      {'ip': '192.168.2.3', 'last_ping': str(calendar.timegm(time.gmtime())), 'type': 'object', 'name': 'storagenode2',
                       'devices': '{"sdb1": {"free": 16832876544, "size": 16832880640}}'})
+        now = calendar.timegm(time.gmtime())
+        self.r.zadd('nodes:heartbeat', controller=now, storagenode1=now, storagenode2=now)
+
+    def create_sync_dir(self):
+        if not os.path.exists(SYNC_DIR):
+            os.makedirs(SYNC_DIR)
+        with open(os.path.join(SYNC_DIR, 'm1.py'), 'w') as f:
+            f.write('class Metric1(object):\n    pass\n')
+        with open(os.path.join(SYNC_DIR, 'm2.py'), 'w') as f:
+            f.write('class Metric2: pass\n')
 
     def configure_usernames_and_passwords_for_nodes(self):
         self.r.hmset('node:controller', {'ssh_username': 'user1', 'ssh_password': 's3cr3t'})
@@ -201,6 +680,14 @@ class MainTestCase(TestCase):
                      {'alive': 'True', 'policy_description': 'FOR TENANT:0123456789abcdef DO SET compression'})
         self.r.hmset('policy:2',
                      {'alive': 'True', 'policy_description': 'FOR TENANT:0123456789abcdef DO SET encryption'})
+        self.r.hmset('pipeline:AUTH_0123456789abcdef', {'1': '{"filter_name": "compression-1.0.jar", "execution_order": 1}',
+                                                        '2': '{"filter_name": "crypto-1.0.jar", "execution_order": 2}'})
+        self.r.hmset('pipeline:AUTH_0123456789abcdef:container1', {'3': '{"filter_name": "compression-1.0.jar", "execution_order": 3}'})
+        self.r.sadd('filter_policies:stale-1.0.jar', '0123456789abcdef:4')
+        self.r.sadd('rules:metric1:0123456789abcdef', 'policy:1')
+        self.r.rpush('AUTH_0123456789abcdef:dependencies', 'dep1', 'dep2', 'dep1')
+        self.r.delete('node:controller', 'node:storagenode1', 'node:storagenode2')
+        self.r.hmset('node:stalenode', {'ip': '192.168.2.4', 'last_ping': '1467623304', 'name': 'stalenode'})
 
 
 class FakeTokenData:
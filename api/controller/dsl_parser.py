@@ -1,7 +1,11 @@
 from pyparsing import Word, Suppress, alphas, Literal, Group, Combine, opAssoc, alphanums
 from pyparsing import Regex, operatorPrecedence, oneOf, nums, Optional, delimitedList
 from django.conf import settings
-import redis
+import threading
+
+from api.events import EVENTS_LOG_KEY
+from api.instrumentation import InstrumentedRedis
+from controller.dynamic_policies.rules.windows import functions as window_functions
 
 # By default, PyParsing treats \n as whitespace and ignores it
 # In our grammar, \n is significant, so tell PyParsing not to ignore it
@@ -22,7 +26,7 @@ import redis
 
 
 def get_redis_connection():
-    return redis.Redis(connection_pool=settings.REDIS_CON_POOL)
+    return InstrumentedRedis(connection_pool=settings.REDIS_CON_POOL)
 
 
 def parse_group_tenants(tokens):
@@ -31,11 +35,40 @@ def parse_group_tenants(tokens):
     return data
 
 
-def parse(input_string):
-    # TODO Raise an exception if not metrics or not action registered
-    # TODO Raise an exception if group of tenants does not exist.
-    r = get_redis_connection()
-
+# Compiled grammar, the (metrics, filters) it was built with and the last change event seen then
+_grammar_cache = {'key': None, 'grammar': None, 'event': None}
+_grammar_lock = threading.Lock()
+
+
+def get_grammar(r=None):
+    """
+    Returns the rule grammar. It depends on the registered metrics and DSL
+    filters, and it is only rebuilt when they change.
+
+    Their writers publish a change event (see api/events.py), so the metrics
+    and filters are only listed again when an event was published since the
+    last call.
+    """
+    r = r or get_redis_connection()
+    # Read before listing them: a change made meanwhile is seen in the next call
+    last_event = r.zrange(EVENTS_LOG_KEY, -1, -1)
+    last_event = last_event[0] if last_event else None
+    with _grammar_lock:
+        if last_event and _grammar_cache['event'] == last_event:
+            return _grammar_cache['grammar']
+
+    services = sorted(key.split(":")[1] for key in r.keys("metric:*"))
+    sfilter = sorted(key.split(":")[1] for key in r.keys("dsl_filter:*"))
+    key = (tuple(services), tuple(sfilter))
+    with _grammar_lock:
+        if _grammar_cache['key'] != key:
+            _grammar_cache['grammar'] = build_grammar(services, sfilter)
+            _grammar_cache['key'] = key
+        _grammar_cache['event'] = last_event
+        return _grammar_cache['grammar']
+
+
+def build_grammar(services, sfilter):
     # Support words to construct the grammar.
     word = Word(alphas)
     when = Suppress(Literal("WHEN"))
@@ -43,12 +76,13 @@ def parse(input_string):
     # boolean_condition = oneOf("AND OR")
     # Condition part
     param = Word(alphanums+"_") + Suppress(Literal("=")) + Word(alphanums+"_")
-    metrics_workload = r.keys("metric:*")
-    services = map(lambda x: "".join(x.split(":")[1]), metrics_workload)
     services_options = oneOf(services)
     operand = oneOf("< > == != <= >=")
     number = Regex(r"[+-]?\d+(:?\.\d*)?(:?[eE][+-]?\d+)?")
-    condition = Group(services_options + operand("operand") + number("limit_value"))
+    # Window functions: avg(metric, 30s)
+    window = Group(oneOf(" ".join(window_functions))("function") + Suppress("(") + services_options("metric") + Suppress(",") +
+                   Regex(r"\d+[smh]")("window") + Suppress(")"))
+    condition = Group((window | services_options) + operand("operand") + number("limit_value"))
     condition_list = operatorPrecedence(condition, [
                                 ("AND", 2, opAssoc.LEFT, ),
                                 ("OR", 2, opAssoc.LEFT, ),
@@ -67,20 +101,23 @@ def parse(input_string):
     # Group(tenant_list ^ tenant_group_list ^ container_list ^ obj_list)
     # Action part
     action = oneOf("SET DELETE")
-    sfilters_list = r.keys("dsl_filter:*")
-    sfilter = map(lambda x: "".join(x.split(":")[1]), sfilters_list)
     with_params = Suppress(Literal("WITH"))
     do = Suppress(Literal("DO"))
     params_list = delimitedList(param)
     server_execution = oneOf("PROXY OBJECT")
-    # TRANSIENT
+    # TRANSIENT [HOLD <n> UPDATES|SECONDS] [UNTIL <conditions>] [MAX <n> TOGGLES PER <t> SECONDS]
     transient = Literal("TRANSIENT")
+    hold = Group(Suppress("HOLD") + number("value") + oneOf("UPDATES SECONDS")("unit"))
+    until = Suppress("UNTIL") + condition_list("until")
+    max_toggles = Group(Suppress("MAX") + Word(nums)("count") + Suppress("TOGGLES") + Suppress("PER") +
+                        number("period") + Suppress("SECONDS"))
     # CALLABLE
     is_callable = Literal("CALLABLE")
     action = Group(action("action") + oneOf(sfilter)("filter") +
                    Optional(with_params + params_list("params")) +
                    Optional(Suppress("ON")+server_execution("server_execution")) +
-                   Optional(transient("transient")) +
+                   Optional(transient("transient") + Optional(hold("hold")) + Optional(until) +
+                            Optional(max_toggles("max_toggles"))) +
                    Optional(is_callable("callable")))
 
     action_list = Group(delimitedList(action))
@@ -104,9 +141,20 @@ def parse(input_string):
     rule_parse = literal_for + target("target") + \
                  Optional(when + condition_list("condition_list")) + do + \
                  action_list("action_list") + Optional(to + object_list("object_list"))
+    return rule_parse
+
+
+def parse(input_string, grammar=None):
+    """
+    Parses a rule. Callers parsing many rules at once can fetch the grammar
+    once with get_grammar() and pass it.
+    """
+    # TODO Raise an exception if not metrics or not action registered
+    # TODO Raise an exception if group of tenants does not exist.
+    r = get_redis_connection()
 
     # Parse the rule
-    parsed_rule = rule_parse.parseString(input_string)
+    parsed_rule = (grammar or get_grammar(r)).parseString(input_string, parseAll=True)
 
     # Pos-parsed validation
     has_condition_list = True
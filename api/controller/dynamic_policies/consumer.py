@@ -6,7 +6,7 @@ logger = logging.getLogger(__name__)
 
 
 class Consumer(object):
-    _sync = {}
+    _sync = {'is_consuming': '1'}
     _async = ['start_consuming', 'stop_consuming']
     _ref = []
     _parallel = []
@@ -46,6 +46,14 @@ class Consumer(object):
         self.thread = Thread(target=self._channel.start_consuming)
         self.thread.start()
 
+    def is_consuming(self):
+        """
+        Synchronous method. The consuming thread ends when the connection
+        with RabbitMQ is lost.
+        """
+        thread = getattr(self, 'thread', None)
+        return thread is not None and thread.is_alive()
+
     def stop_consuming(self):
         logger.info('Metric, Stopping to consume from rabbitmq')
         self._atom.stop()
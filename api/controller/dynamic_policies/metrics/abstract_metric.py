@@ -1,11 +1,16 @@
 import sys
 import logging
+import time
 import redis
 
 #from api.settings import RABBITMQ_USERNAME, RABBITMQ_PASSWORD, RABBITMQ_HOST, RABBITMQ_PORT, REDIS_CON_POOL, LOGSTASH_HOST, LOGSTASH_PORT
 from django.conf import settings
 from redis.exceptions import RedisError
 
+from api.events import publish_event
+from controller import rule_table
+from controller.dynamic_policies.rules import rule_engine
+
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +26,10 @@ class Metric(object):
 
     def __init__(self):
         self._observers = {}
+        # Actor that evaluates the dynamic policy rules that use this metric
+        self.rule_engine = None
+        # Time of the first update sent to the rule engine after its last heartbeat
+        self.rule_engine_pending = None
         self.value = None
         self.name = None
         # settings = ConfigParser.ConfigParser()
@@ -92,6 +101,7 @@ class Metric(object):
         """
         try:
             self.redis.hmset("metric:" + self.name, {"network_location": self._atom.aref.replace("atom:", "tcp:", 1), "type": "integer"})
+            publish_event(self.redis, 'metric', self.name)
 
             self.consumer = self.host.spawn_id(self.id + "_consumer",
                                                "controller.dynamic_policies.consumer",
@@ -104,24 +114,62 @@ class Metric(object):
                                                 self.queue,
                                                 self.routing_key,
                                                 self.proxy])
+            self.rule_engine = self.host.spawn_id(self.id + "_rules", settings.RULE_ENGINE_MODULE, settings.RULE_ENGINE_CLASS,
+                                                  [self.name])
             self.start_consuming()
         except:
             e = sys.exc_info()[0]
             print e
 
-    def stop_actor(self):
+    def ping(self):
+        """
+        Synchronous method. Health check of the actor supervisor: the metric
+        is alive while its consumer is consuming from RabbitMQ and its rule
+        engine processes its values. The engine is not pinged, as a busy engine
+        would not answer in time: it is dead when it has not processed any
+        update for RULE_ENGINE_TIMEOUT seconds since it was sent one.
+        """
+        return bool(self.consumer.is_consuming() and self.rule_engine and not self._rule_engine_stalled())
+
+    def update_rule_engine(self, values):
+        """
+        Sends the values of each tenant to the rule engine.
+        """
+        if not self._rule_engine_pending():
+            self.rule_engine_pending = time.time()
+        self.rule_engine.update(values)
+
+    def _rule_engine_pending(self):
+        """
+        If an update sent to the rule engine has not been processed yet.
+        """
+        return (self.rule_engine_pending is not None and
+                rule_engine.heartbeats.get(self.name, 0) < self.rule_engine_pending)
+
+    def _rule_engine_stalled(self):
+        return self._rule_engine_pending() and time.time() - self.rule_engine_pending > settings.RULE_ENGINE_TIMEOUT
+
+    def stop_actor(self, restart=False):
         """
         Asynchronous method. This method allows to be called remotelly.
         This method ends the workload execution and kills the actor.
+
+        :param restart: If the actor is stopped to be started again. The rules
+                        and observers are kept, so the new actor evaluates them.
         """
         try:
-            # Stop observers
-            for tenant in self._observers:
-                for observer in self._observers[tenant]:
-                    observer.stop_actor()
-                    self.redis.hset(observer.get_id(), 'alive', 'False')
+            if not restart:
+                # Stop observers
+                for tenant in self._observers:
+                    for observer in self._observers[tenant]:
+                        observer.stop_actor()
+                        self.redis.hset(observer.get_id(), 'alive', 'False')
+                rule_table.disable_metric_rules(self.redis, self.name)
+            if self.rule_engine:
+                self.rule_engine.stop_actor()
 
             self.redis.delete("metric:" + self.name)
+            publish_event(self.redis, 'metric', self.name)
             self.stop_consuming()
             self._atom.stop()
 
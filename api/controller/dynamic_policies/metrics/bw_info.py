@@ -7,7 +7,7 @@ AGGREGATION_INTERVAL = 0.2
 
 
 class BwInfo(Metric):
-    _sync = {}
+    _sync = {'ping': '3'}
     _async = ['get_value', 'attach', 'detach', 'notify', 'start_consuming', 'stop_consuming', 'init_consum',
               'stop_actor', 'get_redis_bw', 'compute_assignations', 'parse_osinfo', 'send_bw', 'detach_global_obs']
     _ref = ['attach', 'detach']
@@ -3,11 +3,14 @@ from threading import Thread
 import datetime
 import json
 import socket
+import time
 from copy import deepcopy
 
+from controller import timeseries
+
 
 class SwiftMetric(Metric):
-    _sync = {}
+    _sync = {'ping': '3'}
     _async = ['get_value', 'attach', 'detach', 'notify', 'start_consuming', 'stop_consuming', 'init_consum', 'stop_actor']
     _ref = ['attach', 'detach']
     _parallel = []
@@ -41,14 +44,25 @@ class SwiftMetric(Metric):
         # TODO REFACTORING A method must be called here to aggregate results from all nodes that have sent
         # a data dict, otherwise it will only work with 1 node.
         try:
+            values = dict()
             for host in data:
                 del data[host]['@timestamp']
                 for target in data[host]:
-                    value = data[host][target]
                     tenant = target.split("#:#")[1].replace('AUTH_', '')
-                    if tenant in self._observers:
-                        for observer in self._observers[tenant]:
-                            observer.update(self.name, value)
+                    values.setdefault(tenant, []).append(data[host][target])
+
+            now = time.time()
+            for tenant, tenant_values in values.items():
+                for value in tenant_values:
+                    timeseries.store.add(self.name, tenant, value, now)
+
+            # The rules of all the tenants are evaluated by the rule engine, with a single message
+            if self.rule_engine:
+                self.update_rule_engine(values)
+            for tenant, tenant_values in values.items():
+                for observer in self._observers.get(tenant, ()):
+                    for value in tenant_values:
+                        observer.update(self.name, value)
 
         except Exception as e:
             print "Fail sending monitoring data to observer: ", e
@@ -21,7 +21,7 @@ class AbstractEnforcementAlgorithm(object):
     
     Global controller algorithms (e.g.: Bandwidth controllers) must extend this class and implement the compute_algorithm method.
     """
-    _sync = {'get_tenant': '2'}
+    _sync = {'get_tenant': '2', 'ping': '2'}
     _async = ['update', 'run', 'stop_actor']
     _ref = []
     _parallel = []
@@ -139,6 +139,12 @@ class AbstractEnforcementAlgorithm(object):
         """
         return self.tenant
 
+    def ping(self):
+        """
+        Synchronous method. Health check of the actor supervisor.
+        """
+        return True
+
     def stop_actor(self):
         """
         Asynchronous method. This method can be called remotely.
@@ -0,0 +1,77 @@
+"""
+Compilation of the conditions of the dynamic policy rules.
+
+The condition list of a parsed rule (rule_parsed.condition_list.asList()) is a
+tree of pyparsing lists:
+
+    ['metric1', '>', '5']
+    [['metric1', '>', '5'], 'AND', ['metric2', '<', '3'], 'OR', ...]
+    [['avg', 'metric1', '30s'], '>', '5']
+
+It is compiled once, when the rule is created, into a function that receives
+the last value of each metric, so that checking a rule does not walk the tree,
+look up the operators or parse the thresholds again.
+
+The value of a window function (see windows.py) is looked up with the key
+(function, metric, seconds) instead of the name of the metric.
+"""
+import operator
+
+from windows import window_seconds
+
+comparisons = {'>': operator.gt, '>=': operator.ge,
+               '==': operator.eq, '<=': operator.le, '<': operator.lt,
+               '!=': operator.ne}
+
+
+def compile_conditions(condition_list, windows=None):
+    """
+    Compiles a condition list.
+
+    :param condition_list: The conditions of a rule.
+    :type condition_list: **any** List type
+    :param windows: If given, the (function, metric, seconds) keys of the window
+                    functions used by the conditions are added to it.
+    :type windows: **any** Set type
+
+    :return: The function that evaluates the conditions with a dict of metric
+             values (AND and OR are short-circuited), and the names of the
+             metrics that it uses.
+    :rtype: (function, set) tuple.
+    """
+    metrics = set()
+    if windows is None:
+        windows = set()
+    return _compile(condition_list, metrics, windows), metrics
+
+
+def _compile(condition_list, metrics, windows):
+    if len(condition_list) == 3 and condition_list[1] in comparisons:
+        if isinstance(condition_list[0], list):
+            function, metric, duration = condition_list[0]
+            metric = metric.lower()
+            key = (function, metric, window_seconds(duration))
+            windows.add(key)
+        else:
+            metric = key = condition_list[0].lower()
+        compare = comparisons[condition_list[1]]
+        threshold = float(condition_list[2])
+        metrics.add(metric)
+        return lambda values: compare(float(values[key]), threshold)
+
+    first = _compile(condition_list[0], metrics, windows)
+    rest = [(condition_list[i] == 'AND', _compile(condition_list[i + 1], metrics, windows))
+            for i in range(1, len(condition_list) - 1, 2)]
+    if not rest:
+        return first
+
+    def evaluate(values):
+        # Left to right, like the operators in the rule
+        result = first(values)
+        for is_and, condition in rest:
+            if is_and:
+                result = result and condition(values)
+            else:
+                result = result or condition(values)
+        return result
+    return evaluate
@@ -1,68 +1,91 @@
 import json
-import operator
 import logging
-import redis
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 
-from api.settings import MANAGEMENT_ACCOUNT, MANAGEMENT_ADMIN_USERNAME, MANAGEMENT_ADMIN_PASSWORD, KEYSTONE_ADMIN_URL, REDIS_HOST, REDIS_PORT, REDIS_DATABASE
+from controller import rule_table
+from conditions import compile_conditions
+from api.events import EventCache
+from api.exceptions import CrystalControllerException
+from api.settings import MANAGEMENT_ACCOUNT, MANAGEMENT_ADMIN_USERNAME, MANAGEMENT_ADMIN_PASSWORD, KEYSTONE_ADMIN_URL, \
+    LOCAL_ACTIVATION_URLS, ACTIVATION_POOL_SIZE, ACTIVATION_TIMEOUT
+from filters.views import deploy_filter, undeploy_filter, delete_static_policy
 
-mappings = {'>': operator.gt, '>=': operator.ge,
-            '==': operator.eq, '<=': operator.le, '<': operator.lt,
-            '!=': operator.ne, "OR": operator.or_, "AND": operator.and_}
 logger = logging.getLogger(__name__)
 
+# Keep-alive connections to the remote activation URLs (and keystone), shared by all the rules of the process
+activation_session = requests.Session()
+activation_session.mount('http://', HTTPAdapter(pool_maxsize=ACTIVATION_POOL_SIZE))
+activation_session.mount('https://', HTTPAdapter(pool_maxsize=ACTIVATION_POOL_SIZE))
+
+# DSL filters used by the actions, cached for all the rules of the process
+_dsl_filters = None
+_dsl_filters_lock = threading.Lock()
+
+
+def get_dsl_filter(r, name):
+    """
+    Returns a DSL filter (dsl_filter:<name>) from the cache of the process. The cache
+    is kept up to date by the change events, listened to in a background thread
+    (which subscribes again, and clears the cache, when the connection is lost).
+    """
+    global _dsl_filters
+    with _dsl_filters_lock:
+        if _dsl_filters is None:
+            _dsl_filters = EventCache(r, {'dsl_filter': lambda r, name: r.hgetall('dsl_filter:' + name)})
+            listener = threading.Thread(target=_dsl_filters.listen, name='dsl_filter_events')
+            listener.daemon = True
+            listener.start()
+    return _dsl_filters.get('dsl_filter', name)
+
 
 class Rule(object):
     """
-    Rule: Each policy of each tenant is compiled as Rule. Rule is an Actor and
-    it will be subscribed in the workloads metrics. When the data received from
-    the workloads metrics satisfies the conditions defined in the policy,the
-    Rule actor executes an Action that it is also defined in the policy. Once
-    the rule executed the action, this actor is destroyed.
+    Rule: Each policy of each tenant is compiled as Rule. The rules are
+    evaluated by the rule engine of their workload metric (see rule_engine.py)
+    with the values received from the workload metrics. When they satisfy the
+    conditions defined in the policy, the Rule executes an Action that it is
+    also defined in the policy. Once the rule executed the action, it is
+    finished.
     """
-    _sync = {'get_target': '2'}
-    _async = ['update', 'start_rule', 'stop_actor']
-    _ref = []
-    _parallel = []
 
-    def __init__(self, rule_parsed, action, target, host):
+    def __init__(self, policy_id, rule_parsed, action, target, r):
         """
         Initialize all the variables needed for the rule.
 
+        :param policy_id: The key of the policy (policy:<id>).
+        :type policy_id: **any** String type
         :param rule_parsed: The rule parsed by the dsl_parser.
         :type rule_parsed: **any** PyParsing type
         :param action: The action assigned to this rule.
         :type action: **any** PyParsing type
         :param target: The target assigned to this rule.
         :type target: **any** String type
-        :param host: The proxy host provided by the PyActive Middleware.
-        :type host: **any** PyActive Proxy type
+        :param r: The redis connection of the rule engine.
+        :type r: **any** Redis type
         """
-
-        # settings = ConfigParser.ConfigParser()
-        # settings.read("controller/dynamic_policies/settings.conf")
-
         self.openstack_tenant = MANAGEMENT_ACCOUNT
         self.openstack_user = MANAGEMENT_ADMIN_USERNAME
         self.openstack_pass = MANAGEMENT_ADMIN_PASSWORD
         self.openstack_keystone_url = KEYSTONE_ADMIN_URL
 
-        self.redis_host = REDIS_HOST
-        self.redis_port = REDIS_PORT
-        self.redis_db = REDIS_DATABASE
-
-        self.redis = redis.StrictRedis(host=self.redis_host,
-                                       port=self.redis_port,
-                                       db=self.redis_db)
+        self.redis = r
 
-        self.host = host
+        self.id = policy_id
         self.rule_parsed = rule_parsed
         self.target = target
         self.conditions = rule_parsed.condition_list.asList()
-        self.observers_values = dict()
-        self.observers_proxies = dict()
+        # (function, metric, seconds) of the window functions of the conditions
+        self.windows = set()
+        self.check_conditions, self.metrics = compile_conditions(self.conditions, self.windows)
+        # Rules of the same tenant with the same conditions are evaluated once
+        self.condition_key = repr(self.conditions)
         self.action_list = action
         self.token = None
+        self.finished = False
+        # The rule engines of all its metrics evaluate the rule
+        self.lock = threading.Lock()
 
     def _admin_login(self):
         """
@@ -73,179 +96,149 @@ class Rule(object):
                                                                                                  "password": self.openstack_pass}}})
         headers = {"Content-type": "application/json"}
 
-        r = requests.post(self.openstack_keystone_url, data=body, headers=headers)
+        r = activation_session.post(self.openstack_keystone_url, data=body, headers=headers, timeout=ACTIVATION_TIMEOUT)
         if r.status_code == 200:
             self.token = r.json()["access"]["token"]["id"]
         else:
             raise Exception("Problems with the admin user credentials located in the config file")
 
-    def stop_actor(self):
-        """
-        Method called to end the rule. This method unsubscribes the rule from
-        all the workload metrics subscribed, and kills the actor of the rule.
+    def execute(self, condition_result, values=None):
         """
-        for observer in self.observers_proxies.values():
-            observer.detach(self.proxy, self.get_target())
-        self._atom.stop()
-        logger.info("Rule, Actor '" + str(self.id) + "' stopped")
+        Called by the rule engine with the result of the conditions
+        (self.check_conditions(values), compiled from the rule), every time
+        that the value of one of the metrics of the rule is updated.
 
-    def start_rule(self):
+        :param values: The last value of each metric of the rule.
+
+        :return: If the rule is finished (the engine discards it).
+        :rtype: boolean type.
         """
-        Method called afeter init to start the rule. Basically this method
-        allows to be called remotely and calls the internal method
-        **check_metrics()** which subscribes the rule to all the workload
-        metrics necessaries.
+        if condition_result:
+            self._do_action()
+        return self.finished
+
+    def get_target(self):
         """
-        logger.info("Rule, Start '" + str(self.id) + "'")
-        self.check_metrics(self.conditions)
+        Return the target assigned to this rule.
 
-    def _add_metric(self, workload_name):
+        :return: Return the target id assigned to this rule
+        :rtype: String type.
         """
-        The `add_metric()` method subscribes the rule to all workload metrics
-        that it needs to check the conditions defined in the policy
+        return self.target
 
-        :param workload_name: The name that identifies the workload metric.
-        :type workload_name: **any** String type
+    def _get_token(self):
+        if not self.token:
+            self._admin_login()
+        return self.token
 
+    def _is_local(self, dynamic_filter):
         """
-        if workload_name not in self.observers_values.keys():
-            # Trying the new PyActive version. New lookup function.
-            logger.info("Rule, Workload name: " + workload_name)
-            observer = self.host.lookup(workload_name)
-            logger.info('Rule, Observer: ' + str(observer.get_id()) + " " + observer)
-            observer.attach(self.proxy)
-            self.observers_proxies[workload_name] = observer
-            self.observers_values[workload_name] = None
-
-    def check_metrics(self, condition_list):
+        If the activation URL of the DSL filter is this controller (LOCAL_ACTIVATION_URLS):
+        the action is then executed in-process, without an HTTP request to ourselves.
         """
-        The check_metrics method finds in the condition list all the metrics
-        that it needs to check the conditions, when find some metric that it
-        needs, call the method add_metric.
+        return dynamic_filter["activation_url"].rstrip('/') in LOCAL_ACTIVATION_URLS
 
-        :param condition_list: The list of all the conditions.
-        :type condition_list: **any** List type
+    def _local_token(self, filter_id):
+        """
+        The admin token for the in-process actions: it is only needed for storlets.
         """
-        logger.info('Rule, Condition: ' + str(condition_list))
-        if not isinstance(condition_list[0], list):
-            self._add_metric(condition_list[0].lower())
+        if self.redis.hget("filter:" + str(filter_id), "filter_type") == 'storlet':
+            return self._get_token()
+        return None
+
+    def _policy_params(self):
+        data = dict()
+
+        if hasattr(self.rule_parsed.object_list, "object_type"):
+            data['object_type'] = self.rule_parsed.object_list.object_type.object_value
         else:
-            for element in condition_list:
-                if element is not "OR" and element is not "AND":
-                    self.check_metrics(element)
+            data['object_type'] = ''
 
-    def update(self, metric, value):
-        """
-        The method update is called by the workloads metrics following the
-        observer pattern. This method is called to send to this actor the
-        data updated.
+        if hasattr(self.rule_parsed.object_list, "object_size"):
+            data['object_size'] = self.rule_parsed.object_list.object_size.object_value
+        else:
+            data['object_size'] = ''
 
-        :param metric: The name that identifies the workload metric.
-        :type metric: **any** String type
+        data['params'] = self.action_list.params
+        return data
 
-        :param tenant_info: Contains the timestamp and the value sent from
-                            workload metric.
-        :type tenant_info: **any** PyParsing type
+    def _deploy(self, dynamic_filter):
         """
-        logger.info("--> Success update: " + str(value))
+        Deploys the filter of the action to the target.
 
-        self.observers_values[metric] = value
+        :return: The id of the static policy, None if it could not be deployed.
+        """
+        if self._is_local(dynamic_filter):
+            filter_id = dynamic_filter["identifier"]
+            try:
+                return str(deploy_filter(self.redis, filter_id, self.target, self._policy_params(), self._local_token(filter_id)))
+            except CrystalControllerException as e:
+                logger.error('Error setting policy: ' + str(e))
+                return None
 
-        # TODO Check the last time updated the value
-        # Check the condition of the policy if all values are setted. If the
-        # condition result is true, it calls the method do_action
-        if all(val is not None for val in self.observers_values.values()):
-            if self._check_conditions(self.conditions):
-                self._do_action()
-        else:
-            logger.error("not all values setted" + str(self.observers_values.values()))
+        url = dynamic_filter["activation_url"] + "/" + self.target + "/deploy/" + str(dynamic_filter["identifier"])
+        response = activation_session.put(url, json.dumps(self._policy_params()), headers={"X-Auth-Token": self._get_token()},
+                                          timeout=ACTIVATION_TIMEOUT)
+        if 200 <= response.status_code < 300:
+            return response.content
+        logger.error('Error setting policy: ' + str(response.status_code))
+        return None
 
-    def _check_conditions(self, condition_list):
+    def _undeploy(self, dynamic_filter):
         """
-        The method **check_conditions()** runs the ternary tree of conditions
-        to check if the **self.observers_values** complies the conditions. If
-        the values comply the conditions return True, else return False.
+        Undeploys the filter of the action from the target.
 
-        :param condition_list: A list of all the conditions
-        :type condition_list: **any** List type
-
-        :return: If the values comply the conditions
-        :rtype: boolean type.
+        :return: If it was undeployed.
         """
-        if not isinstance(condition_list[0], list):
-            result = mappings[condition_list[1]](float(self.observers_values[condition_list[0].lower()]), float(condition_list[2]))
-        else:
-            result = self.check_conditions(condition_list[0])
-            for i in range(1, len(condition_list) - 1, 2):
-                result = mappings[condition_list[i]](result, self.check_conditions(condition_list[i + 1]))
-        return result
+        if self._is_local(dynamic_filter):
+            filter_id = dynamic_filter["identifier"]
+            try:
+                undeploy_filter(self.redis, filter_id, self.target, self._local_token(filter_id))
+                return True
+            except CrystalControllerException as e:
+                logger.error('Error undeploying filter: ' + str(e))
+                return False
 
-    def get_target(self):
+        url = dynamic_filter["activation_url"] + "/" + self.target + "/undeploy/" + str(dynamic_filter["identifier"])
+        response = activation_session.put(url, headers={"X-Auth-Token": self._get_token()}, timeout=ACTIVATION_TIMEOUT)
+        if 200 <= response.status_code < 300:
+            return True
+        logger.error('Error undeploying filter: ' + str(response.status_code))
+        return False
+
+    def _delete_static_policy(self, dynamic_filter, static_policy_id):
         """
-        Return the target assigned to this rule.
+        Deletes a static policy of the target, created by _deploy.
 
-        :return: Return the target id assigned to this rule
-        :rtype: String type.
+        :return: If it was deleted.
         """
-        return self.target
+        if self._is_local(dynamic_filter):
+            return delete_static_policy(self.redis, self.target.replace('/', ':'), str(static_policy_id))
+
+        url = dynamic_filter["activation_url"].rsplit("/", 1)[0] + "/controller/static_policy/" + self.target + ":" + str(static_policy_id)
+        response = activation_session.delete(url, headers={"X-Auth-Token": self._get_token()}, timeout=ACTIVATION_TIMEOUT)
+        return 200 <= response.status_code < 300
 
     def _do_action(self):
         """
         The do_action method is called after the conditions are satisfied. So
         this method is responsible to execute the action defined in the policy.
         """
-        if not self.token:
-            self._admin_login()
-
-        headers = {"X-Auth-Token": self.token}
-        dynamic_filter = self.redis.hgetall("dsl_filter:" + str(self.action_list.filter))
+        dynamic_filter = get_dsl_filter(self.redis, str(self.action_list.filter))
 
         if self.action_list.action == "SET":
             # TODO Review if this tenant has already deployed this filter. Not deploy the same filter more than one time.
-
-            url = dynamic_filter["activation_url"] + "/" + self.target + "/deploy/" + str(dynamic_filter["identifier"])
-
-            data = dict()
-
-            if hasattr(self.rule_parsed.object_list, "object_type"):
-                data['object_type'] = self.rule_parsed.object_list.object_type.object_value
-            else:
-                data['object_type'] = ''
-
-            if hasattr(self.rule_parsed.object_list, "object_size"):
-                data['object_size'] = self.rule_parsed.object_list.object_size.object_value
-            else:
-                data['object_size'] = ''
-
-            data['params'] = self.action_list.params
-
-            response = requests.put(url, json.dumps(data), headers=headers)
-
-            if 200 <= response.status_code < 300:
+            if self._deploy(dynamic_filter):
                 logger.info('Policy ' + str(self.id) + ' applied')
-                self.redis.hset(self.id, 'alive', False)
-                try:
-                    self.stop_actor()
-                except:
-                    pass
-                return
-            else:
-                logger.error('Error setting policy')
+                self._finish()
 
         elif self.action_list.action == "DELETE":
             logger.info("--> DELETE <--")
+            if self._undeploy(dynamic_filter):
+                logger.info('Policy ' + str(self.id) + ' applied')
+                self._finish()
 
-            url = dynamic_filter["activation_url"] + "/" + self.target + "/undeploy/" + str(dynamic_filter["identifier"])
-            response = requests.put(url, headers=headers)
-
-            if 200 <= response.status_code < 300:
-                logger.info(response.text + " " + str(response.status_code))
-                try:
-                    self.stop_actor()
-                except:
-                    pass
-                return response.text
-            else:
-                logger.error('ERROR RESPONSE')
-
-        return 'Not action supported'
+    def _finish(self):
+        rule_table.unregister_rule(self.redis, self.id)
+        self.redis.hset(self.id, 'alive', False)
+        self.finished = True
@@ -0,0 +1,234 @@
+import importlib
+import logging
+import threading
+import time
+
+import redis
+from django.conf import settings
+
+from controller import dsl_parser, rule_table
+from windows import Window
+
+logger = logging.getLogger(__name__)
+
+# Last value of each (metric, tenant). It is shared by the engines of all the
+# metrics, because the conditions of a rule can use several metrics.
+last_values = dict()
+# Windows of each (metric, tenant), by (function, seconds), used by the window
+# functions of the conditions (see windows.py). Shared for the same reason.
+windows = dict()
+# Rules loaded by the engines: policy key -> (rule, metrics of the engines that use it).
+# A rule with several metrics is shared by their engines, so it keeps a single state.
+shared_rules = dict()
+shared_rules_lock = threading.Lock()
+# Time each engine (by metric) last finished processing the values of its metric.
+# The metric checks it in its health check, instead of a ping through the mailbox
+# of the engine, which would time out while the engine is busy with a backlog.
+heartbeats = dict()
+
+
+class RuleEngine(object):
+    """
+    RuleEngine: Each workload metric has a RuleEngine actor that evaluates all
+    the dynamic policy rules that use it. The metric sends it the values of
+    each tenant in a single message, and the engine checks the conditions of
+    the rules of those tenants in one pass, instead of having an actor per rule
+    subscribed to the metric.
+
+    The rules of a tenant are loaded from the rule table (controller/rule_table.py)
+    with its first value, and discarded when it sends no values for
+    RULE_IDLE_TIMEOUT seconds. A rule with several metrics is loaded by the
+    engines of all of them and evaluated with the updates of any of them,
+    with the last values of the others.
+    """
+    _sync = {}
+    _async = ['update', 'stop_actor']
+    _ref = []
+    _parallel = []
+
+    def __init__(self, metric):
+        """
+        :param metric: The name of the workload metric.
+        :type metric: **any** String type
+        """
+        self.metric = metric
+        self.redis = redis.Redis(connection_pool=settings.REDIS_CON_POOL)
+        # tenant -> {policy key: rule}, None for the policies that are not evaluated here
+        self.rules = dict()
+        # tenant -> {condition: [rules]}, to check each condition once per value
+        self.conditions = dict()
+        self.last_update = dict()
+        self.last_passivation = time.time()
+
+    def update(self, values):
+        """
+        Asynchronous method. This method allows to be called remotelly. It is
+        called from the metric actor with the values received from RabbitMQ.
+
+        :param values: The values of each tenant ({tenant: [value, ...]}).
+        :type values: **any** Dict type
+        """
+        now = time.time()
+        tenants = list(values)
+        pipe = self.redis.pipeline(transaction=False)
+        for tenant in tenants:
+            pipe.smembers(rule_table.rule_table_key(self.metric, tenant))
+        for tenant, policy_keys in zip(tenants, pipe.execute()):
+            self._sync_rules(tenant, policy_keys)
+            self.last_update[tenant] = now
+            for value in values[tenant]:
+                last_values[(self.metric, tenant)] = value
+                for window in windows.get((self.metric, tenant), {}).values():
+                    window.add(now, value)
+                self._evaluate(tenant, now)
+        self._passivate_idle_tenants(now)
+        heartbeats[self.metric] = time.time()
+
+    def stop_actor(self):
+        """
+        Asynchronous method. This method allows to be called remotelly.
+        Discards all the rules and kills the actor.
+        """
+        heartbeats.pop(self.metric, None)
+        for tenant in self.last_update:
+            last_values.pop((self.metric, tenant), None)
+            windows.pop((self.metric, tenant), None)
+        for rules in self.rules.values():
+            for policy_key in rules:
+                self._release_rule(policy_key)
+        self._atom.stop()
+        logger.info("RuleEngine, Actor '" + self.metric + "' stopped")
+
+    def _sync_rules(self, tenant, policy_keys):
+        """
+        Loads the rules registered for the tenant since the last value, and discards
+        the ones unregistered (deleted policies, finished rules).
+        """
+        rules = self.rules.get(tenant, {})
+        if set(rules) == policy_keys:
+            return
+        for policy_key in set(rules).difference(policy_keys):
+            self._release_rule(policy_key)
+        rules = dict((policy_key, rule) for policy_key, rule in rules.items() if policy_key in policy_keys)
+        for policy_key in policy_keys.difference(rules):
+            try:
+                rules[policy_key] = self._load_rule(policy_key)
+            except Exception as e:
+                logger.error("RuleEngine, Could not load rule '" + policy_key + "': " + str(e))
+                rules[policy_key] = None
+        self.rules[tenant] = rules
+        self._index_rules(tenant)
+
+    def _load_rule(self, policy_key):
+        """
+        Returns the rule of a policy, loaded by the engine of another of its metrics or from its policy.
+        """
+        with shared_rules_lock:
+            if policy_key in shared_rules:
+                rule, metrics = shared_rules[policy_key]
+                metrics.add(self.metric)
+                return rule
+        rule = self._create_rule(policy_key)
+        if rule is None:
+            return None
+        with shared_rules_lock:
+            # Another engine may have loaded it meanwhile
+            rule, metrics = shared_rules.setdefault(policy_key, (rule, set()))
+            metrics.add(self.metric)
+        return rule
+
+    def _release_rule(self, policy_key):
+        """
+        Discards the rule of a policy when no engine uses it.
+        """
+        with shared_rules_lock:
+            if policy_key in shared_rules:
+                _, metrics = shared_rules[policy_key]
+                metrics.discard(self.metric)
+                if not metrics:
+                    del shared_rules[policy_key]
+
+    def _create_rule(self, policy_key):
+        policy = self.redis.hgetall(policy_key)
+        if not policy or policy.get('alive') != 'True':
+            return None
+
+        _, rule_parsed = dsl_parser.parse(policy['policy_description'])
+        action_info = rule_parsed.action_list[int(policy.get('action_index', 0))]
+        if action_info.transient:
+            rule_class = getattr(importlib.import_module(settings.RULE_TRANSIENT_MODULE), settings.RULE_TRANSIENT_CLASS)
+        else:
+            rule_class = getattr(importlib.import_module(settings.RULE_MODULE), settings.RULE_CLASS)
+        logger.info("RuleEngine, Loading rule '" + policy_key + "': " + policy['policy_description'])
+        return rule_class(policy_key, rule_parsed, action_info, policy['target'], self.redis)
+
+    def _index_rules(self, tenant):
+        conditions = dict()
+        for rule in self.rules[tenant].values():
+            if rule:
+                conditions.setdefault(rule.condition_key, []).append(rule)
+        self.conditions[tenant] = conditions
+
+    def _evaluate(self, tenant, now):
+        finished = False
+        for rules in self.conditions.get(tenant, {}).values():
+            values = dict((metric, last_values.get((metric, tenant))) for metric in rules[0].metrics)
+            for window_key in rules[0].windows:
+                values[window_key] = self._window(window_key, tenant).value(now)
+            if any(value is None for value in values.values()):
+                continue
+            try:
+                condition_result = rules[0].check_conditions(values)
+            except Exception as e:
+                logger.error("RuleEngine, Could not check the conditions of '" + rules[0].id + "': " + str(e))
+                continue
+            for rule in rules:
+                try:
+                    # The engines of the other metrics of the rule may evaluate it at the same time
+                    with rule.lock:
+                        if not rule.finished:
+                            rule.execute(condition_result, values)
+                    if rule.finished:
+                        del self.rules[tenant][rule.id]
+                        self._release_rule(rule.id)
+                        finished = True
+                except Exception as e:
+                    logger.error("RuleEngine, Rule '" + rule.id + "' failed: " + str(e))
+        if finished:
+            self._index_rules(tenant)
+
+    def _window(self, window_key, tenant):
+        """
+        Returns the window of a window function, created with the last value of its metric
+        the first time. It is then updated by the engine of the metric with its values.
+        """
+        function, metric, seconds = window_key
+        metric_windows = windows.setdefault((metric, tenant), {})
+        window = metric_windows.get((function, seconds))
+        if window is None:
+            new_window = Window(function, seconds, settings.WINDOW_MAX_SAMPLES)
+            # The engine of another metric may have created it meanwhile
+            window = metric_windows.setdefault((function, seconds), new_window)
+            if window is new_window and (metric, tenant) in last_values:
+                window.add(time.time(), last_values[(metric, tenant)])
+        return window
+
+    def _passivate_idle_tenants(self, now):
+        """
+        Discards the rules of the tenants without values in the last RULE_IDLE_TIMEOUT
+        seconds. They are loaded again with the next value.
+        """
+        if now - self.last_passivation < settings.RULE_PASSIVATION_INTERVAL:
+            return
+        self.last_passivation = now
+        idle_tenants = [tenant for tenant, last_update in self.last_update.items()
+                        if now - last_update > settings.RULE_IDLE_TIMEOUT]
+        for tenant in idle_tenants:
+            del self.last_update[tenant]
+            for policy_key in self.rules.pop(tenant, {}):
+                self._release_rule(policy_key)
+            self.conditions.pop(tenant, None)
+            last_values.pop((self.metric, tenant), None)
+            windows.pop((self.metric, tenant), None)
+        if idle_tenants:
+            logger.info("RuleEngine, Discarded the rules of " + str(len(idle_tenants)) + " idle tenants")
@@ -1,62 +1,113 @@
-from rule import Rule
-import requests
+from rule import Rule, get_dsl_filter
+from conditions import compile_conditions
 import logging
-import json
+import time
 
 logger = logging.getLogger(__name__)
 
 
 class TransientRule(Rule):
     """
-    TransientRule: Each policy of each tenant is compiled as Rule. Rule is an
-    Actor and it will be subscribed in the workloads metrics. When the data
-    received from the workloads metrics satisfies the conditions defined in the
-    policy,the Rule actor executes an Action that it is also defined in the
-    policy. Once executed the action, if change the condition evaluation  the
-    rule will execute the reverse action (if action is SET, the will execute
-    DELETE)
+    TransientRule: Each policy of each tenant is compiled as Rule. The rules
+    are evaluated by the rule engine of their workload metric. When the values
+    of the workload metrics satisfy the conditions defined in the policy, the
+    Rule executes an Action that it is also defined in the policy. Once
+    executed the action, if change the condition evaluation  the rule will
+    execute the reverse action (if action is SET, the will execute DELETE)
     """
-    _sync = {'get_target': '2'}
-    _async = ['update', 'start_rule', 'stop_actor']
-    _ref = []
-    _parallel = []
 
-    def __init__(self, rule_parsed, action, target, host):
+    def __init__(self, policy_id, rule_parsed, action, target, r):
         """
-        Initialize all the variables needed for the rule.
+        Initialize all the variables needed for the rule. The state of the rule
+        is kept in the policy, because the rule engine discards the rules of the
+        idle tenants and loads them again later.
 
+        :param policy_id: The key of the policy (policy:<id>).
+        :type policy_id: **any** String type
         :param rule_parsed: The rule parsed by the dsl_parser.
         :type rule_parsed: **any** PyParsing type
         :param target: The target assigned to this rule.
         :type target: **any** String type
         """
-        super(TransientRule, self).__init__(rule_parsed, action, target, host)
+        super(TransientRule, self).__init__(policy_id, rule_parsed, action, target, r)
         logger.info("Transient Rule")
-        self.execution_stat = False
-        self.static_policy_id = None
 
-    def update(self, metric, tenant_info):
+        # HOLD: the new result must be kept for a number of updates or seconds before toggling
+        self.hold_value = float(action.hold.value) if action.hold else 0
+        self.hold_unit = action.hold.unit if action.hold else None
+        # UNTIL: once executed, the action is reverted when these conditions are met (instead
+        # of when the rule conditions are not), so the enter and exit thresholds can differ
+        self.check_until = None
+        if action.until:
+            self.check_until, until_metrics = compile_conditions(action.until.asList(), self.windows)
+            self.metrics = self.metrics.union(until_metrics)
+            self.condition_key = repr((self.conditions, action.until.asList()))
+        # MAX: maximum number of toggles in a period of seconds
+        self.max_toggles = int(action.max_toggles.count) if action.max_toggles else None
+        self.toggle_period = float(action.max_toggles.period) if action.max_toggles else None
+
+        self.pending_since = None
+        self.pending_updates = 0
+
+        execution_stat, static_policy_id, toggle_times = self.redis.hmget(self.id, 'execution_stat', 'static_policy_id', 'toggle_times')
+        self.execution_stat = execution_stat == 'True'
+        self.static_policy_id = static_policy_id or None
+        self.toggle_times = [float(t) for t in toggle_times.split(',')] if toggle_times else []
+
+    def execute(self, condition_result, values=None):
         """
-        The method update is called by the workloads metrics following the
-        observer pattern. This method is called to send to this actor the
-        data updated.
+        Called by the rule engine with the result of the conditions. The action
+        (or the reverse one) is executed when the result changes, once the HOLD
+        time has passed and if the MAX toggle rate allows it.
 
-        :param metric: The name that identifies the workload metric.
-        :type metric: **any** String type
-
-        :param tenant_info: Contains the timestamp and the value sent from
-                            workload metric.
-        :type tenant_info: **any** PyParsing type
+        :param values: The last value of each metric of the rule, needed by the UNTIL conditions.
+        :return: If the rule is finished: transient rules never are.
+        :rtype: boolean type.
         """
-        logger.info('Success update: ' + str(tenant_info))
-
-        self.observers_values[metric] = tenant_info
-
-        if all(val is not None for val in self.observers_values.values()):
-            condition_accomplished = self._check_conditions(self.conditions)
-            if condition_accomplished != self.execution_stat:
-                self.do_action(condition_accomplished)
-                self.execution_stat = condition_accomplished
+        if self.execution_stat and self.check_until:
+            condition_result = not self.check_until(values)
+
+        if condition_result == self.execution_stat:
+            self.pending_since = None
+            return False
+
+        now = time.time()
+        if self.pending_since is None:
+            self.pending_since = now
+            self.pending_updates = 0
+        self.pending_updates += 1
+        if not self._held(now) or not self._toggle_allowed(now):
+            return False
+
+        self.do_action(condition_result)
+        self.execution_stat = condition_result
+        self.pending_since = None
+        self.toggle_times.append(now)
+        self.redis.hmset(self.id, {'execution_stat': self.execution_stat,
+                                   'static_policy_id': self.static_policy_id or '',
+                                   'toggle_times': ','.join(repr(t) for t in self.toggle_times)})
+        return False
+
+    def _held(self, now):
+        if self.hold_unit == 'UPDATES':
+            return self.pending_updates >= self.hold_value
+        if self.hold_unit == 'SECONDS':
+            return now - self.pending_since >= self.hold_value
+        return True
+
+    def _toggle_allowed(self, now):
+        """
+        Checks the MAX toggle rate. Only the toggles of the last period are kept.
+        """
+        if self.max_toggles is None:
+            self.toggle_times = []
+            return True
+        self.toggle_times = [t for t in self.toggle_times if now - t < self.toggle_period]
+        if len(self.toggle_times) < self.max_toggles:
+            return True
+        logger.debug("Transient Rule " + str(self.id) + " reached " + str(self.max_toggles) + " toggles in " +
+                    str(self.toggle_period) + " seconds")
+        return False
 
     def do_action(self, condition_result):
         """
@@ -70,47 +121,19 @@ class TransientRule(Rule):
         else:
             action = self.action_list.action
 
-        if not self.token:
-            self._admin_login()
-
-        headers = {"X-Auth-Token": self.token}
-        dynamic_filter = self.redis.hgetall("dsl_filter:"+str(self.action_list.filter))
+        dynamic_filter = get_dsl_filter(self.redis, str(self.action_list.filter))
 
         if action == "SET":
             # TODO Review if this tenant has already deployed this filter. Don't deploy the same filter more than one time.
             logger.info("Setting static policy")
-            data = dict()
-            url = dynamic_filter["activation_url"]+"/"+self.target+"/deploy/"+str(dynamic_filter["identifier"])
-
-            if hasattr(self.rule_parsed.object_list, "object_type"):
-                data['object_type'] = self.rule_parsed.object_list.object_type.object_value
-            else:
-                data['object_type'] = ''
-
-            if hasattr(self.rule_parsed.object_list, "object_size"):
-                data['object_size'] = self.rule_parsed.object_list.object_size.object_value
-            else:
-                data['object_size'] = ''
-
-            data['params'] = self.action_list.params
-
-            response = requests.put(url, json.dumps(data), headers=headers)
-
-            if 200 <= response.status_code < 300:
-                logger.info("Static policy applied with ID: " + response.content)
-                self.static_policy_id = response.content
-            else:
-                logger.error('Error setting policy')
+            static_policy_id = self._deploy(dynamic_filter)
+            if static_policy_id:
+                logger.info("Static policy applied with ID: " + static_policy_id)
+                self.static_policy_id = static_policy_id
 
         elif action == "DELETE":
             logger.info("Deleting static policy " + str(self.static_policy_id))
-
-            url = dynamic_filter["activation_url"].rsplit("/",1)[0]+"/controller/static_policy/"+self.target+":"+str(self.static_policy_id)
-            response = requests.delete(url, headers=headers)
-
-            if 200 <= response.status_code < 300:
+            if self._delete_static_policy(dynamic_filter, self.static_policy_id):
                 logger.info("Policy " + str(self.static_policy_id) + " successfully deleted")
             else:
                 logger.error('Error Deleting policy')
-
-        return 'Not action supported'
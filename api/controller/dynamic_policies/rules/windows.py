@@ -0,0 +1,125 @@
+"""
+Window functions of the dynamic policy rules.
+
+A condition can compare a function of the values of a metric in the last
+seconds, minutes or hours instead of its last value:
+
+    avg(get_ops, 30s) > 10
+    max(put_bw, 5m) > 100
+    p95(get_ops, 1h) > 50
+
+The values of each (metric, tenant) are kept in a Window per function and
+duration, a ring buffer of at most WINDOW_MAX_SAMPLES values that is updated
+in O(1) (amortized, for max and min) with every value of the metric. For p95,
+the values are also kept in a sorted list, so the percentile is read by index
+in O(1), but adding and expiring a value are O(n) in the number of values of
+the window (at most WINDOW_MAX_SAMPLES).
+"""
+import bisect
+import math
+import threading
+from collections import deque
+
+functions = ('avg', 'max', 'min', 'p95', 'rate')
+
+units = {'s': 1, 'm': 60, 'h': 3600}
+
+
+def window_seconds(duration):
+    """
+    Converts a window duration of the DSL (e.g. '30s', '5m', '1h') to seconds.
+    """
+    return int(duration[:-1]) * units[duration[-1]]
+
+
+class Window(object):
+    """
+    Values of a metric in the last `seconds`, to compute one of the window functions.
+    A window is shared by the rule engines of all the metrics (which run in
+    different threads), so it is updated and read under its lock.
+    """
+
+    def __init__(self, function, seconds, max_samples):
+        """
+        :param function: One of `functions`.
+        :param seconds: Duration of the window.
+        :param max_samples: Size of the ring buffer.
+        """
+        if function not in functions:
+            raise ValueError('Unknown window function: ' + str(function))
+        self.function = function
+        self.seconds = seconds
+        # (sequence number, time, value) of each sample
+        self.samples = deque(maxlen=max_samples)
+        self.sequence = 0
+        self.total = 0.0
+        # Monotonic queue of the samples that can still be the max (or min) of the window
+        self.extremes = deque()
+        # Values of the samples in order, for p95
+        self.sorted_values = []
+        self.lock = threading.Lock()
+
+    def add(self, now, value):
+        value = float(value)
+        with self.lock:
+            self._add(now, value)
+
+    def value(self, now):
+        """
+        :return: The result of the function with the values of the window, None
+                 if there are not enough values.
+        """
+        with self.lock:
+            return self._value(now)
+
+    def _add(self, now, value):
+        if len(self.samples) == self.samples.maxlen:
+            self._drop()
+        self.sequence += 1
+        sample = (self.sequence, now, value)
+        self.samples.append(sample)
+        self.total += value
+        if self.function == 'max':
+            while self.extremes and self.extremes[-1][2] < value:
+                self.extremes.pop()
+            self.extremes.append(sample)
+        elif self.function == 'min':
+            while self.extremes and self.extremes[-1][2] > value:
+                self.extremes.pop()
+            self.extremes.append(sample)
+        elif self.function == 'p95':
+            bisect.insort(self.sorted_values, value)
+        self._expire(now)
+
+    def _value(self, now):
+        self._expire(now)
+        if not self.samples:
+            return None
+        if self.function == 'avg':
+            return self.total / len(self.samples)
+        if self.function in ('max', 'min'):
+            return self.extremes[0][2]
+        if self.function == 'p95':
+            return self.sorted_values[int(math.ceil(0.95 * len(self.sorted_values))) - 1]
+        # rate: change per second between the first and the last value
+        _, first_time, first_value = self.samples[0]
+        _, last_time, last_value = self.samples[-1]
+        if last_time == first_time:
+            return None
+        return (last_value - first_value) / (last_time - first_time)
+
+    def _expire(self, now):
+        while self.samples and now - self.samples[0][1] > self.seconds:
+            self._drop()
+
+    def _drop(self):
+        sample = self.samples.popleft()
+        if self.samples:
+            self.total -= sample[2]
+        else:
+            # Avoids accumulating rounding errors
+            self.total = 0.0
+        if self.extremes and self.extremes[0][0] == sample[0]:
+            self.extremes.popleft()
+        if self.function == 'p95':
+            del self.sorted_values[bisect.bisect_left(self.sorted_values, sample[2])]
@@ -0,0 +1,45 @@
+import logging
+import multiprocessing
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.common_utils import get_redis_connection
+from api.jobs import run_worker
+
+logger = logging.getLogger(__name__)
+
+
+def _worker(stop):
+    # The parent process handles the signals and sets `stop`
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    run_worker(get_redis_connection(), stop)
+
+
+class Command(BaseCommand):
+    help = 'Runs the worker processes that execute the background jobs (storage policies, projects, node restarts)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.JOB_WORKERS,
+                            help='Number of jobs executed concurrently')
+
+    def handle(self, *args, **options):
+        stop = multiprocessing.Event()
+        workers = [multiprocessing.Process(target=_worker, args=(stop,)) for _ in range(options['workers'])]
+        for worker in workers:
+            worker.start()
+        logger.info('Job worker started with %d processes', len(workers))
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        try:
+            while not stop.is_set():
+                stop.wait(1)
+        except KeyboardInterrupt:
+            stop.set()
+
+        # Running jobs are finished before exiting
+        for worker in workers:
+            worker.join()
+        logger.info('Job worker stopped')
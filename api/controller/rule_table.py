@@ -0,0 +1,63 @@
+"""
+Table of the dynamic policy rules.
+
+The alive rules are registered in Redis, in one set per workload metric and
+tenant with the policies whose conditions use that metric:
+
+    rules:<metric>:<tenant> -> {policy:<id>, ...}
+
+The rule engine of each metric (controller/dynamic_policies/rules/rule_engine.py)
+loads the rules of a tenant from the table when its first value arrives, and
+discards them when the tenant sends no values for RULE_IDLE_TIMEOUT seconds,
+so the memory used follows the active tenants instead of the policies.
+"""
+from controller.dynamic_policies.rules.conditions import compile_conditions
+
+
+def rule_table_key(metric, tenant):
+    return 'rules:' + metric + ':' + tenant
+
+
+def register_rule(r, policy_key, rule_parsed, target, action_index=0):
+    """
+    Adds the rule of a policy to the table. `r` can be a pipeline.
+
+    :param target: Target of this policy (the rule may have several ones)
+    :param action_index: Action of the rule assigned to this policy
+    """
+    if not rule_parsed.condition_list:
+        raise ValueError('The rule of ' + policy_key + ' has no conditions')
+    _, metrics = compile_conditions(rule_parsed.condition_list.asList())
+    # The exit conditions of a transient action (UNTIL) are evaluated with the same values
+    action_info = rule_parsed.action_list[int(action_index)]
+    if action_info.until:
+        metrics.update(compile_conditions(action_info.until.asList())[1])
+    metrics = sorted(metrics)
+    tenant = target.split('/', 1)[0]
+    for metric in metrics:
+        r.sadd(rule_table_key(metric, tenant), policy_key)
+    r.hmset(policy_key, {'target': target, 'action_index': action_index, 'metrics': ','.join(metrics), 'alive': True})
+    return metrics
+
+
+def unregister_rule(r, policy_key):
+    """
+    Removes the rule of a policy from the table. The rule engines discard it with the next value.
+    """
+    target, metrics = r.hmget(policy_key, 'target', 'metrics')
+    if target and metrics:
+        tenant = target.split('/', 1)[0]
+        pipe = r.pipeline()
+        for metric in metrics.split(','):
+            pipe.srem(rule_table_key(metric, tenant), policy_key)
+        pipe.execute()
+
+
+def disable_metric_rules(r, metric):
+    """
+    Unregisters the rules that use a workload metric, and marks their policies as not alive.
+    """
+    for key in r.keys(rule_table_key(metric, '*')):
+        for policy_key in r.smembers(key):
+            unregister_rule(r, policy_key)
+            r.hset(policy_key, 'alive', False)
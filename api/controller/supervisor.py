@@ -0,0 +1,188 @@
+"""
+Supervision of the metric and global controller actors.
+
+The actors started by the views (controller.views.start_metric,
+start_bw_metric and start_global_controller) are watched by the supervisor,
+which pings them every SUPERVISOR_INTERVAL seconds. A metric is healthy
+while its RabbitMQ consumer is consuming and its rule engine processes its
+values, so a broker disconnection or a stalled rule engine is detected as a
+failure too.
+
+A failed actor is stopped (if it still answers) and started again, waiting
+SUPERVISOR_BACKOFF_MIN seconds after the first failure and twice as long
+after each consecutive one, up to SUPERVISOR_BACKOFF_MAX. The dynamic policy
+rules of a restarted metric are kept in the rule table, so its new rule engine
+loads them again, and the global controllers that observe it are subscribed
+again. The restarts are listed by GET /controller/supervisor.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class SupervisedActor(object):
+
+    def __init__(self, kind, key, actors, start, stop, observes=None):
+        """
+        :param kind: 'metric' or 'controller'.
+        :param key: Key of the actor in `actors`.
+        :param actors: The dict of the views that holds the proxy of the actor.
+        :param start: Function that starts the actor again (and adds it to `actors`).
+        :param stop: Function that stops the proxy of a failed actor.
+        :param observes: The key of the metric observed by a global controller.
+        """
+        self.kind = kind
+        self.key = key
+        self.actors = actors
+        self.start = start
+        self.stop = stop
+        self.observes = observes
+        self.state = 'running'
+        self.restarts = 0
+        self.failures = 0  # Consecutive
+        self.last_error = None
+        self.last_failure = None
+        self.last_restart = None
+        self.next_restart = None
+
+    def status(self):
+        return {'kind': self.kind, 'key': self.key, 'state': self.state, 'restarts': self.restarts,
+                'failures': self.failures, 'last_error': self.last_error, 'last_failure': self.last_failure,
+                'last_restart': self.last_restart, 'next_restart': self.next_restart}
+
+
+class Supervisor(object):
+
+    def __init__(self):
+        self.supervised = dict()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def watch(self, kind, key, actors, start, stop, observes=None):
+        """
+        Supervises an actor. Watching it again (when it is restarted) keeps its restart count.
+        """
+        with self.lock:
+            supervised = self.supervised.get((kind, key))
+            if supervised is None:
+                self.supervised[(kind, key)] = SupervisedActor(kind, key, actors, start, stop, observes)
+            else:
+                supervised.start, supervised.stop, supervised.observes = start, stop, observes
+
+    def unwatch(self, kind, key):
+        """
+        Stops supervising an actor, before it is stopped on purpose.
+        """
+        with self.lock:
+            self.supervised.pop((kind, key), None)
+
+    def start(self):
+        """
+        Starts the supervision in a background thread.
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='actor_supervisor')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(settings.SUPERVISOR_INTERVAL)
+            try:
+                self.check()
+            except Exception as e:
+                logger.error("Supervisor, Check failed: " + str(e))
+
+    def check(self):
+        """
+        Pings all the actors, and restarts the failed ones whose backoff time has passed.
+        """
+        now = time.time()
+        with self.lock:
+            supervised_actors = self.supervised.values()
+        for supervised in supervised_actors:
+            if supervised.state == 'running':
+                error = self._ping(supervised)
+                if error is None:
+                    # Stable for a while: the next failure restarts it without waiting
+                    if supervised.failures and now - (supervised.last_restart or 0) > settings.SUPERVISOR_BACKOFF_MAX:
+                        supervised.failures = 0
+                    continue
+                logger.error("Supervisor, " + supervised.kind + " actor " + str(supervised.key) + " failed: " + error)
+                supervised.state = 'failed'
+                supervised.last_error = error
+                supervised.last_failure = now
+                supervised.failures += 1
+                supervised.next_restart = now + self._backoff(supervised.failures)
+            if now >= supervised.next_restart:
+                self._restart(supervised, now)
+
+    def status(self):
+        with self.lock:
+            return sorted((supervised.status() for supervised in self.supervised.values()),
+                          key=lambda status: (status['kind'], str(status['key'])))
+
+    def _ping(self, supervised):
+        """
+        :return: None if the actor is healthy, the error otherwise.
+        """
+        actor = supervised.actors.get(supervised.key)
+        if actor is None:
+            return 'Not running'
+        try:
+            if not actor.ping():
+                return 'Not consuming or rule engine not running'
+        except Exception as e:
+            return 'Ping failed: ' + (str(e) or type(e).__name__)
+        return None
+
+    def _backoff(self, failures):
+        return min(settings.SUPERVISOR_BACKOFF_MIN * 2 ** (failures - 1), settings.SUPERVISOR_BACKOFF_MAX)
+
+    def _restart(self, supervised, now):
+        logger.info("Supervisor, Restarting " + supervised.kind + " actor " + str(supervised.key))
+        actor = supervised.actors.pop(supervised.key, None)
+        if actor is not None:
+            try:
+                supervised.stop(actor)
+            except Exception as e:
+                logger.warning("Supervisor, Could not stop " + supervised.kind + " actor " + str(supervised.key) + ": " + str(e))
+
+        supervised.last_restart = now
+        supervised.restarts += 1
+        try:
+            supervised.start()
+        except Exception as e:
+            supervised.last_error = 'Restart failed: ' + str(e)
+        if supervised.key not in supervised.actors:
+            logger.error("Supervisor, Could not restart " + supervised.kind + " actor " + str(supervised.key))
+            supervised.failures += 1
+            supervised.next_restart = now + self._backoff(supervised.failures)
+            return
+
+        supervised.state = 'running'
+        supervised.next_restart = None
+        if supervised.kind == 'metric':
+            self._resubscribe(supervised.key)
+
+    def _resubscribe(self, metric_key):
+        """
+        Subscribes the global controllers that observe a restarted metric again.
+        """
+        with self.lock:
+            observers = [supervised for supervised in self.supervised.values()
+                         if supervised.kind == 'controller' and supervised.observes == metric_key]
+        for supervised in observers:
+            actor = supervised.actors.get(supervised.key)
+            if actor is not None:
+                try:
+                    actor.run(metric_key)
+                except Exception as e:
+                    logger.error("Supervisor, Could not subscribe controller " + str(supervised.key) + " again: " + str(e))
+
+
+supervisor = Supervisor()
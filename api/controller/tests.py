@@ -1,5 +1,6 @@
 import json
 import os
+import tempfile
 
 import mock
 import redis
@@ -9,13 +10,20 @@ from pyparsing import ParseException
 from rest_framework import status
 from rest_framework.test import APIRequestFactory
 
+from api import jobs
+from api.common_utils import md5
+from api.events import publish_event
+from api.instrumentation import MonitoredConnectionPool
 from filters.views import storlet_list, filter_deploy, StorletData
-from .dsl_parser import parse
+from .dsl_parser import parse, get_grammar
 from .views import object_type_list, object_type_detail, add_tenants_group, tenants_group_detail, gtenants_tenant_detail, \
     add_metric, metric_detail, metric_module_list, metric_module_detail, MetricModuleData, list_storage_node, storage_node_detail, add_dynamic_filter, \
     dynamic_filter_detail, load_metrics, load_policies, static_policy_detail, dynamic_policy_detail, global_controller_list, global_controller_detail, \
-    GlobalControllerData
+    GlobalControllerData, artifact_manifest, artifact_data, job_detail, job_log, controller_ready, RateLimiter, deploy_policy, redis_pool_stats, metric_series, \
+    supervisor_status, stop_metric, STARTUP_STATUS_KEY
 from .views import policy_list
+from .supervisor import Supervisor
+from .timeseries import TimeSeriesStore
 
 
 # Tests use database=10 instead of 0.
@@ -80,8 +88,9 @@ class ControllerTestCase(TestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertTrue(mock_do_action.called)
 
+    @mock.patch('controller.views.upload_storlet_to_accounts')
     @mock.patch('controller.views.set_filter')
-    def test_registry_static_policy_create_set_filter_ok(self, mock_set_filter):
+    def test_registry_static_policy_create_set_filter_ok(self, mock_set_filter, mock_upload_storlet_to_accounts):
         self.setup_dsl_parser_data()
 
         # Create an instance of a POST request.
@@ -92,7 +101,42 @@ class ControllerTestCase(TestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertTrue(mock_set_filter.called)
         expected_policy_data = {'object_size': '', 'execution_order': 2, 'object_type': 'DOCS', 'params': mock.ANY, 'policy_id': 2, 'execution_server': 'PROXY', 'callable': False}
-        mock_set_filter.assert_called_with(mock.ANY, '1234567890abcdef', mock.ANY, expected_policy_data, 'fake_token')
+        mock_set_filter.assert_called_with(mock.ANY, '1234567890abcdef', mock.ANY, expected_policy_data, 'fake_token', upload=False)
+        # The storlet is uploaded once for all the target accounts
+        mock_upload_storlet_to_accounts.assert_called_once_with('fake_token', mock.ANY, ['1234567890abcdef'])
+
+    @mock.patch('filters.views.swift_client.head_object')
+    @mock.patch('filters.views.swift_client.put_object')
+    def test_registry_static_policy_create_for_many_tenants(self, mock_put_object, mock_head_object):
+        heads = []
+        puts = []
+
+        def put_object(url, token, container, name, contents, content_length, etag, chunk_size, content_type, headers, http_conn, proxy,
+                       query_string, response_dict):
+            puts.append((url, etag))
+            response_dict['status'] = status.HTTP_201_CREATED
+        mock_put_object.side_effect = put_object
+        # abcdef1234567890 already has the storlet
+        etag = self.r.hget('filter:1', 'etag')
+        headers = {'etag': etag, 'x-object-meta-storlet-language': 'java', 'x-object-meta-storlet-main': 'com.example.FakeMain'}
+
+        def head_object(url, token, container, name, http_conn):
+            heads.append(url)
+            return headers if 'abcdef1234567890' in url else {}
+        mock_head_object.side_effect = head_object
+        self.setup_dsl_parser_data()
+
+        data = "FOR TENANT:1234567890abcdef, TENANT:abcdef1234567890 DO SET compression"
+        request = self.factory.post('/controller/static_policy', data, content_type='text/plain')
+        request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
+        response = policy_list(request)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        swift_url = settings.SWIFT_URL + settings.SWIFT_API_VERSION
+        self.assertEqual(sorted(heads), [swift_url + '/AUTH_1234567890abcdef', swift_url + '/AUTH_abcdef1234567890'])
+        self.assertEqual(puts, [(swift_url + '/AUTH_1234567890abcdef', etag)])
+        # The parser does not keep the order of the targets, so either one can get the first policy id
+        policy_ids = self.r.hkeys('pipeline:AUTH_1234567890abcdef') + self.r.hkeys('pipeline:AUTH_abcdef1234567890')
+        self.assertEqual(sorted(policy_ids), ['2', '3'])
 
     @mock.patch('controller.views.deploy_policy')
     def test_registry_dynamic_policy_create_ok(self, mock_deploy_policy):
@@ -106,8 +150,7 @@ class ControllerTestCase(TestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertTrue(mock_deploy_policy.called)
 
-    @mock.patch('controller.views.create_local_host')
-    def test_registry_dynamic_policy_create_spawn_id_ok(self, mock_create_local_host):
+    def test_registry_dynamic_policy_create_registers_rule_ok(self):
         self.setup_dsl_parser_data()
 
         # Create an instance of a POST request.
@@ -116,8 +159,8 @@ class ControllerTestCase(TestCase):
         request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
         response = policy_list(request)
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
-        self.assertTrue(mock_create_local_host.called)
-        self.assertTrue(mock_create_local_host.return_value.spawn_id.called)
+        # The rule is evaluated by the rule engine of metric1, no actor is spawned for it
+        self.assertEqual(self.r.smembers('rules:metric1:1234567890abcdef'), {'policy:2'})
         self.assertTrue(self.r.exists('policy:2'))
         policy_data = self.r.hgetall('policy:2')
         self.assertEqual(policy_data['policy'], 'FOR TENANT:1234567890abcdef DO SET compression')
@@ -285,6 +328,81 @@ class ControllerTestCase(TestCase):
         metric_data = json.loads(response.content)
         self.assertEqual(metric_data['metric_name'], 'test.py')
 
+    #
+    # Artifacts tests
+    #
+
+    @override_settings(ARTIFACT_COLLECTIONS={'workload_metrics': os.path.join("/tmp", "crystal", "workload_metrics")})
+    @mock.patch('controller.views.rsync_dir_with_nodes')
+    def test_artifact_manifest_ok(self, mock_rsync_dir):
+        with open('test_data/test.py', 'r') as fp:
+            metadata = {'class_name': 'Metric1', 'execution_server': 'proxy', 'out_flow': False,
+                        'in_flow': False, 'enabled': False}
+            request = self.factory.post('/controller/metric_module/data/', {'file': fp, 'metadata': json.dumps(metadata)})
+            MetricModuleData.as_view()(request)
+
+        request = self.factory.get('/controller/artifacts/workload_metrics/manifest')
+        response = artifact_manifest(request, 'workload_metrics')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        manifest = json.loads(response.content)
+        self.assertEqual(manifest['files']['test.py'], md5(os.path.join(settings.WORKLOAD_METRICS_DIR, 'test.py')))
+        self.assertEqual(response['ETag'], '"' + str(manifest['version']) + '"')
+
+        # The node already has the current version
+        request = self.factory.get('/controller/artifacts/workload_metrics/manifest', HTTP_IF_NONE_MATCH=response['ETag'])
+        response = artifact_manifest(request, 'workload_metrics')
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Pull the file by its hash
+        md5_hash = manifest['files']['test.py']
+        request = self.factory.get('/controller/artifacts/workload_metrics/' + md5_hash)
+        response = artifact_data(request, 'workload_metrics', md5_hash)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        with open('test_data/test.py', 'r') as fp:
+            self.assertEqual(''.join(response.streaming_content), fp.read())
+
+        response = artifact_data(request, 'workload_metrics', '0' * 32)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_artifact_manifest_unknown_collection(self):
+        request = self.factory.get('/controller/artifacts/unknown/manifest')
+        response = artifact_manifest(request, 'unknown')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    #
+    # Jobs
+    #
+
+    def test_job_log_tail(self):
+        job_id = jobs.submit_job(self.r, 'restart_node', {'node_id': 'storagenode1'})
+        for line in ('line1', 'line2', 'line3'):
+            jobs.append_job_log(self.r, job_id, line)
+
+        request = self.factory.get('/controller/jobs/' + str(job_id) + '/log', {'offset': 1})
+        response = job_log(request, str(job_id))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content), {'status': 'queued', 'progress': None, 'lines': ['line2', 'line3'], 'next': 3})
+
+    def test_job_detail_cancel_queued_job(self):
+        job_id = jobs.submit_job(self.r, 'restart_node', {'node_id': 'storagenode1'}, 'node:storagenode1')
+        request = self.factory.delete('/controller/jobs/' + str(job_id))
+        response = job_detail(request, str(job_id))
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+        request = self.factory.get('/controller/jobs/' + str(job_id))
+        response = job_detail(request, str(job_id))
+        self.assertEqual(json.loads(response.content)['status'], 'cancelled')
+
+        # Finished jobs cannot be cancelled
+        request = self.factory.delete('/controller/jobs/' + str(job_id))
+        response = job_detail(request, str(job_id))
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_job_detail_with_non_existent_job(self):
+        request = self.factory.get('/controller/jobs/1000')
+        response = job_detail(request, '1000')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
     #
     # DSL Filters tests
     #
@@ -381,6 +499,16 @@ class ControllerTestCase(TestCase):
         dsl_filters = json.loads(response.content)
         self.assertEqual(len(dsl_filters), 1)
 
+    def test_delete_dsl_filter_in_use(self):
+        # 'compression' is bound to filter 1, which is deployed to 0123456789abcdef (static policy 1)
+        self.setup_dsl_parser_data()
+
+        dsl_filter_name = 'compression'
+        request = self.factory.delete('/controller/filters/' + dsl_filter_name)
+        response = dynamic_filter_detail(request, dsl_filter_name)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertTrue(self.r.exists('dsl_filter:compression'))
+
     #
     # Storage nodes tests
     #
@@ -934,6 +1062,49 @@ class ControllerTestCase(TestCase):
         action_info = action_list[0]
         self.assertEqual(action_info.callable, '')
 
+    def test_parse_transient_with_hold_until_and_max_toggles(self):
+        self.setup_dsl_parser_data()
+        has_condition_list, rule_parsed = parse('FOR TENANT:123456789abcdef WHEN metric1 > 80 DO SET compression TRANSIENT '
+                                                'HOLD 3 UPDATES UNTIL metric1 < 60 AND metric2 < 5 MAX 4 TOGGLES PER 3600 SECONDS')
+        self.assertTrue(has_condition_list)
+        action_info = rule_parsed.action_list[0]
+        self.assertEqual(action_info.transient, 'TRANSIENT')
+        self.assertEqual((action_info.hold.value, action_info.hold.unit), ('3', 'UPDATES'))
+        self.assertEqual(action_info.until.asList(), [['metric1', '<', '60'], 'AND', ['metric2', '<', '5']])
+        self.assertEqual((action_info.max_toggles.count, action_info.max_toggles.period), ('4', '3600'))
+        self.assertEqual(rule_parsed.condition_list.asList(), ['metric1', '>', '80'])
+
+    def test_parse_window_functions(self):
+        self.setup_dsl_parser_data()
+        has_condition_list, rule_parsed = parse('FOR TENANT:123456789abcdef WHEN avg(metric1, 30s) > 10 OR p95(metric2,5m) > 50 DO SET compression')
+        self.assertTrue(has_condition_list)
+        self.assertEqual(rule_parsed.condition_list.asList(),
+                         [[['avg', 'metric1', '30s'], '>', '10'], 'OR', [['p95', 'metric2', '5m'], '>', '50']])
+        with self.assertRaises(ParseException):
+            parse('FOR TENANT:123456789abcdef WHEN median(metric1, 30s) > 10 DO SET compression')
+
+    def test_parse_hold_without_transient(self):
+        self.setup_dsl_parser_data()
+        with self.assertRaises(ParseException):
+            parse('FOR TENANT:123456789abcdef WHEN metric1 > 80 DO SET compression HOLD 30 SECONDS')
+
+    def test_grammar_is_rebuilt_only_when_metrics_or_filters_change(self):
+        self.setup_dsl_parser_data()
+        publish_event(self.r, 'metric', 'metric2')
+        grammar = get_grammar()
+        # No new events: the metrics and filters are not listed again
+        with mock.patch('api.instrumentation.InstrumentedRedis.keys') as mock_keys:
+            self.assertIs(get_grammar(), grammar)
+            self.assertFalse(mock_keys.called)
+        # Another event, but the metrics and filters did not change
+        publish_event(self.r, 'filter', 1)
+        self.assertIs(get_grammar(), grammar)
+        self.r.hmset('metric:metric3', {'network_location': '?', 'type': 'integer'})
+        publish_event(self.r, 'metric', 'metric3')
+        self.assertIsNot(get_grammar(), grammar)
+        has_condition_list, _ = parse('FOR TENANT:0123456789abcdef WHEN metric3 > 5 DO SET compression')
+        self.assertTrue(has_condition_list)
+
     # TODO Add tests with wrong number of parameters, non existent parameters, wrong type parameters, ...
     # TODO Add tests for conditional rules
 
@@ -946,28 +1117,253 @@ class ControllerTestCase(TestCase):
         load_metrics()
         mock_start_metric.assert_called_with(1, 'm1')
 
-    @mock.patch('controller.views.create_local_host')
-    def test_load_policies_not_alive(self, mock_create_local_host):
+    def test_load_policies_not_alive(self):
         self.r.hmset('policy:20',
-                     {'alive': 'False', 'policy_description': 'FOR TENANT:0123456789abcdef DO SET compression'})
+                     {'alive': 'False', 'policy_description': 'FOR TENANT:0123456789abcdef WHEN metric1 > 5 DO SET compression'})
         load_policies()
-        self.assertEqual(len(mock_create_local_host.return_value.method_calls), 0)
+        self.assertEqual(self.r.keys('rules:*'), [])
 
-    @mock.patch('controller.views.create_local_host')
-    def test_load_policies_alive(self, mock_create_local_host):
+    def test_load_policies_alive(self):
         self.setup_dsl_parser_data()
         self.r.hmset('policy:21',
-                     {'alive': 'True', 'policy_description': 'FOR TENANT:0123456789abcdef DO SET compression'})
+                     {'alive': 'True', 'policy_description': 'FOR TENANT:0123456789abcdef WHEN metric1 > 5 AND metric2 < 3 DO SET compression'})
         load_policies()
-        self.assertTrue(mock_create_local_host.return_value.spawn_id.called)
+        # The rule is registered, and loaded by the rule engines of its metrics
+        self.assertEqual(self.r.smembers('rules:metric1:0123456789abcdef'), {'policy:21'})
+        self.assertEqual(self.r.smembers('rules:metric2:0123456789abcdef'), {'policy:21'})
+        self.assertEqual(self.r.hget('policy:21', 'target'), '0123456789abcdef')
 
-    @mock.patch('controller.views.create_local_host')
-    def test_load_policies_alive_transient(self, mock_create_local_host):
+    def test_load_policies_alive_transient(self):
         self.setup_dsl_parser_data()
         self.r.hmset('policy:21',
-                     {'alive': 'True', 'policy_description': 'FOR TENANT:0123456789abcdef DO SET compression TRANSIENT'})
+                     {'alive': 'True', 'policy_description': 'FOR TENANT:0123456789abcdef WHEN metric1 > 5 DO SET compression TRANSIENT'})
+        load_policies()
+        self.assertEqual(self.r.smembers('rules:metric1:0123456789abcdef'), {'policy:21'})
+
+    def test_load_policies_restores_given_policies(self):
+        self.setup_dsl_parser_data()
+        self.r.hmset('policy:21', {'alive': 'False', 'policy_description': 'FOR TENANT:0123456789abcdef WHEN metric1 > 5 DO SET compression'})
+        self.r.hmset('policy:22', {'alive': 'False', 'policy_description': 'FOR TENANT:0123456789abcdef WHEN metric2 > 5 DO SET encryption'})
+        self.r.hmset('policy:23', {'alive': 'False', 'policy_description': 'FOR TENANT:0123456789abcdef WHEN metric1 > 5 DO SET unknown'})
+        load_policies(['policy:21', 'policy:22', 'policy:23'])
+        self.assertEqual(self.r.smembers('rules:metric1:0123456789abcdef'), {'policy:21'})
+        self.assertEqual(self.r.smembers('rules:metric2:0123456789abcdef'), {'policy:22'})
+        self.assertEqual(self.r.hget('policy:21', 'alive'), 'True')
+        self.assertEqual(self.r.hget('policy:22', 'alive'), 'True')
+        self.assertEqual(self.r.hget('policy:23', 'alive'), 'False')
+
+        request = self.factory.get('/controller/ready')
+        self.r.hset(STARTUP_STATUS_KEY, 'state', 'restoring')
+        response = controller_ready(request)
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        progress = json.loads(response.content)
+        self.assertEqual((progress['policies_total'], progress['policies_started'], progress['policies_failed']), (3, 2, 1))
+
+        self.r.hset(STARTUP_STATUS_KEY, 'state', 'ready')
+        response = controller_ready(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # No process of this host restores actors
+        self.r.delete(STARTUP_STATUS_KEY)
+        response = controller_ready(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    #
+    # rule_table
+    #
+
+    def test_deploy_policy_registers_a_rule_per_target_and_action(self):
+        self.setup_dsl_parser_data()
+        rule_string = 'FOR TENANT:0123456789abcdef WHEN metric1 > 5 DO SET compression, SET encryption'
+        _, rule_parsed = parse(rule_string)
+        deploy_policy(self.r, rule_string, rule_parsed)
+        # setUp has used the policy id 1
+        self.assertEqual(self.r.smembers('rules:metric1:0123456789abcdef'), {'policy:2', 'policy:3'})
+        self.assertEqual(self.r.hmget('policy:2', 'action_index', 'alive'), ['0', 'True'])
+        self.assertEqual(self.r.hmget('policy:3', 'action_index', 'alive'), ['1', 'True'])
+
+    def test_deleted_policy_is_unregistered(self):
+        self.setup_dsl_parser_data()
+        self.r.hmset('policy:21', {'alive': 'True', 'policy_description': 'FOR TENANT:0123456789abcdef WHEN metric1 > 5 DO SET compression'})
         load_policies()
-        self.assertTrue(mock_create_local_host.return_value.spawn_id.called)
+        request = self.factory.delete('/controller/dynamic_policy/21')
+        response = dynamic_policy_detail(request, '21')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(self.r.exists('rules:metric1:0123456789abcdef'))
+
+    def test_redis_pool_stats(self):
+        request = self.factory.get('/controller/redis_pool')
+        response = redis_pool_stats(request)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        with self.settings(REDIS_CON_POOL=MonitoredConnectionPool(max_connections=5, host='localhost', port=6379, db=10)):
+            redis.Redis(connection_pool=settings.REDIS_CON_POOL).ping()
+            response = redis_pool_stats(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        stats = json.loads(response.content)
+        self.assertEqual((stats['max_connections'], stats['connections'], stats['checkouts'], stats['in_use']), (5, 1, 1, 0))
+
+    def test_timeseries_tiers(self):
+        store = TimeSeriesStore([(60, 60), (1, 120)], 10)
+        self.assertEqual(store.tiers, [(1, 120), (60, 60)])
+        for second in range(0, 300):
+            store.add('get_ops', 'tenant1', second % 60, 6000 + second)
+        with mock.patch('controller.timeseries.time.time', return_value=6300):
+            # The last 2 minutes are in the 1 second tier
+            step, points = store.query('get_ops', 'tenant1', 6200)
+            self.assertEqual(step, 1)
+            self.assertEqual(points[0], [6200, 20, 20, 20])
+            self.assertEqual(len(points), 100)
+            step, points = store.query('get_ops', 'tenant1', 6240, step=30)
+            self.assertEqual(step, 30)
+            self.assertEqual(points[:2], [[6240, 14.5, 0, 29], [6270, 44.5, 30, 59]])
+            # Older values come from the 1 minute tier
+            step, points = store.query('get_ops', 'tenant1', 6000, step=10)
+            self.assertEqual(step, 60)
+            self.assertEqual(points[0], [6000, 29.5, 0, 59])
+            self.assertEqual(len(points), 5)
+            self.assertEqual(store.query('get_ops', 'tenant2', 6000), (1, []))
+
+    def test_timeseries_store_is_bounded(self):
+        store = TimeSeriesStore([(1, 10)], 2)
+        store.add('get_ops', 'tenant1', 1, 100)
+        store.add('get_ops', 'tenant2', 1, 100)
+        store.add('get_ops', 'tenant1', 1, 101)
+        store.add('put_ops', 'tenant1', 1, 101)
+        self.assertEqual(store.tenants('get_ops'), ['tenant1'])
+        self.assertEqual(store.tenants('put_ops'), ['tenant1'])
+        # The ring buffer only keeps the last 10 seconds
+        for second in range(100, 120):
+            store.add('get_ops', 'tenant1', second, second)
+        with mock.patch('controller.timeseries.time.time', return_value=120):
+            _, points = store.query('get_ops', 'tenant1', 0)
+        self.assertEqual([point[0] for point in points], range(110, 120))
+
+    def test_timeseries_snapshot(self):
+        path = os.path.join(tempfile.mkdtemp(), 'metric_series.json')
+        store = TimeSeriesStore([(1, 10), (60, 10)], 10)
+        store.add('get_ops', 'tenant1', 5, 100)
+        store.save(path)
+        self.addCleanup(os.remove, path)
+        loaded = TimeSeriesStore([(1, 10), (60, 10)], 10)
+        loaded.load(path)
+        with mock.patch('controller.timeseries.time.time', return_value=100):
+            self.assertEqual(loaded.query('get_ops', 'tenant1', 100), (1, [[100, 5, 5, 5]]))
+        # Snapshots of other tiers are ignored
+        other = TimeSeriesStore([(1, 20)], 10)
+        other.load(path)
+        self.assertEqual(other.tenants('get_ops'), [])
+        # Stores without new values do not overwrite the snapshot
+        loaded.save(path)
+        TimeSeriesStore([(1, 10), (60, 10)], 10).save(path)
+        with open(path) as snapshot_file:
+            self.assertEqual(json.load(snapshot_file)['series'], [['get_ops', 'tenant1', mock.ANY]])
+        store.add('get_ops', 'tenant1', 6, 101)
+        store.save(path)
+        with open(path) as snapshot_file:
+            # Intervals of the first tier
+            self.assertIn(101, json.load(snapshot_file)['series'][0][2][0][0])
+
+    def test_metric_series(self):
+        store = TimeSeriesStore([(1, 3600), (60, 1440)], 10)
+        store.add('get_ops', 'tenant1', 5, 1000)
+        store.add('get_ops', 'tenant1', 7, 1001)
+        with mock.patch('controller.views.timeseries.store', store), mock.patch('controller.timeseries.time.time', return_value=1010):
+            request = self.factory.get('/controller/metrics/get_ops/series', {'tenant': 'tenant1', 'from': 900, 'step': 60})
+            response = metric_series(request, 'get_ops')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            series = json.loads(response.content)
+            self.assertEqual((series['step'], series['points']), (60, [[960, 6, 5, 7]]))
+
+            request = self.factory.get('/controller/metrics/get_ops/series')
+            response = metric_series(request, 'get_ops')
+            self.assertEqual(json.loads(response.content)['tenants'], ['tenant1'])
+
+            request = self.factory.get('/controller/metrics/get_ops/series', {'tenant': 'tenant1', 'step': 'x'})
+            response = metric_series(request, 'get_ops')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(SUPERVISOR_BACKOFF_MIN=5, SUPERVISOR_BACKOFF_MAX=20)
+    @mock.patch('controller.supervisor.time.time')
+    def test_supervisor_restarts_failed_actor_with_backoff(self, mock_time):
+        supervisor = Supervisor()
+        actors = dict()
+        failed_actor = mock.Mock()
+        failed_actor.ping.return_value = False
+        restarted = []
+
+        def start():
+            # The first restart fails
+            if restarted:
+                actors['metric1'] = mock.Mock()
+            restarted.append(True)
+
+        actors['metric1'] = failed_actor
+        stop = mock.Mock()
+        supervisor.watch('metric', 'metric1', actors, start, stop)
+        mock_time.return_value = 100
+        supervisor.check()
+        self.assertEqual(supervisor.status()[0]['state'], 'failed')
+        self.assertEqual(supervisor.status()[0]['next_restart'], 105)
+        mock_time.return_value = 105
+        supervisor.check()
+        stop.assert_called_once_with(failed_actor)
+        self.assertEqual(supervisor.status()[0]['next_restart'], 115)
+        mock_time.return_value = 114
+        supervisor.check()
+        self.assertEqual(len(restarted), 1)
+        mock_time.return_value = 115
+        supervisor.check()
+        status_ = supervisor.status()[0]
+        self.assertEqual((status_['state'], status_['restarts'], status_['failures']), ('running', 2, 2))
+        self.assertIn('metric1', actors)
+        # The consecutive failures are forgotten once the actor is stable
+        mock_time.return_value = 200
+        supervisor.check()
+        self.assertEqual(supervisor.status()[0]['failures'], 0)
+
+    def test_supervisor_resubscribes_controllers(self):
+        supervisor = Supervisor()
+        metric_actors = {'get_bw_info': mock.Mock()}
+        metric_actors['get_bw_info'].ping.side_effect = Exception('Timeout')
+        controller_actors = {'1': mock.Mock()}
+
+        def start_metric():
+            metric_actors['get_bw_info'] = mock.Mock()
+
+        supervisor.watch('metric', 'get_bw_info', metric_actors, start_metric, mock.Mock())
+        supervisor.watch('controller', '1', controller_actors, mock.Mock(), mock.Mock(), 'get_bw_info')
+        with self.settings(SUPERVISOR_BACKOFF_MIN=0):
+            supervisor.check()
+        controller_actors['1'].run.assert_called_once_with('get_bw_info')
+        status_ = supervisor.status()
+        self.assertEqual([(actor['kind'], actor['restarts']) for actor in status_], [('controller', 0), ('metric', 1)])
+        self.assertEqual(status_[1]['last_error'], 'Ping failed: Timeout')
+
+    def test_supervisor_status(self):
+        supervisor = Supervisor()
+        metric_actors = {'metric1': mock.Mock()}
+        supervisor.watch('metric', 'metric1', metric_actors, mock.Mock(), mock.Mock())
+        with mock.patch('controller.views.supervisor', supervisor), mock.patch('controller.views.metric_actors', metric_actors):
+            request = self.factory.get('/controller/supervisor')
+            response = supervisor_status(request)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            actors = json.loads(response.content)['actors']
+            self.assertEqual([(actor['key'], actor['state'], actor['restarts']) for actor in actors], [('metric1', 'running', 0)])
+            # Stopped actors are not supervised
+            stop_metric('metric1')
+            self.assertEqual(supervisor.status(), [])
+
+    @mock.patch('controller.views.time')
+    def test_rate_limiter(self, mock_time):
+        mock_time.time.return_value = 100.0
+        rate_limiter = RateLimiter(10)
+        for _ in range(3):
+            rate_limiter.wait()
+        delays = [call[0][0] for call in mock_time.sleep.call_args_list]
+        self.assertEqual(len(delays), 2)
+        self.assertAlmostEqual(delays[0], 0.1)
+        self.assertAlmostEqual(delays[1], 0.2)
 
     #
     # static_policy_detail()
@@ -1022,6 +1418,7 @@ class ControllerTestCase(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         json_data = json.loads(response.content)
         self.assertEqual(len(json_data), 0)
+        self.assertFalse(self.r.exists('filter_policies:test-1.0.jar'))
 
     #
     # dynamic_policy_detail()
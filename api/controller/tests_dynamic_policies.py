@@ -1,5 +1,6 @@
 import json
 import os
+import threading
 
 import mock
 import redis
@@ -7,16 +8,24 @@ from django.conf import settings
 from django.test import TestCase, override_settings
 from httmock import urlmatch, HTTMock
 
+from api.events import publish_event
 from controller.dynamic_policies.metrics.bw_info import BwInfo
 from controller.dynamic_policies.metrics.bw_info_ssync import BwInfoSSYNC
 from controller.dynamic_policies.metrics.swift_metric import SwiftMetric
-from controller.dynamic_policies.rules.rule import Rule
+from controller import rule_table
+from controller.dynamic_policies.rules import rule_engine
+from controller.dynamic_policies.rules.conditions import compile_conditions
+from controller.dynamic_policies.rules import rule as rule_module
+from controller.dynamic_policies.rules.rule import Rule, get_dsl_filter
+from controller.dynamic_policies.rules.rule_engine import RuleEngine
 from controller.dynamic_policies.rules.rule_transient import TransientRule
+from controller.dynamic_policies.rules.windows import Window, window_seconds
 from controller.dynamic_policies.rules.sample_bw_controllers.simple_proportional_bandwidth import SimpleProportionalBandwidthPerTenant
 from controller.dynamic_policies.rules.sample_bw_controllers.simple_proportional_replication_bandwidth import SimpleProportionalReplicationBandwidth
 from controller.dynamic_policies.rules.sample_bw_controllers.min_bandwidth_per_tenant import SimpleMinBandwidthPerTenant
 from controller.dynamic_policies.rules.sample_bw_controllers.min_slo_tenant_global_share_spare_bw import MinTenantSLOGlobalSpareBWShare
 from controller.dynamic_policies.rules.sample_bw_controllers.min_slo_tenant_global_share_spare_bw_v2 import MinTenantSLOGlobalSpareBWShare as MinTenantSLOGlobalSpareBWShareV2
+from filters.views import deploy_filter
 from .dsl_parser import parse
 
 
@@ -49,8 +58,7 @@ class DynamicPoliciesTestCase(TestCase):
         self.setup_dsl_parser_data()
         _, parsed_rule = parse('FOR TENANT:4f0279da74ef4584a29dc72c835fe2c9 WHEN metric1 > 5 DO SET compression')
         target = '4f0279da74ef4584a29dc72c835fe2c9'
-        host = None
-        rule = Rule(parsed_rule, parsed_rule.action_list[0], target, host)
+        rule = Rule('policy:10', parsed_rule, parsed_rule.action_list[0], target, self.r)
         self.assertEqual(rule.get_target(), '4f0279da74ef4584a29dc72c835fe2c9')
 
     @mock.patch('controller.dynamic_policies.rules.rule.Rule._do_action')
@@ -58,9 +66,8 @@ class DynamicPoliciesTestCase(TestCase):
         self.setup_dsl_parser_data()
         _, parsed_rule = parse('FOR TENANT:4f0279da74ef4584a29dc72c835fe2c9 WHEN metric1 > 5 DO SET compression')
         target = '4f0279da74ef4584a29dc72c835fe2c9'
-        host = None
-        rule = Rule(parsed_rule, parsed_rule.action_list[0], target, host)
-        rule.update('metric1', 3)
+        rule = Rule('policy:10', parsed_rule, parsed_rule.action_list[0], target, self.r)
+        rule.execute(rule.check_conditions({'metric1': 3}))
         self.assertFalse(mock_do_action.called)
 
     @mock.patch('controller.dynamic_policies.rules.rule.Rule._do_action')
@@ -68,67 +75,205 @@ class DynamicPoliciesTestCase(TestCase):
         self.setup_dsl_parser_data()
         _, parsed_rule = parse('FOR TENANT:4f0279da74ef4584a29dc72c835fe2c9 WHEN metric1 > 5 DO SET compression')
         target = '4f0279da74ef4584a29dc72c835fe2c9'
-        host = None
-        rule = Rule(parsed_rule, parsed_rule.action_list[0], target, host)
-        rule.update('metric1', 6)
+        rule = Rule('policy:10', parsed_rule, parsed_rule.action_list[0], target, self.r)
+        rule.execute(rule.check_conditions({'metric1': 6}))
         self.assertTrue(mock_do_action.called)
 
-    @mock.patch('controller.dynamic_policies.rules.rule.redis.StrictRedis.hgetall')
-    @mock.patch('controller.dynamic_policies.rules.rule.redis.StrictRedis.hset')
+    def test_check_conditions_with_several_metrics(self):
+        self.setup_dsl_parser_data()
+        _, parsed_rule = parse('FOR TENANT:4f0279da74ef4584a29dc72c835fe2c9 WHEN metric1 > 5 AND metric2 < 3 OR metric1 == 1 DO SET compression')
+        rule = Rule('policy:10', parsed_rule, parsed_rule.action_list[0], '4f0279da74ef4584a29dc72c835fe2c9', self.r)
+        self.assertEqual(rule.metrics, {'metric1', 'metric2'})
+        self.assertTrue(rule.check_conditions({'metric1': 6, 'metric2': 2}))
+        self.assertFalse(rule.check_conditions({'metric1': 6, 'metric2': 4}))
+        self.assertTrue(rule.check_conditions({'metric1': 1, 'metric2': 4}))
+
+    @mock.patch('controller.dynamic_policies.rules.rule.get_dsl_filter')
     @mock.patch('controller.dynamic_policies.rules.rule.Rule._admin_login')
-    def test_action_set_is_triggered_deploy_200(self, mock_admin_login, mock_redis_hset, mock_redis_hgetall):
-        mock_redis_hgetall.return_value = {'activation_url': 'http://example.com/filters',
+    def test_action_set_is_triggered_deploy_200(self, mock_admin_login, mock_get_dsl_filter):
+        mock_redis = mock.Mock()
+        mock_get_dsl_filter.return_value = {'activation_url': 'http://example.com/filters',
                                            'identifier': '1',
                                            'valid_parameters': '{"cparam1": "integer", "cparam2": "integer", "cparam3": "integer"}'}
+        mock_redis.hmget.return_value = [None, None]
         self.setup_dsl_parser_data()
         _, parsed_rule = parse('FOR TENANT:4f0279da74ef4584a29dc72c835fe2c9 WHEN metric1 > 5 DO SET compression')
         target = '4f0279da74ef4584a29dc72c835fe2c9'
-        host = None
-        rule = Rule(parsed_rule, parsed_rule.action_list[0], target, host)
-        rule.id = '10'
+        rule = Rule('10', parsed_rule, parsed_rule.action_list[0], target, mock_redis)
         with HTTMock(example_mock_200):
-            rule.update('metric1', 6)
+            finished = rule.execute(rule.check_conditions({'metric1': 6}))
         self.assertTrue(mock_admin_login.called)
-        self.assertTrue(mock_redis_hset.called)
-        mock_redis_hset.assert_called_with('10', 'alive', False)
+        self.assertTrue(mock_redis.hset.called)
+        mock_redis.hset.assert_called_with('10', 'alive', False)
+        self.assertTrue(finished)
 
-    @mock.patch('controller.dynamic_policies.rules.rule.redis.StrictRedis.hgetall')
-    @mock.patch('controller.dynamic_policies.rules.rule.redis.StrictRedis.hset')
+    @mock.patch('controller.dynamic_policies.rules.rule.get_dsl_filter')
     @mock.patch('controller.dynamic_policies.rules.rule.Rule._admin_login')
-    def test_action_set_is_triggered_deploy_400(self, mock_admin_login, mock_redis_hset, mock_redis_hgetall):
-        mock_redis_hgetall.return_value = {'activation_url': 'http://example.com/filters',
+    def test_action_set_is_triggered_deploy_400(self, mock_admin_login, mock_get_dsl_filter):
+        mock_redis = mock.Mock()
+        mock_get_dsl_filter.return_value = {'activation_url': 'http://example.com/filters',
                                            'identifier': '1',
                                            'valid_parameters': '{"cparam1": "integer", "cparam2": "integer", "cparam3": "integer"}'}
         self.setup_dsl_parser_data()
         _, parsed_rule = parse('FOR TENANT:4f0279da74ef4584a29dc72c835fe2c9 WHEN metric1 > 5 DO SET compression')
         target = '4f0279da74ef4584a29dc72c835fe2c9'
-        host = None
-        rule = Rule(parsed_rule, parsed_rule.action_list[0], target, host)
-        rule.id = '10'
+        rule = Rule('10', parsed_rule, parsed_rule.action_list[0], target, mock_redis)
         with HTTMock(example_mock_400):
-            rule.update('metric1', 6)
+            finished = rule.execute(rule.check_conditions({'metric1': 6}))
         self.assertTrue(mock_admin_login.called)
-        self.assertFalse(mock_redis_hset.called)
+        self.assertFalse(mock_redis.hset.called)
+        self.assertFalse(finished)
 
-    @mock.patch('controller.dynamic_policies.rules.rule.redis.StrictRedis.hgetall')
+    @mock.patch('controller.dynamic_policies.rules.rule.get_dsl_filter')
     @mock.patch('controller.dynamic_policies.rules.rule.Rule._admin_login')
-    @mock.patch('controller.dynamic_policies.rules.rule.Rule.stop_actor')
-    def test_action_delete_is_triggered_undeploy_200(self, mock_stop_actor, mock_admin_login, mock_redis_hgetall):
-        mock_redis_hgetall.return_value = {'activation_url': 'http://example.com/filters',
+    def test_action_delete_is_triggered_undeploy_200(self, mock_admin_login, mock_get_dsl_filter):
+        mock_redis = mock.Mock()
+        mock_get_dsl_filter.return_value = {'activation_url': 'http://example.com/filters',
                                            'identifier': '1',
                                            'valid_parameters': '{"cparam1": "integer", "cparam2": "integer", "cparam3": "integer"}'}
+        mock_redis.hmget.return_value = [None, None]
         self.setup_dsl_parser_data()
         _, parsed_rule = parse('FOR TENANT:4f0279da74ef4584a29dc72c835fe2c9 WHEN metric1 > 5 DO SET compression')
         target = '4f0279da74ef4584a29dc72c835fe2c9'
-        host = None
         action = parsed_rule.action_list[0]
         action.action = 'DELETE'
-        rule = Rule(parsed_rule, action, target, host)
-        rule.id = '10'
+        rule = Rule('10', parsed_rule, action, target, mock_redis)
         with HTTMock(example_mock_200):
-            rule.update('metric1', 6)
+            finished = rule.execute(rule.check_conditions({'metric1': 6}))
         self.assertTrue(mock_admin_login.called)
-        self.assertTrue(mock_stop_actor.called)
+        self.assertTrue(finished)
+
+    @mock.patch('controller.dynamic_policies.rules.rule.get_dsl_filter')
+    @mock.patch('controller.dynamic_policies.rules.rule.Rule._admin_login')
+    @mock.patch('controller.dynamic_policies.rules.rule.activation_session')
+    def test_action_set_is_deployed_in_process(self, mock_session, mock_admin_login, mock_get_dsl_filter):
+        self.setup_local_filter_data()
+        mock_get_dsl_filter.return_value = self.r.hgetall('dsl_filter:compression')
+        _, parsed_rule = parse('FOR TENANT:4f0279da74ef4584a29dc72c835fe2c9 WHEN metric1 > 5 DO SET compression')
+        rule = Rule('policy:10', parsed_rule, parsed_rule.action_list[0], '4f0279da74ef4584a29dc72c835fe2c9', self.r)
+        self.assertTrue(rule.execute(rule.check_conditions({'metric1': 6})))
+        self.assertFalse(mock_session.put.called)
+        # No admin token is needed for native filters
+        self.assertFalse(mock_admin_login.called)
+        self.assertEqual(self.r.hkeys('pipeline:AUTH_4f0279da74ef4584a29dc72c835fe2c9'), ['1'])
+        self.assertEqual(self.r.hget('policy:10', 'alive'), 'False')
+
+    @mock.patch('controller.dynamic_policies.rules.rule.get_dsl_filter')
+    @mock.patch('controller.dynamic_policies.rules.rule.activation_session')
+    def test_action_delete_is_undeployed_in_process(self, mock_session, mock_get_dsl_filter):
+        self.setup_local_filter_data()
+        mock_get_dsl_filter.return_value = self.r.hgetall('dsl_filter:compression')
+        _, parsed_rule = parse('FOR TENANT:4f0279da74ef4584a29dc72c835fe2c9 WHEN metric1 > 5 DO SET compression')
+        action = parsed_rule.action_list[0]
+        action.action = 'DELETE'
+        rule = Rule('policy:10', parsed_rule, action, '4f0279da74ef4584a29dc72c835fe2c9', self.r)
+
+        # Not deployed: the rule is not finished
+        self.assertFalse(rule.execute(rule.check_conditions({'metric1': 6})))
+        deploy_filter(self.r, '1', '4f0279da74ef4584a29dc72c835fe2c9', {'object_type': '', 'object_size': '', 'params': ''}, None)
+        self.assertTrue(rule.execute(rule.check_conditions({'metric1': 6})))
+        self.assertFalse(mock_session.put.called)
+        self.assertFalse(self.r.exists('pipeline:AUTH_4f0279da74ef4584a29dc72c835fe2c9'))
+
+    #
+    # rules/conditions
+    #
+
+    def test_compile_conditions(self):
+        check, metrics = compile_conditions([['Metric1', '>', '5'], 'AND', ['metric2', '<=', '3.5'], 'OR', ['metric1', '==', '1']])
+        self.assertEqual(metrics, {'metric1', 'metric2'})
+        self.assertTrue(check({'metric1': 6, 'metric2': 3.5}))
+        self.assertFalse(check({'metric1': 6, 'metric2': 4}))
+        self.assertTrue(check({'metric1': '1', 'metric2': 4}))
+
+    def test_compile_conditions_short_circuits(self):
+        check, _ = compile_conditions([['metric1', '>', '5'], 'AND', ['metric2', '<', '3']])
+        # metric2 is not needed (nor looked up) when the first condition is false
+        self.assertFalse(check({'metric1': 1}))
+        check, _ = compile_conditions([['metric1', '>', '5'], 'OR', ['metric2', '<', '3']])
+        self.assertTrue(check({'metric1': 6}))
+
+    def test_compile_conditions_with_window_functions(self):
+        windows = set()
+        check, metrics = compile_conditions([[['avg', 'Metric1', '30s'], '>', '5'], 'AND', ['metric2', '<', '3']], windows)
+        self.assertEqual(metrics, {'metric1', 'metric2'})
+        self.assertEqual(windows, {('avg', 'metric1', 30)})
+        self.assertTrue(check({('avg', 'metric1', 30): 6, 'metric2': 2}))
+        self.assertFalse(check({('avg', 'metric1', 30): 4, 'metric2': 2}))
+
+    #
+    # rules/windows
+    #
+
+    def test_window_functions(self):
+        self.assertEqual(window_seconds('5m'), 300)
+        samples = [(0, 10), (1, 30), (2, 20), (3, 50), (4, 40)]
+        results = {'avg': 30, 'max': 50, 'min': 10, 'p95': 50, 'rate': 7.5}
+        for function, result in results.items():
+            window = Window(function, 10, 100)
+            for now, value in samples:
+                window.add(now, value)
+            self.assertEqual(window.value(4), result)
+
+    def test_window_discards_old_values(self):
+        window = Window('max', 2, 3)
+        self.assertIsNone(window.value(0))
+        for now, value in [(0, 50), (1, 10), (2, 20), (3, 15)]:
+            window.add(now, value)
+        # 50 is out of the window (2 seconds), and the buffer only keeps 3 values
+        self.assertEqual(window.value(3), 20)
+        self.assertEqual(len(window.samples), 3)
+        self.assertEqual(window.value(5), 15)
+        self.assertIsNone(window.value(10))
+
+        window = Window('avg', 60, 2)
+        for now, value in [(0, 50), (1, 10), (2, 20)]:
+            window.add(now, value)
+        self.assertEqual(window.value(2), 15)
+
+    def test_window_p95_keeps_the_values_sorted(self):
+        window = Window('p95', 10, 20)
+        values = [(i * 37) % 101 for i in range(30)]
+        for now, value in enumerate(values):
+            window.add(now, value)
+        # Only the last 10 seconds (11 values) are in the window
+        self.assertEqual(window.sorted_values, sorted(values[-11:]))
+        self.assertEqual(window.value(29), max(values[-11:]))
+        self.assertEqual(window.value(35), max(values[-5:]))
+        self.assertEqual(window.sorted_values, sorted(values[-5:]))
+
+    def test_window_is_shared_by_threads(self):
+        # One thread adds values while another one reads (and expires) them
+        window = Window('p95', 5, 50)
+        errors = []
+
+        def read():
+            try:
+                for now in range(2000):
+                    window.value(now / 10.0)
+            except Exception as e:
+                errors.append(e)
+        reader = threading.Thread(target=read)
+        reader.start()
+        for now in range(2000):
+            window.add(now / 10.0, now % 97)
+        reader.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(window.sorted_values, sorted(value for _, _, value in window.samples))
+
+    @mock.patch('controller.dynamic_policies.rules.rule.threading.Thread')
+    def test_dsl_filters_are_cached_until_they_change(self, mock_thread):
+        self.addCleanup(setattr, rule_module, '_dsl_filters', None)
+        rule_module._dsl_filters = None
+        self.setup_dsl_parser_data()
+        self.assertEqual(get_dsl_filter(self.r, 'compression')['identifier'], '1')
+        self.assertTrue(mock_thread.return_value.start.called)
+
+        self.r.hset('dsl_filter:compression', 'identifier', '5')
+        self.assertEqual(get_dsl_filter(self.r, 'compression')['identifier'], '1')
+        publish_event(self.r, 'dsl_filter', 'compression')
+        rule_module._dsl_filters.catch_up()
+        self.assertEqual(get_dsl_filter(self.r, 'compression')['identifier'], '5')
 
     #
     # rules/rule_transient
@@ -139,35 +284,213 @@ class DynamicPoliciesTestCase(TestCase):
         self.setup_dsl_parser_data()
         _, parsed_rule = parse('FOR TENANT:4f0279da74ef4584a29dc72c835fe2c9 WHEN metric1 > 5 DO SET compression TRANSIENT')
         target = '4f0279da74ef4584a29dc72c835fe2c9'
-        host = None
-        rule = TransientRule(parsed_rule, parsed_rule.action_list[0], target, host)
-        rule.update('metric1', 6)
+        rule = TransientRule('policy:10', parsed_rule, parsed_rule.action_list[0], target, self.r)
+        rule.execute(rule.check_conditions({'metric1': 6}))
         self.assertTrue(mock_do_action.called)
+        self.assertEqual(self.r.hget('policy:10', 'execution_stat'), 'True')
 
-    @mock.patch('controller.dynamic_policies.rules.rule.redis.StrictRedis.hgetall')
+    @mock.patch('controller.dynamic_policies.rules.rule_transient.get_dsl_filter')
     @mock.patch('controller.dynamic_policies.rules.rule_transient.TransientRule._admin_login')
-    @mock.patch('controller.dynamic_policies.rules.rule_transient.requests.put')
-    @mock.patch('controller.dynamic_policies.rules.rule_transient.requests.delete')
-    def test_transient_action_set_is_triggered_200(self, mock_requests_delete, mock_requests_put, mock_admin_login, mock_redis_hgetall):
-        mock_redis_hgetall.return_value = {'activation_url': 'http://example.com/filters',
-                                           'identifier': '1',
-                                           'valid_parameters': '{"cparam1": "integer", "cparam2": "integer", "cparam3": "integer"}'}
+    @mock.patch('controller.dynamic_policies.rules.rule.activation_session.put')
+    @mock.patch('controller.dynamic_policies.rules.rule.activation_session.delete')
+    def test_transient_action_set_is_triggered_200(self, mock_requests_delete, mock_requests_put, mock_admin_login, mock_get_dsl_filter):
+        mock_requests_put.return_value.status_code = 201
+        mock_requests_put.return_value.content = '7'
+        mock_requests_delete.return_value.status_code = 204
         self.setup_dsl_parser_data()
+        mock_get_dsl_filter.return_value = self.r.hgetall('dsl_filter:compression')
         _, parsed_rule = parse('FOR TENANT:4f0279da74ef4584a29dc72c835fe2c9 WHEN metric1 > 5 DO SET compression TRANSIENT')
         target = '4f0279da74ef4584a29dc72c835fe2c9'
-        host = None
-        rule = TransientRule(parsed_rule, parsed_rule.action_list[0], target, host)
+        rule = TransientRule('policy:10', parsed_rule, parsed_rule.action_list[0], target, self.r)
 
-        rule.update('metric1', 6)
+        rule.execute(rule.check_conditions({'metric1': 6}))
         self.assertTrue(mock_requests_put.called)
         self.assertFalse(mock_requests_delete.called)
         mock_requests_put.reset_mock()
         mock_requests_delete.reset_mock()
         rule.static_policy_id = 'FAKE_ID'
-        rule.update('metric1', 4)
+        rule.execute(rule.check_conditions({'metric1': 4}))
         self.assertFalse(mock_requests_put.called)
         self.assertTrue(mock_requests_delete.called)
 
+    @mock.patch('controller.dynamic_policies.rules.rule_transient.get_dsl_filter')
+    @mock.patch('controller.dynamic_policies.rules.rule.activation_session')
+    def test_transient_action_is_toggled_in_process(self, mock_session, mock_get_dsl_filter):
+        self.setup_local_filter_data()
+        mock_get_dsl_filter.return_value = self.r.hgetall('dsl_filter:compression')
+        _, parsed_rule = parse('FOR TENANT:4f0279da74ef4584a29dc72c835fe2c9 WHEN metric1 > 5 DO SET compression TRANSIENT')
+        rule = TransientRule('policy:10', parsed_rule, parsed_rule.action_list[0], '4f0279da74ef4584a29dc72c835fe2c9', self.r)
+
+        rule.execute(rule.check_conditions({'metric1': 6}))
+        self.assertEqual(rule.static_policy_id, '1')
+        self.assertTrue(self.r.hexists('pipeline:AUTH_4f0279da74ef4584a29dc72c835fe2c9', '1'))
+        rule.execute(rule.check_conditions({'metric1': 4}))
+        self.assertFalse(self.r.hexists('pipeline:AUTH_4f0279da74ef4584a29dc72c835fe2c9', '1'))
+        self.assertFalse(mock_session.put.called)
+        self.assertFalse(mock_session.delete.called)
+
+    @mock.patch('controller.dynamic_policies.rules.rule_transient.TransientRule.do_action')
+    def test_transient_action_is_held_for_some_updates(self, mock_do_action):
+        self.setup_dsl_parser_data()
+        _, parsed_rule = parse('FOR TENANT:4f0279da74ef4584a29dc72c835fe2c9 WHEN metric1 > 5 DO SET compression TRANSIENT HOLD 3 UPDATES')
+        rule = TransientRule('policy:10', parsed_rule, parsed_rule.action_list[0], '4f0279da74ef4584a29dc72c835fe2c9', self.r)
+        for value in [6, 6, 4, 6, 6]:
+            rule.execute(rule.check_conditions({'metric1': value}))
+        self.assertFalse(mock_do_action.called)
+        rule.execute(rule.check_conditions({'metric1': 6}))
+        mock_do_action.assert_called_once_with(True)
+
+    @mock.patch('controller.dynamic_policies.rules.rule_transient.time.time')
+    @mock.patch('controller.dynamic_policies.rules.rule_transient.TransientRule.do_action')
+    def test_transient_action_is_held_for_some_seconds(self, mock_do_action, mock_time):
+        self.setup_dsl_parser_data()
+        _, parsed_rule = parse('FOR TENANT:4f0279da74ef4584a29dc72c835fe2c9 WHEN metric1 > 5 DO SET compression TRANSIENT HOLD 30 SECONDS')
+        rule = TransientRule('policy:10', parsed_rule, parsed_rule.action_list[0], '4f0279da74ef4584a29dc72c835fe2c9', self.r)
+        mock_time.return_value = 1000
+        rule.execute(True)
+        mock_time.return_value = 1029
+        rule.execute(True)
+        self.assertFalse(mock_do_action.called)
+        mock_time.return_value = 1030
+        rule.execute(True)
+        mock_do_action.assert_called_once_with(True)
+
+    @mock.patch('controller.dynamic_policies.rules.rule_transient.TransientRule.do_action')
+    def test_transient_action_is_reverted_until_exit_conditions(self, mock_do_action):
+        self.setup_dsl_parser_data()
+        _, parsed_rule = parse('FOR TENANT:4f0279da74ef4584a29dc72c835fe2c9 WHEN metric1 > 80 DO SET compression TRANSIENT UNTIL metric1 < 60')
+        rule = TransientRule('policy:10', parsed_rule, parsed_rule.action_list[0], '4f0279da74ef4584a29dc72c835fe2c9', self.r)
+        for value in [85, 79, 65, 81]:
+            rule.execute(rule.check_conditions({'metric1': value}), {'metric1': value})
+        mock_do_action.assert_called_once_with(True)
+        rule.execute(rule.check_conditions({'metric1': 59}), {'metric1': 59})
+        mock_do_action.assert_called_with(False)
+        self.assertFalse(rule.execution_stat)
+
+    @mock.patch('controller.dynamic_policies.rules.rule_transient.time.time')
+    @mock.patch('controller.dynamic_policies.rules.rule_transient.TransientRule.do_action')
+    def test_transient_action_toggles_are_limited(self, mock_do_action, mock_time):
+        self.setup_dsl_parser_data()
+        _, parsed_rule = parse('FOR TENANT:4f0279da74ef4584a29dc72c835fe2c9 WHEN metric1 > 5 DO SET compression TRANSIENT MAX 2 TOGGLES PER 60 SECONDS')
+        rule = TransientRule('policy:10', parsed_rule, parsed_rule.action_list[0], '4f0279da74ef4584a29dc72c835fe2c9', self.r)
+        mock_time.return_value = 1000
+        for condition_result in [True, False, True]:
+            rule.execute(condition_result)
+        self.assertEqual(mock_do_action.call_count, 2)
+
+        # The toggles are kept in the policy, so a reloaded rule is limited too
+        rule = TransientRule('policy:10', parsed_rule, parsed_rule.action_list[0], '4f0279da74ef4584a29dc72c835fe2c9', self.r)
+        rule.execute(True)
+        self.assertEqual(mock_do_action.call_count, 2)
+        mock_time.return_value = 1060
+        rule.execute(True)
+        self.assertEqual(mock_do_action.call_count, 3)
+
+    def test_transient_rule_restores_its_state(self):
+        self.setup_dsl_parser_data()
+        _, parsed_rule = parse('FOR TENANT:4f0279da74ef4584a29dc72c835fe2c9 WHEN metric1 > 5 DO SET compression TRANSIENT')
+        self.r.hmset('policy:10', {'execution_stat': True, 'static_policy_id': '3'})
+        rule = TransientRule('policy:10', parsed_rule, parsed_rule.action_list[0], '4f0279da74ef4584a29dc72c835fe2c9', self.r)
+        self.assertTrue(rule.execution_stat)
+        self.assertEqual(rule.static_policy_id, '3')
+
+    #
+    # rules/rule_engine
+    #
+
+    def test_register_rule_with_exit_conditions(self):
+        self.setup_dsl_parser_data()
+        _, parsed_rule = parse('FOR TENANT:0123456789abcdef WHEN metric1 > 80 DO SET compression TRANSIENT UNTIL metric2 < 60')
+        metrics = rule_table.register_rule(self.r, 'policy:21', parsed_rule, '0123456789abcdef')
+        self.assertEqual(metrics, ['metric1', 'metric2'])
+        self.assertEqual(self.r.smembers(rule_table.rule_table_key('metric2', '0123456789abcdef')), {'policy:21'})
+
+    @mock.patch('controller.dynamic_policies.rules.rule.Rule._do_action')
+    def test_rule_engine_evaluates_the_rules_of_each_tenant(self, mock_do_action):
+        self.addCleanup(rule_engine.last_values.clear)
+        self.addCleanup(rule_engine.shared_rules.clear)
+        self.setup_dsl_parser_data()
+        self.create_policy('policy:21', 'FOR TENANT:0123456789abcdef WHEN metric1 > 5 DO SET compression')
+        self.create_policy('policy:22', 'FOR TENANT:0123456789abcdef WHEN metric1 > 5 DO SET encryption')
+        self.create_policy('policy:23', 'FOR TENANT:abcdef0123456789 WHEN metric1 > 5 AND metric2 < 3 DO SET compression')
+        self.create_policy('policy:24', 'FOR TENANT:abcdef0123456789 WHEN metric2 < 3 DO SET compression')
+        engine = RuleEngine('metric1')
+
+        engine.update({'0123456789abcdef': [3]})
+        self.assertEqual(len(engine.conditions['0123456789abcdef']), 1)
+        self.assertFalse(mock_do_action.called)
+        engine.update({'0123456789abcdef': [6]})
+        self.assertEqual(mock_do_action.call_count, 2)
+
+        # policy:24 only uses metric2, and policy:23 needs its value
+        engine.update({'abcdef0123456789': [6]})
+        self.assertEqual(engine.rules['abcdef0123456789'].keys(), ['policy:23'])
+        self.assertEqual(mock_do_action.call_count, 2)
+        rule_engine.last_values[('metric2', 'abcdef0123456789')] = 1
+        engine.update({'abcdef0123456789': [6]})
+        self.assertEqual(mock_do_action.call_count, 3)
+
+    @mock.patch('controller.dynamic_policies.rules.rule.Rule._do_action')
+    def test_rule_engine_evaluates_rules_with_the_updates_of_any_metric(self, mock_do_action):
+        self.addCleanup(rule_engine.last_values.clear)
+        self.addCleanup(rule_engine.shared_rules.clear)
+        self.setup_dsl_parser_data()
+        self.create_policy('policy:21', 'FOR TENANT:0123456789abcdef WHEN metric1 > 5 AND metric2 > 5 DO SET compression')
+        engine1 = RuleEngine('metric1')
+        engine2 = RuleEngine('metric2')
+
+        engine1.update({'0123456789abcdef': [6]})
+        engine2.update({'0123456789abcdef': [1]})
+        self.assertFalse(mock_do_action.called)
+        # The value of metric2 triggers the rule, with the last value of metric1
+        engine2.update({'0123456789abcdef': [6]})
+        self.assertEqual(mock_do_action.call_count, 1)
+        rule = engine1.rules['0123456789abcdef']['policy:21']
+        self.assertIs(engine2.rules['0123456789abcdef']['policy:21'], rule)
+
+        # A rule finished by one engine is not executed by the other
+        rule.finished = True
+        engine1.update({'0123456789abcdef': [6]})
+        self.assertEqual(mock_do_action.call_count, 1)
+        self.assertEqual(engine1.rules['0123456789abcdef'], {})
+        self.assertEqual(rule_engine.shared_rules['policy:21'], (rule, {'metric2'}))
+
+    @mock.patch('controller.dynamic_policies.rules.rule.Rule._do_action')
+    def test_rule_engine_evaluates_window_functions(self, mock_do_action):
+        self.addCleanup(rule_engine.last_values.clear)
+        self.addCleanup(rule_engine.windows.clear)
+        self.addCleanup(rule_engine.shared_rules.clear)
+        self.setup_dsl_parser_data()
+        self.create_policy('policy:21', 'FOR TENANT:0123456789abcdef WHEN avg(metric1, 1m) > 5 DO SET compression')
+        engine = RuleEngine('metric1')
+
+        # A spike does not trigger the rule, a sustained load does
+        engine.update({'0123456789abcdef': [1, 1, 12]})
+        self.assertFalse(mock_do_action.called)
+        engine.update({'0123456789abcdef': [12, 12]})
+        self.assertTrue(mock_do_action.called)
+        self.assertEqual(rule_engine.windows[('metric1', '0123456789abcdef')].keys(), [('avg', 60)])
+
+    def test_rule_engine_discards_deleted_and_idle_rules(self):
+        self.addCleanup(rule_engine.last_values.clear)
+        self.addCleanup(rule_engine.shared_rules.clear)
+        self.setup_dsl_parser_data()
+        self.create_policy('policy:21', 'FOR TENANT:0123456789abcdef WHEN metric1 > 5 DO SET compression')
+        self.create_policy('policy:22', 'FOR TENANT:abcdef0123456789 WHEN metric1 > 5 DO SET compression')
+        engine = RuleEngine('metric1')
+        engine.update({'0123456789abcdef': [1], 'abcdef0123456789': [1]})
+        self.assertEqual(engine.rules['0123456789abcdef'].keys(), ['policy:21'])
+
+        rule_table.unregister_rule(self.r, 'policy:21')
+        engine.update({'0123456789abcdef': [1]})
+        self.assertEqual(engine.rules['0123456789abcdef'], {})
+
+        engine.last_update['abcdef0123456789'] -= settings.RULE_IDLE_TIMEOUT + 1
+        engine.last_passivation = 0
+        engine.update({'0123456789abcdef': [1]})
+        self.assertNotIn('abcdef0123456789', engine.rules)
+        self.assertNotIn(('metric1', 'abcdef0123456789'), rule_engine.last_values)
+
     #
     # metrics/bw_info
     #
@@ -240,6 +563,59 @@ class DynamicPoliciesTestCase(TestCase):
         self.assertTrue(mock_thread.called)
         self.assertIsNone(swift_metric.get_value())
 
+    @mock.patch('controller.dynamic_policies.metrics.swift_metric.timeseries.store')
+    @mock.patch('controller.dynamic_policies.metrics.swift_metric.Thread')
+    def test_metrics_swift_metric_stores_the_values(self, mock_thread, mock_store):
+        swift_metric = SwiftMetric('exchange', 'get_ops', 'routing_key')
+        data = {"controller": {"@timestamp": 123456789, "tenant1#:#AUTH_bd34c4073b65426894545b36f0d8dcce": 3}}
+        swift_metric.notify(json.dumps(data))
+        mock_store.add.assert_called_once_with('get_ops', 'bd34c4073b65426894545b36f0d8dcce', 3, mock.ANY)
+
+    def test_metrics_swift_metric_ping_checks_the_rule_engine(self):
+        swift_metric = SwiftMetric('exchange', 'get_ops', 'routing_key')
+        swift_metric.consumer = mock.Mock()
+        swift_metric.consumer.is_consuming.return_value = True
+        swift_metric.rule_engine = mock.Mock()
+        self.assertTrue(swift_metric.ping())
+        self.assertFalse(swift_metric.rule_engine.ping.called)
+        swift_metric.rule_engine = None
+        self.assertFalse(swift_metric.ping())
+
+    @override_settings(RULE_ENGINE_TIMEOUT=60)
+    @mock.patch('controller.dynamic_policies.metrics.abstract_metric.time.time')
+    def test_metrics_swift_metric_ping_with_busy_or_stalled_rule_engine(self, mock_time):
+        swift_metric = SwiftMetric('exchange', 'get_ops', 'routing_key')
+        swift_metric.consumer = mock.Mock()
+        swift_metric.consumer.is_consuming.return_value = True
+        swift_metric.rule_engine = mock.Mock()
+        rule_engine.heartbeats.pop('get_ops', None)
+        self.addCleanup(rule_engine.heartbeats.pop, 'get_ops', None)
+
+        mock_time.return_value = 1000
+        swift_metric.update_rule_engine({'tenant1': [3]})
+        mock_time.return_value = 1030
+        swift_metric.update_rule_engine({'tenant1': [4]})
+        # Busy with the updates, for less than RULE_ENGINE_TIMEOUT
+        self.assertTrue(swift_metric.ping())
+        # The first update is processed, so the engine is alive, even with the second one pending
+        rule_engine.heartbeats['get_ops'] = 1040
+        mock_time.return_value = 1090
+        self.assertTrue(swift_metric.ping())
+        swift_metric.update_rule_engine({'tenant1': [5]})
+        mock_time.return_value = 1150
+        self.assertTrue(swift_metric.ping())
+        # No update processed for more than RULE_ENGINE_TIMEOUT
+        mock_time.return_value = 1151
+        self.assertFalse(swift_metric.ping())
+
+    def test_rule_engine_update_records_the_heartbeat(self):
+        engine = RuleEngine('get_ops')
+        engine._atom = mock.Mock()
+        engine.update({'tenant1': [3]})
+        self.assertIn('get_ops', rule_engine.heartbeats)
+        engine.stop_actor()
+        self.assertNotIn('get_ops', rule_engine.heartbeats)
+
     @mock.patch('controller.dynamic_policies.metrics.swift_metric.socket.socket')
     def test_metrics_swift_metric_send_data_to_logstash(self, mock_socket):
         swift_metric = SwiftMetric('exchange', 'metric_id', 'routing_key')
@@ -348,6 +724,22 @@ class DynamicPoliciesTestCase(TestCase):
     # Aux methods
     #
 
+    def create_policy(self, policy_key, rule_string):
+        _, parsed_rule = parse(rule_string)
+        self.r.hset(policy_key, 'policy_description', rule_string)
+        rule_table.register_rule(self.r, policy_key, parsed_rule, parsed_rule.target[0][1])
+
+    def setup_local_filter_data(self):
+        # A native filter whose DSL filter is activated by this controller
+        self.r.hmset('filter:1', {'id': '1', 'filter_name': 'compression-1.0.jar', 'filter_type': 'native',
+                                  'path': '/tmp/compression-1.0.jar', 'is_pre_put': 'True', 'is_post_get': 'False',
+                                  'is_pre_get': 'False', 'is_post_put': 'False', 'has_reverse': 'False',
+                                  'execution_server': 'proxy', 'execution_server_reverse': 'proxy'})
+        self.r.hmset('dsl_filter:compression', {'activation_url': settings.LOCAL_ACTIVATION_URLS[0],
+                                                'identifier': '1',
+                                                'valid_parameters': '{"cparam1": "integer", "cparam2": "integer", "cparam3": "integer"}'})
+        self.r.hmset('metric:metric1', {'network_location': '?', 'type': 'integer'})
+
     def setup_dsl_parser_data(self):
         self.r.hmset('dsl_filter:compression', {'activation_url': 'http://example.com/filters',
                                                 'identifier': '1',
@@ -0,0 +1,206 @@
+"""
+Store of the recent values of the workload metrics.
+
+The values received by each metric actor (SwiftMetric.notify) are kept per
+(metric, tenant) in memory, in ring buffers of fixed size with one tier per
+resolution (METRIC_SERIES_TIERS, e.g. 1 hour of 1-second points, 1 day of
+1-minute points and 30 days of 1-hour points). Each point keeps the sum,
+count, min and max of the values of its interval, so adding a value is O(1)
+per tier. The points are kept in typed arrays of 40 bytes per point, so a
+series takes 40 * (sum of the tier sizes) bytes (230 KB with the default
+tiers) and the memory used is bounded by METRIC_SERIES_MAX_SERIES series.
+
+The series are queried with GET /controller/metrics/<name>/series, and they
+can be saved to METRIC_SERIES_SNAPSHOT_FILE when the process exits. The store
+is local to each process: the series only have data in the process that hosts
+the metric actors (the one that started them), so with several API processes
+the requests must reach that one.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class Tier(object):
+    """
+    Ring buffer of the points of a series with a resolution of `step` seconds.
+    The points are kept in typed arrays (one per field, 40 bytes per point).
+    """
+    columns = ('intervals', 'sums', 'counts', 'mins', 'maxs')
+
+    def __init__(self, step, size):
+        self.step = step
+        self.size = size
+        # Interval (time // step) of the point of each slot, which tells if the
+        # slot still holds a point of the last `size` intervals (-1 if empty).
+        self.intervals = array('l', [-1]) * size
+        self.sums = array('d', [0.0]) * size
+        self.counts = array('l', [0]) * size
+        self.mins = array('d', [0.0]) * size
+        self.maxs = array('d', [0.0]) * size
+
+    def add(self, timestamp, value):
+        interval = int(timestamp // self.step)
+        slot = interval % self.size
+        if self.intervals[slot] != interval:
+            self.intervals[slot] = interval
+            self.sums[slot] = self.mins[slot] = self.maxs[slot] = value
+            self.counts[slot] = 1
+        else:
+            self.sums[slot] += value
+            self.counts[slot] += 1
+            self.mins[slot] = min(self.mins[slot], value)
+            self.maxs[slot] = max(self.maxs[slot], value)
+
+    def covers(self, timestamp, now):
+        return int(timestamp // self.step) > int(now // self.step) - self.size
+
+    def query(self, start, end, step):
+        """
+        Returns the points between start and end, merged into intervals of `step`
+        seconds (a multiple of the step of the tier), as
+        [timestamp, average, min, max] lists sorted by time.
+        """
+        first, last = int(start // self.step), int(end // self.step)
+        merged = dict()
+        for slot, interval in enumerate(self.intervals):
+            if not first <= interval <= last:
+                continue
+            bucket = int(interval * self.step // step) * step
+            current = merged.get(bucket)
+            if current is None:
+                merged[bucket] = [self.sums[slot], self.counts[slot], self.mins[slot], self.maxs[slot]]
+            else:
+                current[0] += self.sums[slot]
+                current[1] += self.counts[slot]
+                current[2] = min(current[2], self.mins[slot])
+                current[3] = max(current[3], self.maxs[slot])
+        return [[bucket, total / count, minimum, maximum]
+                for bucket, (total, count, minimum, maximum) in sorted(merged.items())]
+
+    def dump(self):
+        return [getattr(self, column).tolist() for column in self.columns]
+
+    def restore(self, values):
+        if len(values) != len(self.columns) or any(len(column) != self.size for column in values):
+            raise ValueError('Invalid tier of ' + str(self.size) + ' points')
+        for column, column_values in zip(self.columns, values):
+            getattr(self, column)[:] = array(getattr(self, column).typecode, column_values)
+
+
+class TimeSeriesStore(object):
+    """
+    Series of each (metric, tenant). When there are more than max_series, the
+    series updated least recently are discarded.
+    """
+
+    def __init__(self, tiers, max_series):
+        """
+        :param tiers: (step, size) of each tier, from the finest to the coarsest.
+        :param max_series: Maximum number of (metric, tenant) series.
+        """
+        self.tiers = sorted(tuple(tier) for tier in tiers)
+        self.max_series = max_series
+        self.series = OrderedDict()
+        self.lock = threading.Lock()
+        # Whether values were added since the store was created, loaded or saved
+        self.changed = False
+
+    def add(self, metric, tenant, value, timestamp=None):
+        timestamp = timestamp or time.time()
+        value = float(value)
+        key = (metric, tenant)
+        with self.lock:
+            tiers = self.series.pop(key, None)
+            if tiers is None:
+                tiers = [Tier(step, size) for step, size in self.tiers]
+                while len(self.series) >= self.max_series:
+                    self.series.popitem(last=False)
+            # Most recently updated at the end
+            self.series[key] = tiers
+            for tier in tiers:
+                tier.add(timestamp, value)
+            self.changed = True
+
+    def query(self, metric, tenant, start, end=None, step=None):
+        """
+        Returns the points of a series between start and end (now by default).
+        They are taken from the coarsest tier with a step not greater than the
+        requested one (the finest one if there is none, or no step is given)
+        among those that still cover the start, and merged into intervals of
+        the requested step.
+
+        :return: The step of the points and the points, as [timestamp, average, min, max] lists.
+        :rtype: (int, list) tuple
+        """
+        now = time.time()
+        end = end or now
+        with self.lock:
+            tiers = self.series.get((metric, tenant))
+            if tiers is None:
+                return step or self.tiers[0][0], []
+            candidates = [tier for tier in tiers if tier.covers(start, now)] or tiers[-1:]
+            finer = [tier for tier in candidates if step is not None and tier.step <= step]
+            tier = finer[-1] if finer else candidates[0]
+            step = max(tier.step, int(step or tier.step) // tier.step * tier.step)
+            return step, tier.query(start, end, step)
+
+    def tenants(self, metric):
+        with self.lock:
+            return sorted(tenant for series_metric, tenant in self.series if series_metric == metric)
+
+    def save(self, path):
+        """
+        Saves all the series to a file (written to a temporary file and renamed).
+        Nothing is saved if no value was added since the store was created, loaded
+        or saved: every process saves its store when it exits, and only the one
+        that hosts the metric actors receives values, so the others must not
+        overwrite its snapshot.
+        """
+        with self.lock:
+            if not self.changed:
+                return
+            self.changed = False
+            series_count = len(self.series)
+            snapshot = json.dumps({'tiers': self.tiers,
+                                   'series': [[metric, tenant, [tier.dump() for tier in tiers]]
+                                              for (metric, tenant), tiers in self.series.items()]})
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as snapshot_file:
+            snapshot_file.write(snapshot)
+        os.rename(tmp_path, path)
+        logger.info('Metric series saved to ' + path + ': ' + str(series_count) + ' series')
+
+    def load(self, path):
+        """
+        Loads the series saved with save(). The snapshot is ignored if the tiers have changed.
+        """
+        if not os.path.exists(path):
+            return
+        with open(path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        if [tuple(tier) for tier in snapshot['tiers']] != self.tiers:
+            logger.warning('Metric series snapshot ' + path + ' ignored: the tiers have changed')
+            return
+        with self.lock:
+            for metric, tenant, points in snapshot['series'][-self.max_series:]:
+                tiers = [Tier(step, size) for step, size in self.tiers]
+                for tier, tier_points in zip(tiers, points):
+                    tier.restore(tier_points)
+                self.series[(str(metric), str(tenant))] = tiers
+            while len(self.series) > self.max_series:
+                self.series.popitem(last=False)
+        logger.info('Metric series loaded from ' + path + ': ' + str(len(snapshot['series'])) + ' series')
+
+
+store = TimeSeriesStore(settings.METRIC_SERIES_TIERS, settings.METRIC_SERIES_MAX_SERIES)
@@ -6,6 +6,7 @@ urlpatterns = [
 
     url(r'^/metrics/?$', views.add_metric),
     url(r'^/metrics/(?P<name>\w+)/?$', views.metric_detail),
+    url(r'^/metrics/(?P<name>\w+)/series/?$', views.metric_series),
 
     url(r'^/metric_module/?$', views.metric_module_list),
     url(r'^/metric_module/data/?$', views.MetricModuleData.as_view()),
@@ -32,6 +33,17 @@ urlpatterns = [
     url(r'^/object_type/?$', views.object_type_list),
     url(r'^/object_type/(?P<object_type_name>\w+)/?$', views.object_type_detail),
 
+    url(r'^/artifacts/(?P<collection>\w+)/manifest/?$', views.artifact_manifest),
+    url(r'^/artifacts/(?P<collection>\w+)/(?P<md5_hash>[0-9a-f]{32})/?$', views.artifact_data),
+
+    url(r'^/ready/?$', views.controller_ready),
+    url(r'^/redis_pool/?$', views.redis_pool_stats),
+    url(r'^/supervisor/?$', views.supervisor_status),
+
+    url(r'^/jobs/?$', views.job_list),
+    url(r'^/jobs/(?P<job_id>\d+)/?$', views.job_detail),
+    url(r'^/jobs/(?P<job_id>\d+)/log/?$', views.job_log),
+
     url(r'^/global_controllers/?$', views.global_controller_list),
     url(r'^/global_controllers/data/?$', views.GlobalControllerData.as_view()),
     url(r'^/global_controller/(?P<controller_id>\w+)/data/?$', views.GlobalControllerData.as_view()),
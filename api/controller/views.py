@@ -1,15 +1,16 @@
 import json
 import logging
-import mimetypes
 import os
 import re
+import socket
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 from operator import itemgetter
 from eventlet import sleep
 
 from django.conf import settings
-from django.core.servers.basehttp import FileWrapper
 from django.http import HttpResponse
-from django.http import StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from redis.exceptions import RedisError, DataError
 from rest_framework import status
@@ -18,67 +19,210 @@ from rest_framework.parsers import JSONParser, MultiPartParser, FormParser
 from rest_framework.views import APIView
 
 import dsl_parser
+import rule_table
+import timeseries
+from supervisor import supervisor
 from api.common_utils import get_token_connection, rsync_dir_with_nodes, to_json_bools, remove_extra_whitespaces, JSONResponse, get_redis_connection, \
-    get_project_list, create_local_host
-from api.exceptions import SwiftClientError, StorletNotFoundException, FileSynchronizationException
-from filters.views import save_file, make_sure_path_exists
-from filters.views import set_filter, unset_filter
+    get_project_list, create_local_host, update_manifest, file_response
+from api import jobs
+from api.events import publish_event
+from api.exceptions import SwiftClientError, StorletNotFoundException, FileSynchronizationException, FileTooLargeException
+from filters.views import save_file, make_sure_path_exists, check_upload_size
+from filters.views import set_filter, unset_filter, delete_static_policy, compile_pipeline, upload_storlet_to_accounts
 
 logger = logging.getLogger(__name__)
 
 controller_actors = dict()
 metric_actors = dict()
-rule_actors = dict()
 
 
-def load_metrics():
+# Progress of the actor restoration in this host (see restore_actors and api/startup.py)
+STARTUP_STATUS_KEY = 'startup:status:' + socket.gethostname()
+
+
+class RateLimiter(object):
+    """
+    Spaces the calls to wait() at least 1/rate seconds apart, across threads.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def spawn_actors(r, kind, tasks):
+    """
+    Runs the actor start functions in `tasks` (list of (key, function) pairs) in parallel, with
+    at most ACTOR_SPAWN_WORKERS at a time and ACTOR_SPAWN_RATE per second, and counts them in the
+    startup status (<kind>_started / <kind>_failed).
+    """
+    if not tasks:
+        return
+    rate_limiter = RateLimiter(settings.ACTOR_SPAWN_RATE)
+
+    def spawn(task):
+        key, start = task
+        rate_limiter.wait()
+        try:
+            start()
+        except Exception as e:
+            logger.error("Could not start actor " + str(key) + ": " + str(e))
+            r.hincrby(STARTUP_STATUS_KEY, kind + '_failed', 1)
+        else:
+            r.hincrby(STARTUP_STATUS_KEY, kind + '_started', 1)
+
+    pool = ThreadPool(min(settings.ACTOR_SPAWN_WORKERS, len(tasks)))
+    try:
+        pool.map(spawn, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def load_metrics(metric_keys=None):
+    """
+    Starts the actors of the enabled workload metrics, or of the given workload_metric:<id> keys.
+    """
     try:
         r = get_redis_connection()
     except RedisError:
         return JSONResponse('Error connecting with DB', status=500)
 
-    workload_metrics = r.keys("workload_metric:*")
+    restore = metric_keys is not None
+    if not restore:
+        metric_keys = r.keys("workload_metric:*")
+    pipe = r.pipeline(transaction=False)
+    for key in metric_keys:
+        pipe.hgetall(key)
+    workload_metrics = [(key, wm_data) for key, wm_data in zip(metric_keys, pipe.execute())
+                        if wm_data and (restore or wm_data['enabled'] == 'True')]
 
     if workload_metrics:
         logger.info("Starting workload metrics")
 
-    for wm in workload_metrics:
-        wm_data = r.hgetall(wm)
-        if wm_data['enabled'] == 'True':
+    def metric_starter(key, wm_data):
+        def start():
             actor_id = wm_data['metric_name'].split('.')[0]
             metric_id = int(wm_data['id'])
             start_metric(metric_id, actor_id)
+            r.hset(key, 'enabled', True)
+        return start
+
+    r.hset(STARTUP_STATUS_KEY, 'metrics_total', len(workload_metrics))
+    spawn_actors(r, 'metrics', [(key, metric_starter(key, wm_data)) for key, wm_data in workload_metrics])
 
 
-def load_policies():
+def load_policies(policy_keys=None):
+    """
+    Registers the rules of the alive dynamic policies, or of the given policy:<id> keys,
+    in the rule table, from where the rule engines of the metrics load them.
+    """
     try:
         r = get_redis_connection()
     except RedisError:
         return JSONResponse('Error connecting with DB', status=500)
 
-    dynamic_policies = r.keys("policy:*")
+    restore = policy_keys is not None
+    if not restore:
+        policy_keys = r.keys("policy:*")
+    pipe = r.pipeline(transaction=False)
+    for key in policy_keys:
+        pipe.hgetall(key)
+    dynamic_policies = [(key, policy_data) for key, policy_data in zip(policy_keys, pipe.execute())
+                        if policy_data and (restore or policy_data['alive'] == 'True')]
 
     if dynamic_policies:
-        logger.info("Starting dynamic rules stored in redis")
+        logger.info("Registering dynamic rules stored in redis")
 
-    host = create_local_host()
-    for policy in dynamic_policies:
-        policy_data = r.hgetall(policy)
-
-        if policy_data['alive'] == 'True':
-            _, rule_parsed = dsl_parser.parse(policy_data['policy_description'])
-            target = rule_parsed.target[0][1]  # Tenant ID or tenant+container
-            for action_info in rule_parsed.action_list:
-                if action_info.transient:
-                    logger.info("Transient rule: " + policy_data['policy_description'])
-                    rule_actors[policy] = host.spawn_id(str(policy), settings.RULE_TRANSIENT_MODULE, settings.RULE_TRANSIENT_CLASS,
-                                                  [rule_parsed, action_info, target, host])
-                    rule_actors[policy].start_rule()
-                else:
-                    logger.info("Rule: "+policy_data['policy_description'])
-                    rule_actors[policy] = host.spawn_id(str(policy), settings.RULE_MODULE, settings.RULE_CLASS,
-                                                  [rule_parsed, action_info, target, host])
-                    rule_actors[policy].start_rule()
+    # The rules are parsed with the same grammar, and registered in a single pipeline
+    grammar = dsl_parser.get_grammar(r)
+    pipe = r.pipeline()
+    failed = 0
+    for policy, policy_data in dynamic_policies:
+        try:
+            _, rule_parsed = dsl_parser.parse(policy_data['policy_description'], grammar)
+            target = policy_data.get('target') or rule_parsed.target[0][1]  # Tenant ID or tenant+container
+            rule_table.register_rule(pipe, policy, rule_parsed, target, int(policy_data.get('action_index', 0)))
+        except Exception as e:
+            logger.error("Could not register rule " + str(policy) + ": " + str(e))
+            failed += 1
+    pipe.execute()
+
+    r.hmset(STARTUP_STATUS_KEY, {'policies_total': len(dynamic_policies),
+                                 'policies_started': len(dynamic_policies) - failed,
+                                 'policies_failed': failed})
+
+
+def restore_actors(metric_keys, policy_keys):
+    """
+    Starts again the actors that were running before a restart, and records the progress
+    in the startup status returned by the readiness endpoint.
+    """
+    r = get_redis_connection()
+    r.hmset(STARTUP_STATUS_KEY, {'state': 'restoring'})
+    try:
+        load_metrics(metric_keys)
+        load_policies(policy_keys)
+    finally:
+        r.hmset(STARTUP_STATUS_KEY, {'state': 'ready', 'finished_at': time.time()})
+        logger.info("Controller ready: actors restored")
+
+
+@csrf_exempt
+def controller_ready(request):
+    """
+    Readiness of the controller: 200 once the actors running before the last restart
+    have been restored, 503 (with the progress) while they are being restored. Hosts
+    that do not restore actors (RESTORE_ACTORS_ON_STARTUP) are always ready.
+    """
+    try:
+        r = get_redis_connection()
+    except RedisError:
+        return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    if request.method == 'GET':
+        startup_status = r.hgetall(STARTUP_STATUS_KEY) or {'state': 'ready'}
+        for field, value in startup_status.items():
+            if field.endswith(('_total', '_started', '_failed')):
+                startup_status[field] = int(value)
+        code = status.HTTP_200_OK if startup_status['state'] == 'ready' else status.HTTP_503_SERVICE_UNAVAILABLE
+        return JSONResponse(startup_status, status=code)
+
+    return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+@csrf_exempt
+def redis_pool_stats(request):
+    """
+    Usage of the Redis connection pool of this process.
+    """
+    if request.method == 'GET':
+        pool = settings.REDIS_CON_POOL
+        if not hasattr(pool, 'stats'):
+            return JSONResponse('The Redis connection pool is not monitored', status=status.HTTP_404_NOT_FOUND)
+        return JSONResponse(pool.stats(), status=status.HTTP_200_OK)
+
+    return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+@csrf_exempt
+def supervisor_status(request):
+    """
+    Actors supervised in this process, with their state and restart count.
+    """
+    if request.method == 'GET':
+        return JSONResponse({'enabled': settings.SUPERVISE_ACTORS, 'actors': supervisor.status()}, status=status.HTTP_200_OK)
+
+    return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
 
 #
@@ -115,6 +259,7 @@ def add_metric(request):
         if not name:
             return JSONResponse('Metric must have a name', status=400)
         r.hmset('metric:' + str(name), data)
+        publish_event(r, 'metric', name)
         return JSONResponse('Metric has been added in the registry', status=201)
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=405)
 
@@ -140,15 +285,46 @@ def metric_detail(request, name):
 
         data = JSONParser().parse(request)
         r.hmset('metric:' + str(name), data)
+        publish_event(r, 'metric', name)
         return JSONResponse('The metadata of the metric workload with name: ' + str(name) + ' has been updated',
                             status=201)
 
     if request.method == 'DELETE':
         r.delete("metric:" + str(name))
+        publish_event(r, 'metric', name)
         return JSONResponse('Metric workload has been deleted', status=204)
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=405)
 
 
+@csrf_exempt
+def metric_series(request, name):
+    """
+    Recent values of a workload metric for a tenant, kept by this controller (see timeseries.py).
+    Query parameters: tenant, from and to (UNIX timestamps, the last hour by default) and step (seconds).
+    Without tenant, the tenants with values are listed. The values are only kept by the process
+    that hosts the metric actors, so the other processes return no data.
+    """
+    if request.method == 'GET':
+        tenant = request.GET.get('tenant')
+        if not tenant:
+            return JSONResponse({'metric': name, 'tenants': timeseries.store.tenants(name)}, status=status.HTTP_200_OK)
+        try:
+            now = time.time()
+            start = float(request.GET.get('from', now - 3600))
+            end = float(request.GET.get('to', now))
+            step = int(request.GET['step']) if 'step' in request.GET else None
+        except ValueError:
+            return JSONResponse('Invalid from, to or step', status=status.HTTP_400_BAD_REQUEST)
+        if step is not None and step <= 0:
+            return JSONResponse('Invalid from, to or step', status=status.HTTP_400_BAD_REQUEST)
+
+        step, points = timeseries.store.query(name, tenant, start, end, step)
+        return JSONResponse({'metric': name, 'tenant': tenant, 'step': step,
+                             'columns': ['timestamp', 'avg', 'min', 'max'], 'points': points}, status=status.HTTP_200_OK)
+
+    return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
 #
 # Dynamic Filters part
 #
@@ -180,6 +356,7 @@ def add_dynamic_filter(request):
         if not name:
             return JSONResponse('Filter must have a name', status=400)
         r.hmset('dsl_filter:' + str(name), data)
+        publish_event(r, 'dsl_filter', name)
         return JSONResponse('Filter has been added to the registy', status=201)
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=405)
 
@@ -206,6 +383,7 @@ def dynamic_filter_detail(request, name):
         if 'name' in data:
             del data['name']
         r.hmset('dsl_filter:' + str(name), data)
+        publish_event(r, 'dsl_filter', name)
         return JSONResponse('The metadata of the dynamic filter with name: ' + str(name) + ' has been updated',
                             status=status.HTTP_201_CREATED)
 
@@ -213,14 +391,11 @@ def dynamic_filter_detail(request, name):
         filter_id = r.hget('dsl_filter:' + str(name), 'identifier')
         filter_name = r.hget('filter:' + str(filter_id), 'filter_name')
 
-        keys = r.keys("pipeline:AUTH_*")
-        for it in keys:
-            for value in r.hgetall(it).values():
-                json_value = json.loads(value)
-                if json_value['filter_name'] == filter_name:
-                    return JSONResponse('Unable to delete Registry DSL, is in use by some policy.', status=status.HTTP_403_FORBIDDEN)
+        if r.scard("filter_policies:" + str(filter_name)):
+            return JSONResponse('Unable to delete Registry DSL, is in use by some policy.', status=status.HTTP_403_FORBIDDEN)
 
         r.delete("dsl_filter:" + str(name))
+        publish_event(r, 'dsl_filter', name)
         return JSONResponse('Dynamic filter has been deleted', status=status.HTTP_204_NO_CONTENT)
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
@@ -259,12 +434,21 @@ def start_metric(metric_id, actor_id):
             metric_actors[metric_id] = host.spawn_id(actor_id, settings.METRIC_MODULE, settings.METRIC_CLASS,
                                                ["amq.topic", actor_id, "metrics." + actor_id])
             metric_actors[metric_id].init_consum()
+            supervisor.watch('metric', metric_id, metric_actors, lambda: start_metric(metric_id, actor_id), restart_metric)
     except Exception as e:
         logger.error(str(e))
         print e
 
 
+def restart_metric(metric_actor):
+    """
+    Stops a failed metric actor, keeping its rules to be evaluated by the new one.
+    """
+    metric_actor.stop_actor(True)
+
+
 def stop_metric(metric_id):
+    supervisor.unwatch('metric', metric_id)
     if metric_id in metric_actors:
         logger.info("Metric, Stopping workload metric actor " + str(metric_id))
         metric_actors[metric_id].stop_actor()
@@ -310,6 +494,7 @@ def metric_module_detail(request, metric_module_id):
 
         try:
             r.hmset('workload_metric:' + str(metric_id), data)
+            publish_event(r, 'workload_metric', metric_id)
             return JSONResponse("Data updated", status=status.HTTP_200_OK)
         except DataError:
             return JSONResponse("Error updating data", status=status.HTTP_408_REQUEST_TIMEOUT)
@@ -322,6 +507,7 @@ def metric_module_detail(request, metric_module_id):
             r.delete("workload_metric:" + str(metric_id))
             keys = len(r.keys("workload_metric:*"))
             r.set('workload_metrics:id', keys)
+            publish_event(r, 'workload_metric', metric_id)
 
             return JSONResponse('Workload metric has been deleted', status=status.HTTP_204_NO_CONTENT)
         except DataError:
@@ -342,6 +528,11 @@ class MetricModuleData(APIView):
         except RedisError:
             return JSONResponse('Error connecting with DB', status=500)
 
+        try:
+            check_upload_size(request)
+        except FileTooLargeException as e:
+            return JSONResponse(e.message, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
         data = json.loads(request.POST['metadata'])  # json data is in metadata parameter for this request
         if not data:
             return JSONResponse("Invalid format or empty request", status=status.HTTP_400_BAD_REQUEST)
@@ -360,10 +551,10 @@ class MetricModuleData(APIView):
             try:
                 rsync_dir_with_nodes(settings.WORKLOAD_METRICS_DIR)
             except FileSynchronizationException as e:
-                # print "FileSynchronizationException", e  # TODO remove
-                return JSONResponse(e.message, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+                return JSONResponse({'message': e.message, 'nodes': e.results}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
             r.hmset('workload_metric:' + str(workload_metric_id), data)
+            publish_event(r, 'workload_metric', workload_metric_id)
 
             if data['enabled']:
                 actor_id = data['metric_name'].split('.')[0]
@@ -371,6 +562,8 @@ class MetricModuleData(APIView):
 
             return JSONResponse(data, status=status.HTTP_201_CREATED)
 
+        except FileTooLargeException as e:
+            return JSONResponse(e.message, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
         except DataError:
             return JSONResponse("Error to save the object", status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
@@ -388,16 +581,8 @@ class MetricModuleData(APIView):
             workload_metric_path = os.path.join(settings.WORKLOAD_METRICS_DIR,
                                                 str(r.hget('workload_metric:' + str(metric_module_id), 'metric_name')))
             if os.path.exists(workload_metric_path):
-                workload_metric_name = os.path.basename(workload_metric_path)
-                workload_metric_size = os.stat(workload_metric_path).st_size
-
-                # Generate response
-                response = StreamingHttpResponse(FileWrapper(open(workload_metric_path), workload_metric_size),
-                                                 content_type=mimetypes.guess_type(workload_metric_path)[0])
-                response['Content-Length'] = workload_metric_size
-                response['Content-Disposition'] = "attachment; filename=%s" % workload_metric_name
-
-                return response
+                files, _ = update_manifest(r, settings.WORKLOAD_METRICS_DIR)
+                return file_response(request, workload_metric_path, files.get(os.path.basename(workload_metric_path)))
             else:
                 return HttpResponse(status=status.HTTP_404_NOT_FOUND)
         else:
@@ -435,6 +620,7 @@ def list_storage_node(request):
         sn_id = r.incr("storage_nodes:id")
         data = JSONParser().parse(request)
         r.hmset('SN:' + str(sn_id), data)
+        publish_event(r, 'storage_node', sn_id)
         return JSONResponse('Storage node has been added to the registry', status=201)
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=405)
 
@@ -459,11 +645,13 @@ def storage_node_detail(request, snode_id):
             return JSONResponse('Storage node with name:  ' + str(snode_id) + ' not exists.', status=404)
         data = JSONParser().parse(request)
         r.hmset('SN:' + str(snode_id), data)
+        publish_event(r, 'storage_node', snode_id)
         return JSONResponse('The metadata of the storage node with name: ' + str(snode_id) + ' has been updated',
                             status=201)
 
     if request.method == 'DELETE':
         r.delete("SN:" + str(snode_id))
+        publish_event(r, 'storage_node', snode_id)
         return JSONResponse('Storage node has been deleted', status=204)
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=405)
 
@@ -499,6 +687,7 @@ def add_tenants_group(request):
                                 status=status.HTTP_400_BAD_REQUEST)
         gtenant_id = r.incr("gtenant:id")
         r.rpush('G:' + str(gtenant_id), *data)
+        publish_event(r, 'tenant_group', gtenant_id)
         return JSONResponse('Tenant group has been added to the registry', status=status.HTTP_201_CREATED)
 
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
@@ -533,6 +722,7 @@ def tenants_group_detail(request, gtenant_id):
             pipe = r.pipeline()
             # the following commands are buffered in a single atomic request (to replace current contents)
             if pipe.delete(key).rpush(key, *data).execute():
+                publish_event(r, 'tenant_group', gtenant_id)
                 return JSONResponse('The members of the tenants group with id: ' + str(gtenant_id) + ' has been updated', status=status.HTTP_201_CREATED)
             return JSONResponse('Error storing the tenant group in the DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         else:
@@ -542,6 +732,7 @@ def tenants_group_detail(request, gtenant_id):
         key = 'G:' + str(gtenant_id)
         if r.exists(key):
             r.delete("G:" + str(gtenant_id))
+            publish_event(r, 'tenant_group', gtenant_id)
             return JSONResponse('Tenants group has been deleted', status=status.HTTP_204_NO_CONTENT)
         else:
             return JSONResponse('The tenant group with id:  ' + str(gtenant_id) + ' does not exist.', status=status.HTTP_404_NOT_FOUND)
@@ -559,6 +750,7 @@ def gtenants_tenant_detail(request, gtenant_id, tenant_id):
         return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     if request.method == 'DELETE':
         r.lrem("G:" + str(gtenant_id), str(tenant_id), 1)
+        publish_event(r, 'tenant_group', gtenant_id)
         return JSONResponse('Tenant ' + str(tenant_id) + ' has been deleted from group with the id: ' + str(gtenant_id),
                             status=status.HTTP_204_NO_CONTENT)
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
@@ -600,6 +792,7 @@ def object_type_list(request):
                                 status=status.HTTP_400_BAD_REQUEST)
 
         if r.rpush('object_type:' + str(name), *data["types_list"]):
+            publish_event(r, 'object_type', name)
             return JSONResponse('Object type has been added in the registy', status=status.HTTP_201_CREATED)
         return JSONResponse('Error storing the object type in the DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -638,6 +831,7 @@ def object_type_detail(request, object_type_name):
         pipe = r.pipeline()
         # the following commands are buffered in a single atomic request (to replace current contents)
         if pipe.delete(key).rpush(key, *data).execute():
+            publish_event(r, 'object_type', object_type_name)
             return JSONResponse('The object type ' + str(object_type_name) + ' has been updated',
                                 status=status.HTTP_201_CREATED)
         return JSONResponse('Error storing the object type in the DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -645,6 +839,7 @@ def object_type_detail(request, object_type_name):
     if request.method == "DELETE":
         if r.exists(key):
             object_type = r.delete(key)
+            publish_event(r, 'object_type', object_type_name)
             return JSONResponse(object_type, status=status.HTTP_200_OK)
         return JSONResponse("Object type not found", status=status.HTTP_404_NOT_FOUND)
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
@@ -662,6 +857,7 @@ def object_type_items_detail(request, object_type_name, item_name):
         return JSONResponse('Error connecting with DB', status=500)
     if request.method == 'DELETE':
         r.lrem("object_type:" + str(object_type_name), str(item_name), 1)
+        publish_event(r, 'object_type', object_type_name)
         return JSONResponse('Extension ' + str(item_name) + ' has been deleted from object type ' + str(object_type_name),
                             status=204)
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=405)
@@ -777,13 +973,21 @@ def static_policy_detail(request, policy_id):
         try:
             policy_redis = r.hget("pipeline:AUTH_" + str(target), policy)
             json_data = json.loads(policy_redis)
+            old_filter_name = json_data['filter_name']
             json_data.update(data)
-            r.hset("pipeline:AUTH_" + str(target), policy, json.dumps(json_data))
+            pipe = r.pipeline()
+            pipe.hset("pipeline:AUTH_" + str(target), policy, json.dumps(json_data))
+            if json_data['filter_name'] != old_filter_name:
+                pipe.srem("filter_policies:" + str(old_filter_name), target + ":" + policy)
+                pipe.sadd("filter_policies:" + str(json_data['filter_name']), target + ":" + policy)
+            pipe.execute()
+            pipeline_doc = compile_pipeline(r, target)
+            publish_event(r, 'static_policy', policy, target, pipeline_doc['version'])
             return JSONResponse("Data updated", status=201)
         except DataError:
             return JSONResponse("Error updating data", status=400)
     elif request.method == 'DELETE':
-        r.hdel('pipeline:AUTH_' + target, policy)
+        delete_static_policy(r, target, policy)
         return JSONResponse('Policy has been deleted', status=status.HTTP_204_NO_CONTENT)
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
@@ -800,19 +1004,12 @@ def dynamic_policy_detail(request, policy_id):
         return JSONResponse('Error connecting with DB', status=500)
 
     if request.method == 'DELETE':
-        create_local_host()
-
-        try:
-            rule_actors[int(policy_id)].stop_actor()
-            del rule_actors[int(policy_id)]
-        except Exception as e:
-            logger.error(str(e))
-            print e
-
+        rule_table.unregister_rule(r, 'policy:' + policy_id)
         r.delete('policy:' + policy_id)
         policies_ids = r.keys('policy:*')
         if len(policies_ids) == 0:
             r.set('policies:id', 0)
+        publish_event(r, 'dynamic_policy', policy_id)
         return JSONResponse('Policy has been deleted', status=204)
 
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=405)
@@ -821,6 +1018,16 @@ def dynamic_policy_detail(request, policy_id):
 def do_action(request, r, rule_parsed):
     token = get_token_connection(request)
 
+    # Upload the storlets of the SET actions to all the target accounts concurrently,
+    # instead of one account at a time from set_filter
+    accounts = [target[1].split('/', 3)[0] for target in rule_parsed.target]
+    for action_info in rule_parsed.action_list:
+        if action_info.action == "SET":
+            dynamic_filter = r.hgetall("dsl_filter:" + str(action_info.filter))
+            filter_data = r.hgetall("filter:" + dynamic_filter["identifier"])
+            if filter_data and filter_data['filter_type'] == 'storlet':
+                upload_storlet_to_accounts(token, filter_data, accounts)
+
     for target in rule_parsed.target:
         for action_info in rule_parsed.action_list:
             logger.info("TARGET RULE: " + action_info)
@@ -860,7 +1067,7 @@ def do_action(request, r, rule_parsed):
                     policy_data["callable"] = True
 
                 # Deploy (an exception is raised if something goes wrong)
-                set_filter(r, target[1], filter_data, policy_data, token)
+                set_filter(r, target[1], filter_data, policy_data, token, upload=False)
 
             elif action_info.action == "DELETE":
                 undeploy_response = unset_filter(r, target[1], filter_data, token)
@@ -869,32 +1076,23 @@ def do_action(request, r, rule_parsed):
 
 
 def deploy_policy(r, rule_string, parsed_rule):
-    host = create_local_host()
-    rules_to_parse = dict()
-
-    for target in parsed_rule.target:
-        rules_to_parse[target[1]] = parsed_rule
-
-    for key in rules_to_parse.keys():
-        for action_info in rules_to_parse[key].action_list:
+    """
+    Creates a dynamic policy for each target and action of the rule, and registers
+    them in the rule table. They are evaluated by the rule engines of their metrics
+    (see rule_table).
+    """
+    for target in set(target[1] for target in parsed_rule.target):
+        for action_index, action_info in enumerate(parsed_rule.action_list):
             policy_id = r.incr("policies:id")
             rule_id = 'policy:' + str(policy_id)
 
             if action_info.transient:
-                # print 'Transient rule:', parsed_rule
-                rule_actors[policy_id] = host.spawn_id(rule_id, settings.RULE_TRANSIENT_MODULE, settings.RULE_TRANSIENT_CLASS,
-                                                 [rules_to_parse[key], action_info, key, host])
                 location = os.path.join(settings.RULE_TRANSIENT_MODULE, settings.RULE_TRANSIENT_CLASS)
                 is_transient = True
             else:
-                # print 'Rule:', parsed_rule
-                rule_actors[policy_id] = host.spawn_id(rule_id, settings.RULE_MODULE, settings.RULE_CLASS,
-                                                 [rules_to_parse[key], action_info, key, host])
                 location = os.path.join(settings.RULE_MODULE, settings.RULE_CLASS)
                 is_transient = False
 
-                rule_actors[policy_id].start_rule()
-
             # FIXME Should we recreate a static rule for each target and action??
             condition_re = re.compile(r'.* (WHEN .*) DO .*', re.M | re.I)
             condition_str = condition_re.match(rule_string).group(1)
@@ -904,13 +1102,145 @@ def deploy_policy(r, rule_string, parsed_rule):
 
             # Add policy into redis
             policy_location = os.path.join(settings.PYACTIVE_URL, location, str(rule_id))
-            r.hmset('policy:' + str(policy_id), {"id": policy_id,
-                                                 "policy": static_policy_rule_string,
-                                                 "policy_description": rule_string,
-                                                 "condition": condition_str.replace('WHEN ', ''),
-                                                 "transient": is_transient,
-                                                 "policy_location": policy_location,
-                                                 "alive": True})
+            r.hmset(rule_id, {"id": policy_id,
+                              "policy": static_policy_rule_string,
+                              "policy_description": rule_string,
+                              "condition": condition_str.replace('WHEN ', ''),
+                              "transient": is_transient,
+                              "policy_location": policy_location})
+            rule_table.register_rule(r, rule_id, parsed_rule, target, action_index)
+            publish_event(r, 'dynamic_policy', policy_id, target)
+
+
+#
+# Artifacts (files synchronized with the Swift nodes)
+#
+
+
+@csrf_exempt
+def artifact_manifest(request, collection):
+    """
+    Get the manifest of an artifact collection: its version and the md5 of each file.
+    Nodes can send the version they have in If-None-Match to skip the synchronization when it is current.
+    """
+    if collection not in settings.ARTIFACT_COLLECTIONS:
+        return JSONResponse('Artifact collection ' + str(collection) + ' does not exist.', status=status.HTTP_404_NOT_FOUND)
+
+    try:
+        r = get_redis_connection()
+    except RedisError:
+        return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    if request.method == 'GET':
+        files, version = update_manifest(r, settings.ARTIFACT_COLLECTIONS[collection])
+        etag = '"' + str(version) + '"'
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = JSONResponse({'version': version, 'files': files}, status=status.HTTP_200_OK)
+        response['ETag'] = etag
+        return response
+
+    return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+@csrf_exempt
+def artifact_data(request, collection, md5_hash):
+    """
+    Download the file of an artifact collection with the given md5.
+    """
+    if collection not in settings.ARTIFACT_COLLECTIONS:
+        return JSONResponse('Artifact collection ' + str(collection) + ' does not exist.', status=status.HTTP_404_NOT_FOUND)
+
+    try:
+        r = get_redis_connection()
+    except RedisError:
+        return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    if request.method == 'GET':
+        directory = settings.ARTIFACT_COLLECTIONS[collection]
+        files, _ = update_manifest(r, directory)
+        for name, file_md5 in files.items():
+            if file_md5 == md5_hash:
+                return file_response(request, os.path.join(directory, name), file_md5)
+        return HttpResponse(status=status.HTTP_404_NOT_FOUND)
+
+    return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+#
+# Background jobs (see api/jobs.py)
+#
+
+
+@csrf_exempt
+def job_list(request):
+    """
+    List the last jobs, newest first (?count=<n>, 100 by default).
+    """
+    try:
+        r = get_redis_connection()
+    except RedisError:
+        return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    if request.method == 'GET':
+        try:
+            count = int(request.GET.get('count', 100))
+        except ValueError:
+            return JSONResponse('Invalid count', status=status.HTTP_400_BAD_REQUEST)
+        return JSONResponse(jobs.list_jobs(r, count), status=status.HTTP_200_OK)
+
+    return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+@csrf_exempt
+def job_detail(request, job_id):
+    """
+    GET: Status of a job. DELETE: Cancel it.
+    """
+    try:
+        r = get_redis_connection()
+    except RedisError:
+        return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    job = jobs.get_job(r, job_id)
+    if not job:
+        return JSONResponse('Job not found.', status=status.HTTP_404_NOT_FOUND)
+
+    if request.method == 'GET':
+        return JSONResponse(job, status=status.HTTP_200_OK)
+
+    if request.method == 'DELETE':
+        if job['status'] in jobs.FINISHED_STATUSES:
+            return JSONResponse('Job ' + str(job_id) + ' has already finished.', status=status.HTTP_409_CONFLICT)
+        return JSONResponse({'status': jobs.cancel_job(r, job_id)}, status=status.HTTP_202_ACCEPTED)
+
+    return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+@csrf_exempt
+def job_log(request, job_id):
+    """
+    Output of a job from line ?offset=<n> on. The returned 'next' offset is used to tail the log.
+    """
+    try:
+        r = get_redis_connection()
+    except RedisError:
+        return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    if request.method == 'GET':
+        job = jobs.get_job(r, job_id)
+        if not job:
+            return JSONResponse('Job not found.', status=status.HTTP_404_NOT_FOUND)
+        try:
+            offset = max(int(request.GET.get('offset', 0)), 0)
+        except ValueError:
+            return JSONResponse('Invalid offset', status=status.HTTP_400_BAD_REQUEST)
+        lines, next_offset = jobs.get_job_log(r, job_id, offset)
+        return JSONResponse({'status': job['status'], 'progress': job.get('progress'), 'lines': lines, 'next': next_offset},
+                            status=status.HTTP_200_OK)
+
+    return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
 
 #
@@ -959,6 +1289,7 @@ def global_controller_detail(request, controller_id):
         data = JSONParser().parse(request)
         try:
             r.hmset('controller:' + str(controller_id), data)
+            publish_event(r, 'global_controller', controller_id)
             controller_data = r.hgetall('controller:' + str(controller_id))
             to_json_bools(controller_data, 'enabled')
 
@@ -974,6 +1305,7 @@ def global_controller_detail(request, controller_id):
 
     elif request.method == 'DELETE':
         r.delete("controller:" + str(controller_id))
+        publish_event(r, 'global_controller', controller_id)
 
         # If this is the last controller, the counter is reset
         keys = r.keys('controller:*')
@@ -997,6 +1329,11 @@ class GlobalControllerData(APIView):
         except RedisError:
             return JSONResponse('Error connecting with DB', status=500)
 
+        try:
+            check_upload_size(request)
+        except FileTooLargeException as e:
+            return JSONResponse(e.message, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
         data = json.loads(request.POST['metadata'])  # json data is in metadata parameter for this request
         if not data:
             return JSONResponse("Invalid format or empty request", status=status.HTTP_400_BAD_REQUEST)
@@ -1012,6 +1349,7 @@ class GlobalControllerData(APIView):
             data['controller_name'] = os.path.basename(path)
 
             r.hmset('controller:' + str(controller_id), data)
+            publish_event(r, 'global_controller', controller_id)
 
             if data['enabled']:
                 actor_id = data['controller_name'].split('.')[0]
@@ -1019,6 +1357,8 @@ class GlobalControllerData(APIView):
 
             return JSONResponse(data, status=status.HTTP_201_CREATED)
 
+        except FileTooLargeException as e:
+            return JSONResponse(e.message, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
         except DataError:
             return JSONResponse("Error to save the object", status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
@@ -1035,22 +1375,40 @@ class GlobalControllerData(APIView):
             global_controller_path = os.path.join(settings.GLOBAL_CONTROLLERS_DIR,
                                                   str(r.hget('controller:' + str(controller_id), 'controller_name')))
             if os.path.exists(global_controller_path):
-                global_controller_name = os.path.basename(global_controller_path)
-                global_controller_size = os.stat(global_controller_path).st_size
-
-                # Generate response
-                response = StreamingHttpResponse(FileWrapper(open(global_controller_path), global_controller_size),
-                                                 content_type=mimetypes.guess_type(global_controller_path)[0])
-                response['Content-Length'] = global_controller_size
-                response['Content-Disposition'] = "attachment; filename=%s" % global_controller_name
-
-                return response
+                files, _ = update_manifest(r, settings.GLOBAL_CONTROLLERS_DIR)
+                return file_response(request, global_controller_path, files.get(os.path.basename(global_controller_path)))
             else:
                 return HttpResponse(status=status.HTTP_404_NOT_FOUND)
         else:
             return HttpResponse(status=status.HTTP_404_NOT_FOUND)
 
 
+def start_bw_metric(metric_name, method_type):
+    """
+    Starts the bandwidth information metric actor observed by the bandwidth global controllers.
+    """
+    host = create_local_host()
+    if method_type == 'ssync':
+        metric_module_name = ''.join([settings.METRICS_BASE_MODULE, '.', 'bw_info_ssync'])
+        metric_class_name = 'BwInfoSSYNC'
+    else:
+        metric_module_name = ''.join([settings.METRICS_BASE_MODULE, '.', 'bw_info'])
+        metric_class_name = 'BwInfo'
+    logger.info("Controller, Starting metric actor " + metric_name)
+    metric_actors[metric_name] = host.spawn_id(metric_name, metric_module_name, metric_class_name,
+                                               ["amq.topic", metric_name, "bwdifferentiation."+metric_name+".#", method_type.upper()])
+
+    try:
+        metric_actors[metric_name].init_consum()
+        logger.info("Controller, Started metric actor " + metric_name)
+        sleep(0.1)
+        supervisor.watch('metric', metric_name, metric_actors, lambda: start_bw_metric(metric_name, method_type), restart_metric)
+    except Exception as e:
+        logger.error(e.args)
+        logger.info("Controller, Failed to start metric actor " + metric_name)
+        metric_actors.pop(metric_name).stop_actor()
+
+
 def start_global_controller(controller_id, actor_id, controller_class_name, method_type, dsl_filter):
 
     host = create_local_host()
@@ -1064,24 +1422,7 @@ def start_global_controller(controller_id, actor_id, controller_class_name, meth
                 # 1) Spawn metric actor if not already spawned
                 metric_name = method_type + "_bw_info"  # get_bw_info, put_bw_info, ssync_bw_info
                 if metric_name not in metric_actors:
-                    if method_type == 'ssync':
-                        metric_module_name = ''.join([settings.METRICS_BASE_MODULE, '.', 'bw_info_ssync'])
-                        metric_class_name = 'BwInfoSSYNC'
-                    else:
-                        metric_module_name = ''.join([settings.METRICS_BASE_MODULE, '.', 'bw_info'])
-                        metric_class_name = 'BwInfo'
-                    logger.info("Controller, Starting metric actor " + metric_name)
-                    metric_actors[metric_name] = host.spawn_id(metric_name, metric_module_name, metric_class_name,
-                                                           ["amq.topic", metric_name, "bwdifferentiation."+metric_name+".#", method_type.upper()])
-
-                    try:
-                        metric_actors[metric_name].init_consum()
-                        logger.info("Controller, Started metric actor " + metric_name)
-                        sleep(0.1)
-                    except Exception as e:
-                        logger.error(e.args)
-                        logger.info("Controller, Failed to start metric actor " + metric_name)
-                        metric_actors[metric_name].stop_actor()
+                    start_bw_metric(metric_name, method_type)
             else:
                 # FIXME: Obtain the related metric_name that the global controller must observe
                 metric_name = 'dummy'
@@ -1096,11 +1437,16 @@ def start_global_controller(controller_id, actor_id, controller_class_name, meth
             # ["amq.topic", actor_id, "controllers." + actor_id])
 
             controller_actors[controller_id].run(metric_name)
+            supervisor.watch('controller', controller_id, controller_actors,
+                             lambda: start_global_controller(controller_id, actor_id, controller_class_name, method_type, dsl_filter),
+                             lambda controller_actor: controller_actor.stop_actor(), metric_name)
     except Exception as e:
+        logger.error(str(e))
         print e
 
 
 def stop_global_controller(controller_id):
+    supervisor.unwatch('controller', controller_id)
     if controller_id in controller_actors:
         try:
             controller_actors[controller_id].stop_actor()
@@ -8,8 +8,11 @@ from django.test import TestCase, override_settings
 from rest_framework import status
 from rest_framework.test import APIRequestFactory
 
-from .views import dependency_list, dependency_detail, storlet_list, storlet_detail, storlet_list_deployed, filter_deploy, unset_filter, StorletData, \
-    slo_list, slo_detail
+from api.common_utils import md5
+from api.events import get_events
+from .views import dependency_list, dependency_detail, storlet_list, storlet_detail, storlet_list_deployed, filter_deploy, filter_undeploy, unset_filter, StorletData, DependencyData, \
+    slo_list, slo_detail, get_filter_policies, compile_pipeline, upload_storlet, upload_storlet_to_accounts, dependency_batch_deploy, dependency_list_deployed, \
+    dependency_undeploy
 
 
 # Tests use database=10 instead of 0.
@@ -197,6 +200,47 @@ class FiltersTestCase(TestCase):
         response = storlet_list(request)
         storlets = json.loads(response.content)
         self.assertTrue(len(storlets[0]['etag']) > 0)
+        self.assertEqual(storlets[0]['etag'], md5(storlets[0]['path']))
+        self.assertEqual(storlets[0]['content_length'], str(os.path.getsize('test_data/test-1.0.jar')))
+        # No temporary files are left behind
+        self.assertEqual([name for name in os.listdir(settings.STORLET_FILTERS_DIR) if name.startswith('.')], [])
+
+    @override_settings(MAX_UPLOAD_SIZE=10)
+    def test_upload_storlet_data_too_large(self):
+        with open('test_data/test-1.0.jar', 'r') as fp:
+            request = self.factory.put('/filters/1/data', {'file': fp})
+            response = StorletData.as_view()(request, 1)
+            self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertFalse(self.r.hexists('filter:1', 'etag'))
+
+    def test_download_storlet_data_ok(self):
+        with open('test_data/test-1.0.jar', 'r') as fp:
+            request = self.factory.put('/filters/1/data', {'file': fp})
+            StorletData.as_view()(request, 1)
+
+        request = self.factory.get('/filters/1/data')
+        response = StorletData.as_view()(request, 1)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['ETag'], '"' + md5('test_data/test-1.0.jar') + '"')
+        with open('test_data/test-1.0.jar', 'r') as fp:
+            self.assertEqual(''.join(response.streaming_content), fp.read())
+
+        # The node already has this version of the filter
+        request = self.factory.get('/filters/1/data', HTTP_IF_NONE_MATCH=response['ETag'])
+        response = StorletData.as_view()(request, 1)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    @override_settings(FILE_DOWNLOAD_MODE='x-accel-redirect', X_ACCEL_REDIRECT_PREFIX='/crystal_files')
+    def test_download_storlet_data_with_x_accel_redirect(self):
+        with open('test_data/test-1.0.jar', 'r') as fp:
+            request = self.factory.put('/filters/1/data', {'file': fp})
+            StorletData.as_view()(request, 1)
+
+        request = self.factory.get('/filters/1/data')
+        response = StorletData.as_view()(request, 1)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Accel-Redirect'], '/crystal_files' + os.path.join(settings.STORLET_FILTERS_DIR, 'test-1.0.jar'))
+        self.assertEqual(response.content, '')
 
     def test_upload_storlet_data_to_non_existent_storlet(self):
         with open('test_data/test-1.0.jar', 'r') as fp:
@@ -245,6 +289,92 @@ class FiltersTestCase(TestCase):
         dumped_data = self.r.hget("pipeline:AUTH_0123456789abcdef", "1")
         json_data = json.loads(dumped_data)
         self.assertEqual(json_data["filter_name"], "test-1.0.jar")
+        self.assertEqual(get_filter_policies(self.r, "test-1.0.jar"), [('0123456789abcdef', '1')])
+        pipeline_doc = json.loads(self.r.get("pipeline_doc:AUTH_0123456789abcdef"))
+        self.assertEqual([p["policy_id"] for p in pipeline_doc["PUT"]["proxy"]], ["1"])
+        event = get_events(self.r)[-1]
+        self.assertEqual((event['type'], event['id'], event['target'], event['version']),
+                         ('static_policy', '1', '0123456789abcdef', pipeline_doc['version']))
+
+    def test_filter_deploy_non_existent_filter(self):
+        data = {"object_type": "", "object_size": "", "params": ""}
+        request = self.factory.put('/filters/0123456789abcdef/deploy/9', data, format='json')
+        response = filter_deploy(request, "9", "0123456789abcdef")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(self.r.exists("policies:id"))
+
+    @mock.patch('filters.views.swift_client.delete_object')
+    @mock.patch('filters.views.swift_client.put_object', side_effect=mock_put_object_status_created)
+    def test_filter_undeploy_from_project_ok(self, mock_put_object, mock_delete_object):
+        with open('test_data/test-1.0.jar', 'r') as fp:
+            request = self.factory.put('/filters/1/data', {'file': fp})
+            StorletData.as_view()(request, 1)
+
+        # Not deployed yet
+        request = self.factory.put('/filters/0123456789abcdef/undeploy/1')
+        response = filter_undeploy(request, "1", "0123456789abcdef")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        data = {"object_type": "", "object_size": "", "params": ""}
+        request = self.factory.put('/filters/0123456789abcdef/deploy/1', data, format='json')
+        request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
+        filter_deploy(request, "1", "0123456789abcdef")
+
+        request = self.factory.put('/filters/0123456789abcdef/undeploy/1')
+        request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
+        response = filter_undeploy(request, "1", "0123456789abcdef")
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertTrue(mock_delete_object.called)
+        self.assertFalse(self.r.exists("pipeline:AUTH_0123456789abcdef"))
+        self.assertEqual(get_filter_policies(self.r, "test-1.0.jar"), [])
+
+    @mock.patch('filters.views.swift_client.head_object')
+    @mock.patch('filters.views.swift_client.put_object', side_effect=mock_put_object_status_created)
+    def test_upload_storlet_skips_deployed_storlet(self, mock_put_object, mock_head_object):
+        with open('test_data/test-1.0.jar', 'r') as fp:
+            request = self.factory.put('/filters/1/data', {'file': fp})
+            StorletData.as_view()(request, 1)
+        filter_data = self.r.hgetall('filter:1')
+
+        # Same etag but different metadata: the storlet is uploaded
+        mock_head_object.return_value = {'etag': filter_data['etag'], 'x-object-meta-storlet-language': 'java',
+                                         'x-object-meta-storlet-main': 'com.example.OldMain'}
+        self.assertTrue(upload_storlet('0123456789abcdef', 'fake_token', filter_data))
+        self.assertEqual(mock_put_object.call_count, 1)
+
+        # The deployed version is cached: neither HEAD nor PUT
+        mock_head_object.reset_mock()
+        self.assertFalse(upload_storlet('0123456789abcdef', 'fake_token', filter_data))
+        self.assertFalse(mock_head_object.called)
+        self.assertEqual(mock_put_object.call_count, 1)
+
+        # Not cached, but Swift already has the same etag and metadata
+        self.r.delete('storlet_deployed:AUTH_0123456789abcdef:test-1.0.jar')
+        mock_head_object.return_value = {'etag': filter_data['etag'], 'x-object-meta-storlet-language': 'java',
+                                         'x-object-meta-storlet-main': 'com.example.FakeMain'}
+        self.assertFalse(upload_storlet('0123456789abcdef', 'fake_token', filter_data))
+        self.assertTrue(mock_head_object.called)
+        self.assertEqual(mock_put_object.call_count, 1)
+        self.assertTrue(self.r.exists('storlet_deployed:AUTH_0123456789abcdef:test-1.0.jar'))
+
+    @override_settings(SWIFT_DEPLOY_MAX_WORKERS=4)
+    @mock.patch('filters.views.swift_client.head_object')
+    @mock.patch('filters.views.swift_client.put_object', side_effect=mock_put_object_status_created)
+    def test_upload_storlet_to_accounts_with_many_workers(self, mock_put_object, mock_head_object):
+        with open('test_data/test-1.0.jar', 'r') as fp:
+            request = self.factory.put('/filters/1/data', {'file': fp})
+            StorletData.as_view()(request, 1)
+        filter_data = self.r.hgetall('filter:1')
+        deployed = {'etag': filter_data['etag'], 'x-object-meta-storlet-language': 'java',
+                    'x-object-meta-storlet-main': 'com.example.FakeMain'}
+        accounts = ['%016x' % i for i in range(8)]
+        # The even accounts already have the storlet
+        mock_head_object.side_effect = lambda url, token, container, name, http_conn: deployed if int(url[-1], 16) % 2 == 0 else {}
+
+        results = upload_storlet_to_accounts('fake_token', filter_data, accounts + accounts[:3])
+        self.assertEqual(results, dict((account, int(account, 16) % 2 == 1) for account in accounts))
+        for account in accounts:
+            self.assertTrue(self.r.exists('storlet_deployed:AUTH_' + account + ':test-1.0.jar'))
 
     @mock.patch('filters.views.swift_client.put_object', side_effect=mock_put_object_status_created)
     def test_filter_deploy_to_project_and_container_ok(self, mock_put_object):
@@ -334,6 +464,18 @@ class FiltersTestCase(TestCase):
         self.assertTrue('DependencyName' in dependency_names)
         self.assertTrue('SecondDependencyName' in dependency_names)
 
+    @override_settings(DEPENDENCY_DIR=os.path.join("/tmp", "crystal", "dependencies"))
+    def test_upload_dependency_data_ok(self):
+        with open('test_data/test-1.0.jar', 'r') as fp:
+            request = self.factory.put('/filters/dependencies/1/data', {'file': fp})
+            response = DependencyData.as_view()(request, 1)
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        dependency = self.r.hgetall('dependency:1')
+        self.assertEqual(dependency['path'], os.path.join(settings.DEPENDENCY_DIR, 'test-1.0.jar'))
+        self.assertEqual(dependency['etag'], md5('test_data/test-1.0.jar'))
+        self.assertEqual(dependency['content_length'], str(os.path.getsize('test_data/test-1.0.jar')))
+
     def test_get_dependency_ok(self):
         dependency_id = 1
         request = self.factory.get('/filters/dependencies/' + str(dependency_id))
@@ -371,17 +513,133 @@ class FiltersTestCase(TestCase):
         dependencies = json.loads(response.content)
         self.assertEqual(len(dependencies), 0)
 
+    @override_settings(DEPENDENCY_DIR=os.path.join("/tmp", "crystal", "dependencies"))
+    @mock.patch('filters.views.swift_client.Connection')
+    def test_dependency_batch_deploy_ok(self, mock_connection):
+        connections = {}
+
+        def connection(preauthurl, **kwargs):
+            connections[preauthurl.rsplit('AUTH_', 1)[1]] = mock.Mock()
+            return connections[preauthurl.rsplit('AUTH_', 1)[1]]
+        mock_connection.side_effect = connection
+        with open('test_data/test-1.0.jar', 'r') as fp:
+            request = self.factory.put('/filters/dependencies/1/data', {'file': fp})
+            DependencyData.as_view()(request, 1)
+        self.r.sadd('AUTH_0123456789abcdef:dependencies', 'DependencyName')
+
+        data = {'dependencies': ['1'], 'accounts': ['0123456789abcdef', 'abcdef0123456789']}
+        request = self.factory.put('/filters/dependencies/deploy', data, format='json')
+        response = dependency_batch_deploy(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        lines = [json.loads(line) for line in ''.join(response.streaming_content).splitlines()]
+        statuses = dict((item['account'], item['status']) for item in lines[:-1])
+        self.assertEqual(statuses, {'0123456789abcdef': 'already_deployed', 'abcdef0123456789': 'deployed'})
+        self.assertEqual(lines[-1]['summary'], {'deployed': 1, 'already_deployed': 1, 'failed': 0, 'total': 2})
+        # One connection per account, reused for all its dependencies
+        self.assertEqual(sorted(connections), ['0123456789abcdef', 'abcdef0123456789'])
+        self.assertEqual([conn.put_object.call_count for conn in connections.values()], [1, 1])
+        self.assertEqual(self.r.smembers('AUTH_abcdef0123456789:dependencies'), {'DependencyName'})
+
+    @override_settings(DEPENDENCY_DIR=os.path.join("/tmp", "crystal", "dependencies"))
+    @mock.patch('filters.views.swift_client.Connection')
+    def test_dependency_batch_deploy_with_repeated_ids(self, mock_connection):
+        with open('test_data/test-1.0.jar', 'r') as fp:
+            request = self.factory.put('/filters/dependencies/1/data', {'file': fp})
+            DependencyData.as_view()(request, 1)
+
+        data = {'dependencies': ['1', 1], 'accounts': ['0123456789abcdef', 'abcdef0123456789', '0123456789abcdef']}
+        request = self.factory.put('/filters/dependencies/deploy', data, format='json')
+        response = dependency_batch_deploy(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        lines = [json.loads(line) for line in ''.join(response.streaming_content).splitlines()]
+        self.assertEqual(sorted(item['account'] for item in lines[:-1]), ['0123456789abcdef', 'abcdef0123456789'])
+        self.assertEqual(lines[-1]['summary'], {'deployed': 2, 'already_deployed': 0, 'failed': 0, 'total': 2})
+
+    @mock.patch('filters.views.swift_client.Connection')
+    def test_dependency_batch_deploy_worker_errors(self, mock_connection):
+        # Errors other than the Swift ones are reported as failed deployments instead of blocking the response
+        def connection(preauthurl, **kwargs):
+            if preauthurl.endswith('abcdef0123456789'):
+                raise ValueError('Invalid token')
+            return mock.Mock()
+        mock_connection.side_effect = connection
+        self.r.hset('dependency:1', 'path', os.path.join(settings.DEPENDENCY_DIR, 'test-1.0.jar'))
+        data = {'dependencies': ['1'], 'accounts': ['0123456789abcdef', 'abcdef0123456789']}
+        request = self.factory.put('/filters/dependencies/deploy', data, format='json')
+        with mock.patch('filters.views.deploy_dependency', side_effect=redis.RedisError('Connection lost')):
+            response = dependency_batch_deploy(request)
+            lines = [json.loads(line) for line in ''.join(response.streaming_content).splitlines()]
+        errors = dict((item['account'], item['error']) for item in lines[:-1])
+        self.assertEqual(errors, {'0123456789abcdef': 'Connection lost', 'abcdef0123456789': 'Invalid token'})
+        self.assertEqual(lines[-1]['summary'], {'deployed': 0, 'already_deployed': 0, 'failed': 2, 'total': 2})
+
+    def test_dependency_batch_deploy_with_non_existent_dependency(self):
+        data = {'dependencies': ['1', '99'], 'accounts': ['0123456789abcdef']}
+        request = self.factory.put('/filters/dependencies/deploy', data, format='json')
+        response = dependency_batch_deploy(request)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @mock.patch('filters.views.swift_client.delete_object')
+    def test_dependency_undeploy_ok(self, mock_delete_object):
+        self.r.sadd('AUTH_0123456789abcdef:dependencies', 'DependencyName', 'OtherDependency')
+        mock_delete_object.side_effect = lambda *args: args[-1].update({'status': 204})
+        request = self.factory.put('/filters/dependencies/0123456789abcdef/undeploy/1')
+        response = dependency_undeploy(request, '1', '0123456789abcdef')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        request = self.factory.get('/filters/dependencies/0123456789abcdef/deploy')
+        response = dependency_list_deployed(request, '0123456789abcdef')
+        self.assertEqual(json.loads(response.content), ['OtherDependency'])
+
     @mock.patch('filters.views.swift_client.delete_object')
     def test_unset_filter_ok(self, mock_delete_object):
         data20 = {'filter_name': 'XXXXX'}
         data21 = {'filter_name': 'test-1.0.jar'}
         self.r.hmset('pipeline:AUTH_0123456789abcdef', {'20': json.dumps(data20), '21': json.dumps(data21)})
+        self.r.sadd('filter_policies:XXXXX', '0123456789abcdef:20')
+        self.r.sadd('filter_policies:test-1.0.jar', '0123456789abcdef:21')
         unset_filter(self.r, '0123456789abcdef', {'filter_type': 'storlet', 'filter_name': 'test-1.0.jar'}, 'fake_token')
         mock_delete_object.assert_called_with(settings.SWIFT_URL + settings.SWIFT_API_VERSION + "/AUTH_0123456789abcdef",
                                               'fake_token', "storlet", "test-1.0.jar", mock.ANY, mock.ANY, mock.ANY,
                                               mock.ANY, mock.ANY)
         self.assertFalse(self.r.hexists("pipeline:AUTH_0123456789abcdef", "21"))  # 21 was deleted
         self.assertTrue(self.r.hexists("pipeline:AUTH_0123456789abcdef", "20"))  # 20 was not deleted
+        self.assertFalse(self.r.exists('filter_policies:test-1.0.jar'))
+        self.assertEqual(self.r.smembers('filter_policies:XXXXX'), {'0123456789abcdef:20'})
+
+    @mock.patch('filters.views.swift_client.delete_object')
+    def test_unset_filter_only_removes_policies_of_target(self, mock_delete_object):
+        data = {'filter_name': 'test-1.0.jar'}
+        self.r.hmset('pipeline:AUTH_0123456789abcdef', {'21': json.dumps(data)})
+        self.r.hmset('pipeline:AUTH_0123456789abcdef:container1', {'22': json.dumps(data)})
+        self.r.sadd('filter_policies:test-1.0.jar', '0123456789abcdef:21', '0123456789abcdef:container1:22')
+        unset_filter(self.r, '0123456789abcdef/container1', {'filter_type': 'storlet', 'filter_name': 'test-1.0.jar'}, 'fake_token')
+        self.assertTrue(self.r.hexists("pipeline:AUTH_0123456789abcdef", "21"))
+        self.assertFalse(self.r.hexists("pipeline:AUTH_0123456789abcdef:container1", "22"))
+        self.assertEqual(get_filter_policies(self.r, 'test-1.0.jar'), [('0123456789abcdef', '21')])
+        pipeline_doc = json.loads(self.r.get('pipeline_doc:AUTH_0123456789abcdef:container1'))
+        self.assertEqual(pipeline_doc['PUT'], {'proxy': [], 'object': []})
+
+    def test_compile_pipeline_ok(self):
+        self.r.hmset('pipeline:AUTH_0123456789abcdef',
+                     {'1': json.dumps({'filter_name': 'compression-1.0.jar', 'execution_order': '2', 'execution_server': 'proxy',
+                                       'has_reverse': True, 'execution_server_reverse': 'object'}),
+                      '2': json.dumps({'filter_name': 'crypto-1.0.jar', 'execution_order': '1', 'execution_server': 'proxy',
+                                       'has_reverse': False}),
+                      '3': json.dumps({'filter_name': 'cache-1.0.jar', 'execution_order': '3', 'execution_server': 'object',
+                                       'is_post_get': True, 'has_reverse': False})})
+        compile_pipeline(self.r, '0123456789abcdef')
+        pipeline_doc = json.loads(self.r.get('pipeline_doc:AUTH_0123456789abcdef'))
+        self.assertEqual(pipeline_doc['version'], 1)
+        self.assertEqual(self.r.get('pipeline_version:AUTH_0123456789abcdef'), '1')
+        self.assertEqual([p['policy_id'] for p in pipeline_doc['PUT']['proxy']], ['2', '1'])
+        self.assertEqual(pipeline_doc['PUT']['object'], [])
+        self.assertEqual([(p['policy_id'], p['reverse']) for p in pipeline_doc['GET']['object']], [('1', True), ('3', False)])
+        self.assertEqual(pipeline_doc['GET']['proxy'], [])
+
+        # Every compilation bumps the version
+        compile_pipeline(self.r, '0123456789abcdef')
+        self.assertEqual(json.loads(self.r.get('pipeline_doc:AUTH_0123456789abcdef'))['version'], 2)
 
     # slo_list / slo_detail
 
@@ -19,6 +19,7 @@ urlpatterns = [
     url(r'^/(?P<account>\w+)/(?P<container>[-\w]+)/(?P<swift_object>[-\w]+)/undeploy/(?P<filter_id>[0-9]+)/?$', views.filter_undeploy),
 
     url(r'^/dependencies/?$', views.dependency_list),
+    url(r'^/dependencies/deploy/?$', views.dependency_batch_deploy),
     url(r'^/dependencies/(?P<dependency_id>\w+)/?$', views.dependency_detail),
     url(r'^/dependencies/(?P<dependency_id>\w+)/data/?$', views.DependencyData.as_view()),
     url(r'^/dependencies/(?P<account>\w+)/deploy/?$', views.dependency_list_deployed),
@@ -2,16 +2,17 @@ import errno
 import hashlib
 import json
 import logging
-import mimetypes
 import os
+import Queue
+import tempfile
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from operator import itemgetter
 
 from django.conf import settings
-from django.core.servers.basehttp import FileWrapper
-from django.http import HttpResponse
-from django.http import StreamingHttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
-from redis.exceptions import RedisError, DataError
+from redis.exceptions import RedisError, DataError, WatchError
 from rest_framework import status
 from rest_framework.exceptions import ParseError
 from rest_framework.parsers import JSONParser, MultiPartParser, FormParser
@@ -20,8 +21,11 @@ from rest_framework.views import APIView
 from swiftclient import client as swift_client
 from swiftclient.exceptions import ClientException
 
-from api.common_utils import rsync_dir_with_nodes, to_json_bools, JSONResponse, get_redis_connection, get_token_connection
-from api.exceptions import SwiftClientError, StorletNotFoundException, FileSynchronizationException
+from api.common_utils import rsync_dir_with_nodes, to_json_bools, JSONResponse, get_redis_connection, get_token_connection, file_response
+from api.events import publish_event
+from api.exceptions import SwiftClientError, StorletNotFoundException, FileSynchronizationException, FileTooLargeException, \
+    FilterNotFoundException
+from api.instrumentation import timed
 
 # TODO create a common file and put this into the new file
 # Start Common
@@ -80,6 +84,8 @@ def storlet_list(request):
                 if data['enabled'] is True or data['enabled'] == 'True' or data['enabled'] == 'true':
                     to_json_bools(data, 'has_reverse', 'is_pre_get', 'is_post_get', 'is_pre_put', 'is_post_put', 'enabled')
                     r.hset("global_filters", str(storlet_id), json.dumps(data))
+                    publish_event(r, 'global_filter', storlet_id)
+            publish_event(r, 'filter', storlet_id)
 
             return JSONResponse(data, status=status.HTTP_201_CREATED)
 
@@ -129,6 +135,8 @@ def storlet_detail(request, storlet_id):
                     r.hset("global_filters", str(storlet_id), json.dumps(data))
                 else:
                     r.hdel("global_filters", str(storlet_id))
+                publish_event(r, 'global_filter', storlet_id)
+            publish_event(r, 'filter', storlet_id)
 
             return JSONResponse("Data updated", status=status.HTTP_200_OK)
         except DataError:
@@ -146,6 +154,8 @@ def storlet_detail(request, storlet_id):
             r.delete("filter:" + str(storlet_id))
             if my_filter['filter_type'] == 'global':
                 r.hdel("global_filters", str(storlet_id))
+                publish_event(r, 'global_filter', storlet_id)
+            publish_event(r, 'filter', storlet_id)
             return JSONResponse('Filter has been deleted', status=status.HTTP_204_NO_CONTENT)
         except DataError:
             return JSONResponse("Error deleting filter", status=status.HTTP_408_REQUEST_TIMEOUT)
@@ -165,6 +175,10 @@ class StorletData(APIView):
             return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         filter_name = "filter:" + str(storlet_id)
         if r.exists(filter_name):
+            try:
+                check_upload_size(request)
+            except FileTooLargeException as e:
+                return JSONResponse(e.message, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
             file_obj = request.FILES['file']
 
             filter_type = r.hget(filter_name, 'filter_type')
@@ -180,14 +194,15 @@ class StorletData(APIView):
                 filter_dir = settings.GLOBAL_NATIVE_FILTERS_DIR
 
             make_sure_path_exists(filter_dir)
-            path = save_file(file_obj, filter_dir)
-            md5_etag = md5(path)
+            try:
+                path, md5_etag, content_length = store_file(file_obj, filter_dir)
+            except FileTooLargeException as e:
+                return JSONResponse(e.message, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
 
             try:
-                r.hset(filter_name, "filter_name", os.path.basename(path))
-                r.hset(filter_name, "path", str(path))
-                r.hset(filter_name, "content_length", str(request.META["CONTENT_LENGTH"]))
-                r.hset(filter_name, "etag", str(md5_etag))
+                r.hmset(filter_name, {"filter_name": os.path.basename(path), "path": str(path),
+                                      "content_length": str(content_length), "etag": str(md5_etag)})
+                publish_event(r, 'filter', storlet_id)
             except RedisError:
                 return JSONResponse('Problems connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -196,7 +211,7 @@ class StorletData(APIView):
                 try:
                     rsync_dir_with_nodes(filter_dir)
                 except FileSynchronizationException as e:
-                    return JSONResponse(e.message, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+                    return JSONResponse({'message': e.message, 'nodes': e.results}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
             return JSONResponse('Filter has been updated', status=status.HTTP_201_CREATED)
         return JSONResponse('Filter does not exist', status=status.HTTP_404_NOT_FOUND)
@@ -208,17 +223,9 @@ class StorletData(APIView):
             return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
         if r.exists('filter:' + str(storlet_id)):
-            filter_path = r.hget('filter:' + str(storlet_id), 'path')
-            if os.path.exists(filter_path):
-                filter_name = os.path.basename(filter_path)
-                filter_size = os.stat(filter_path).st_size
-
-                # Generate response
-                response = StreamingHttpResponse(FileWrapper(open(filter_path), filter_size), content_type=mimetypes.guess_type(filter_path)[0])
-                response['Content-Length'] = filter_size
-                response['Content-Disposition'] = "attachment; filename=%s" % filter_name
-
-                return response
+            filter_path, filter_etag = r.hmget('filter:' + str(storlet_id), 'path', 'etag')
+            if filter_path and os.path.exists(filter_path):
+                return file_response(request, filter_path, filter_etag)
             else:
                 return HttpResponse(status=status.HTTP_404_NOT_FOUND)
         else:
@@ -238,40 +245,12 @@ def filter_deploy(request, filter_id, account, container=None, swift_object=None
         except RedisError:
             return JSONResponse('Problems to connect with the DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        filter_data = r.hgetall("filter:" + str(filter_id))
-
-        if not filter_data:
-            return JSONResponse('Filter does not exist', status=status.HTTP_404_NOT_FOUND)
-
         try:
             params = JSONParser().parse(request)
             logger.debug(str(params))
         except ParseError:
             return JSONResponse("Invalid format or empty request params", status=status.HTTP_400_BAD_REQUEST)
 
-        # Get an identifier of this new policy
-        policy_id = r.incr("policies:id")
-
-        # Set the policy data
-        policy_data = {
-            "policy_id": policy_id,
-            "object_type": params['object_type'],
-            "object_size": params['object_size'],
-            "execution_order": policy_id,
-            "params": params['params'],
-            "callable": False
-        }
-
-        if 'execution_server' in params:
-            if params['execution_server'] != 'default':
-                policy_data['execution_server'] = params['execution_server']
-
-        if 'execution_server_reverse' in params:
-            if params['execution_server_reverse'] != 'default':
-                policy_data['execution_server_reverse'] = params['execution_server_reverse']
-
-        logger.debug(str(policy_data))
-
         # TODO: Try to improve this part
         if container and swift_object:
             target = account + "/" + container + "/" + swift_object
@@ -281,8 +260,10 @@ def filter_deploy(request, filter_id, account, container=None, swift_object=None
             target = account
 
         try:
-            set_filter(r, target, filter_data, policy_data, token)
+            policy_id = deploy_filter(r, filter_id, target, params, token)
             return JSONResponse(policy_id, status=status.HTTP_201_CREATED)
+        except FilterNotFoundException as e:
+            return JSONResponse(str(e), status=status.HTTP_404_NOT_FOUND)
         except SwiftClientError:
             return JSONResponse('Error accessing Swift.', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         except StorletNotFoundException:
@@ -325,14 +306,6 @@ def filter_undeploy(request, filter_id, account, container=None, swift_object=No
         except RedisError:
             return JSONResponse('Problems to connect with the DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        filter_data = r.hgetall("filter:" + str(filter_id))
-
-        if not filter_data:
-            return JSONResponse('Filter does not exist', status=status.HTTP_404_NOT_FOUND)
-
-        if not r.exists("AUTH_" + str(account) + ":" + str(filter_data["filter_name"])):
-            return JSONResponse('Filter ' + str(filter_data["filter_name"]) + ' has not been deployed already', status=status.HTTP_404_NOT_FOUND)
-
         if container and swift_object:
             target = account + "/" + container + "/" + swift_object
         elif container:
@@ -340,9 +313,13 @@ def filter_undeploy(request, filter_id, account, container=None, swift_object=No
         else:
             target = account
 
-        # print target
-
-        return unset_filter(r, target, filter_data, token)
+        try:
+            undeploy_filter(r, filter_id, target, token)
+            return JSONResponse('Filter has been undeployed', status=status.HTTP_204_NO_CONTENT)
+        except FilterNotFoundException as e:
+            return JSONResponse(str(e), status=status.HTTP_404_NOT_FOUND)
+        except SwiftClientError:
+            return JSONResponse('Error accessing Swift.', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
@@ -376,6 +353,7 @@ def dependency_list(request):
         try:
             data["id"] = dependency_id
             r.hmset('dependency:' + str(dependency_id), data)
+            publish_event(r, 'dependency', dependency_id)
             return JSONResponse(data, status=201)
         except DataError:
             return JSONResponse("Error to save the filter", status=400)
@@ -401,12 +379,14 @@ def dependency_detail(request, dependency_id):
         data = JSONParser().parse(request)
         try:
             r.hmset('dependency:' + str(dependency_id), data)
+            publish_event(r, 'dependency', dependency_id)
             return JSONResponse("Data updated", status=201)
         except DataError:
             return JSONResponse("Error updating data", status=400)
 
     elif request.method == 'DELETE':
         r.delete("dependency:" + str(dependency_id))
+        publish_event(r, 'dependency', dependency_id)
         return JSONResponse('Dependency has been deleted', status=204)
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=405)
 
@@ -420,9 +400,15 @@ class DependencyData(APIView):
         except RedisError:
             return JSONResponse('Problems to connect with the DB', status=500)
         if r.exists("dependency:" + str(dependency_id)):
-            file_obj = request.FILES['file']
-            path = save_file(file_obj, settings.DEPENDENCY_DIR)
-            r.hset("dependency:" + str(dependency_id), "path", str(path))
+            try:
+                check_upload_size(request)
+                file_obj = request.FILES['file']
+                make_sure_path_exists(settings.DEPENDENCY_DIR)
+                path, md5_etag, content_length = store_file(file_obj, settings.DEPENDENCY_DIR)
+            except FileTooLargeException as e:
+                return JSONResponse(e.message, status=413)
+            r.hmset("dependency:" + str(dependency_id), {"path": str(path), "content_length": str(content_length), "etag": str(md5_etag)})
+            publish_event(r, 'dependency', dependency_id)
             return JSONResponse('Dependency has been updated', status=201)
         return JSONResponse('Dependency does not exist', status=404)
 
@@ -432,6 +418,27 @@ class DependencyData(APIView):
         return Response(data, status=None, template_name=None, headers=None, content_type=None)
 
 
+def get_dependency_connection(account, token):
+    """
+    Swift connection to the account, kept open across the puts of a deployment.
+    """
+    url = settings.SWIFT_URL + settings.SWIFT_API_VERSION + "/AUTH_" + str(account)
+    return swift_client.Connection(preauthurl=url, preauthtoken=token, retries=1)
+
+
+def deploy_dependency(r, conn, dependency, account):
+    """
+    Uploads the dependency file to the 'dependency' container of the account.
+    Returns True if the dependency was not deployed to the account before.
+    """
+    metadata = {'X-Object-Meta-Storlet-Dependency-Version': str(dependency["version"])}
+    with open(dependency["path"], 'r') as dependency_file:
+        with timed('swift'):
+            conn.put_object('dependency', dependency["name"], dependency_file,
+                            content_type="application/octet-stream", headers=metadata)
+    return r.sadd("AUTH_" + str(account) + ":dependencies", str(dependency['name'])) == 1
+
+
 @csrf_exempt
 def dependency_deploy(request, dependency_id, account):
     token = get_token_connection(request)
@@ -445,32 +452,125 @@ def dependency_deploy(request, dependency_id, account):
         dependency = r.hgetall("dependency:" + str(dependency_id))
         if not dependency:
             return JSONResponse('Dependency does not exist', status=404)
-        metadata = {'X-Object-Meta-Storlet-Dependency-Version': str(dependency["version"])}
 
         if "path" not in dependency.keys():
             return JSONResponse('Dependency path does not exist', status=404)
 
+        conn = get_dependency_connection(account, token)
         try:
-            dependency_file = open(dependency["path"], 'r')
-            content_length = None
-            response = dict()
-            url = settings.SWIFT_URL + settings.SWIFT_API_VERSION + "/AUTH_" + str(account)
-            swift_client.put_object(url, token, 'dependency', dependency["name"], dependency_file, content_length,
-                                    None, None, "application/octet-stream", metadata, None, None, None, response)
-        except ClientException:
-            return JSONResponse(response.get("reason"), status=response.get('status'))
+            if not deploy_dependency(r, conn, dependency, account):
+                return JSONResponse("Already deployed", status=200)
+        except ClientException as e:
+            return JSONResponse(e.http_reason, status=e.http_status or 500)
         finally:
-            dependency_file.close()
+            conn.close()
 
-        status = response.get('status')
-        if status == 201:
-            if r.exists("AUTH_" + str(account) + ":dependency:" + str(dependency['name'])):
-                return JSONResponse("Already deployed", status=200)
+        publish_event(r, 'deployed_dependency', dependency['name'], str(account))
+        return JSONResponse("Deployed", status=201)
+
+    return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=405)
+
+
+@csrf_exempt
+def dependency_batch_deploy(request):
+    """
+    Deploys several dependencies to several accounts:
+    PUT {"dependencies": [<dependency_id>, ...], "accounts": [<account>, ...]}
+
+    Accounts are deployed concurrently (SWIFT_DEPLOY_MAX_WORKERS), each one over a
+    single Swift connection. The response streams one JSON line per
+    (dependency, account) as soon as it finishes, followed by a summary line.
+    """
+    token = get_token_connection(request)
+
+    if request.method == 'PUT':
+        try:
+            r = get_redis_connection()
+        except RedisError:
+            return JSONResponse('Problems to connect with the DB', status=500)
 
-            if r.lpush("AUTH_" + str(account) + ":dependencies", str(dependency['name'])):
-                return JSONResponse("Deployed", status=201)
+        try:
+            data = JSONParser().parse(request)
+            # Each (dependency, account) is deployed and reported once, in the order given
+            dependency_ids = list(OrderedDict.fromkeys(str(dependency_id) for dependency_id in data['dependencies']))
+            accounts = list(OrderedDict.fromkeys(str(account) for account in data['accounts']))
+        except (ParseError, KeyError, TypeError):
+            return JSONResponse("Invalid format or empty request", status=400)
+        if not dependency_ids or not accounts:
+            return JSONResponse("Invalid format or empty request", status=400)
 
-        return JSONResponse("error", status=400)
+        dependencies = []
+        for dependency_id in dependency_ids:
+            dependency = r.hgetall("dependency:" + dependency_id)
+            if not dependency:
+                return JSONResponse('Dependency ' + dependency_id + ' does not exist', status=404)
+            if "path" not in dependency.keys():
+                return JSONResponse('Dependency ' + dependency_id + ' path does not exist', status=404)
+            dependencies.append(dependency)
+
+        results = Queue.Queue()
+
+        def deployment_item(dependency, account):
+            return {'dependency': dependency['id'], 'name': dependency['name'], 'account': account}
+
+        def failed(item, error):
+            logger.error("Dependency " + item['name'] + " deployment to AUTH_" + item['account'] + " failed: " + str(error))
+            item['status'] = 'failed'
+            item['error'] = str(error)
+            return item
+
+        def deploy_to_account(account):
+            # Every dependency of the account produces one result, even if the worker fails
+            try:
+                conn = get_dependency_connection(account, token)
+            except Exception as e:
+                for dependency in dependencies:
+                    results.put(failed(deployment_item(dependency, account), e))
+                return
+            try:
+                for dependency in dependencies:
+                    item = deployment_item(dependency, account)
+                    try:
+                        if deploy_dependency(r, conn, dependency, account):
+                            item['status'] = 'deployed'
+                        else:
+                            item['status'] = 'already_deployed'
+                    except Exception as e:
+                        failed(item, e)
+                    results.put(item)
+            finally:
+                conn.close()
+
+        def progress():
+            total = len(dependencies) * len(accounts)
+            summary = {'deployed': 0, 'already_deployed': 0, 'failed': 0}
+
+            def report(item):
+                summary[item['status']] += 1
+                if item['status'] == 'deployed':
+                    publish_event(r, 'deployed_dependency', item['name'], item['account'])
+                return json.dumps(item) + '\n'
+
+            pending = dict(((dependency['id'], account), dependency) for dependency in dependencies for account in accounts)
+            pool = ThreadPool(min(len(accounts), settings.SWIFT_DEPLOY_MAX_WORKERS))
+            try:
+                pool.map_async(deploy_to_account, accounts)
+                while pending:
+                    try:
+                        item = results.get(timeout=settings.SWIFT_DEPLOY_TIMEOUT)
+                    except Queue.Empty:
+                        break
+                    del pending[(item['dependency'], item['account'])]
+                    yield report(item)
+            finally:
+                pool.close()
+            # Deployments without a result after SWIFT_DEPLOY_TIMEOUT
+            for (_, account), dependency in pending.items():
+                yield report(failed(deployment_item(dependency, account), 'Timeout'))
+            summary['total'] = total
+            yield json.dumps({'summary': summary}) + '\n'
+
+        return StreamingHttpResponse(progress(), content_type='application/x-ndjson')
 
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=405)
 
@@ -483,7 +583,7 @@ def dependency_list_deployed(request, account):
         except RedisError:
             return JSONResponse('Problems to connect with the DB', status=500)
 
-        result = r.lrange("AUTH_" + str(account) + ":dependencies", 0, -1)
+        result = sorted(r.smembers("AUTH_" + str(account) + ":dependencies"))
         if result:
             return JSONResponse(result, status=200)
         else:
@@ -506,21 +606,22 @@ def dependency_undeploy(request, dependency_id, account):
 
         if not dependency:
             return JSONResponse('Dependency does not exist', status=404)
-        if not r.exists("AUTH_" + str(account) + ":dependency:" + str(dependency["name"])):
+        if not r.sismember("AUTH_" + str(account) + ":dependencies", str(dependency["name"])):
             return JSONResponse('Dependency ' + str(dependency["name"]) + ' has not been deployed already', status=404)
 
         try:
             response = dict()
             url = settings.SWIFT_URL + settings.SWIFT_API_VERSION + "/AUTH_" + str(account)
-            swift_client.delete_object(url, token, 'dependency', dependency["name"], None, None, None, None, response)
+            with timed('swift'):
+                swift_client.delete_object(url, token, 'dependency', dependency["name"], None, None, None, None, response)
         except ClientException:
             return JSONResponse(response.get("reason"), status=response.get('status'))
 
         swift_status = response.get('status')
 
         if 200 <= swift_status < 300:
-            r.delete("AUTH_" + str(account) + ":dependency:" + str(dependency["name"]))
-            r.lrem("AUTH_" + str(account) + ":dependencies", str(dependency["name"]), 1)
+            r.srem("AUTH_" + str(account) + ":dependencies", str(dependency["name"]))
+            publish_event(r, 'undeployed_dependency', dependency['name'], str(account))
             return JSONResponse('The dependency has been deleted', status=swift_status)
 
         return JSONResponse(response.get("reason"), status=swift_status)
@@ -553,6 +654,7 @@ def slo_list(request):
         try:
             slo_key = ':'.join(['SLO', data['dsl_filter'], data['slo_name'], data['target']])
             r.set(slo_key, data['value'])
+            publish_event(r, 'slo', data['dsl_filter'] + ':' + data['slo_name'], data['target'])
 
             return JSONResponse(data, status=status.HTTP_201_CREATED)
         except DataError:
@@ -586,44 +688,217 @@ def slo_detail(request, dsl_filter, slo_name, target):
         data = JSONParser().parse(request)
         try:
             r.set(slo_key, data['value'])
+            publish_event(r, 'slo', dsl_filter + ':' + slo_name, target)
             return JSONResponse('Data updated', status=status.HTTP_201_CREATED)
         except DataError:
             return JSONResponse('Error updating data', status=status.HTTP_400_BAD_REQUEST)
 
     elif request.method == 'DELETE':
         r.delete(slo_key)
+        publish_event(r, 'slo', dsl_filter + ':' + slo_name, target)
         return JSONResponse('SLA has been deleted', status=status.HTTP_204_NO_CONTENT)
     return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
 
-def set_filter(r, target, filter_data, parameters, token):
-    if filter_data['filter_type'] == 'storlet':
-        metadata = {"X-Object-Meta-Storlet-Language": 'java',
-                    "X-Object-Meta-Storlet-Interface-Version": filter_data["interface_version"],
-                    "X-Object-Meta-Storlet-Dependency": filter_data["dependencies"],
-                    "X-Object-Meta-Storlet-Object-Metadata": filter_data["object_metadata"],
-                    "X-Object-Meta-Storlet-Main": filter_data["main"]
-                    }
+def _storlet_metadata(filter_data):
+    return {"X-Object-Meta-Storlet-Language": 'java',
+            "X-Object-Meta-Storlet-Interface-Version": filter_data["interface_version"],
+            "X-Object-Meta-Storlet-Dependency": filter_data["dependencies"],
+            "X-Object-Meta-Storlet-Object-Metadata": filter_data["object_metadata"],
+            "X-Object-Meta-Storlet-Main": filter_data["main"]
+            }
+
+
+def _is_storlet_deployed(headers, etag, metadata):
+    """
+    Checks the headers of a HEAD to a storlet object against the etag and metadata it should have.
+    """
+    if headers.get("etag") != etag:
+        return False
+    for key, value in metadata.items():
+        # Swift does not store empty metadata values
+        if headers.get(key.lower(), '') != str(value):
+            return False
+    return True
 
-        target_list = target.split('/', 3)
-        url = settings.SWIFT_URL + settings.SWIFT_API_VERSION + "/AUTH_" + str(target_list[0])
-        swift_response = dict()
 
+def upload_storlet(account, token, filter_data, http_conn=None):
+    """
+    Uploads a storlet to the 'storlet' container of an account. The upload is skipped if the account
+    already has an object with the same etag and storlet metadata. The etag and metadata known to be
+    deployed in each account are cached in Redis (for STORLET_DEPLOYED_CACHE_TTL seconds), so most
+    deployments skip the HEAD too. The HEAD and the PUT share the same Swift connection.
+
+    :param account: The account (project id) without the AUTH_ prefix
+    :param token: Auth token
+    :param filter_data: The filter (filter:<id> hash), with its path and etag
+    :param http_conn: A swiftclient http_connection for the account. A new one is created if not given.
+    :return: True if the storlet has been uploaded, False if the upload was skipped
+    :raises SwiftClientError: if the upload fails
+    """
+    r = get_redis_connection()
+    url = settings.SWIFT_URL + settings.SWIFT_API_VERSION + "/AUTH_" + str(account)
+    if http_conn is None:
+        http_conn = swift_client.http_connection(url)
+
+    etag = filter_data.get("etag")
+    metadata = _storlet_metadata(filter_data)
+    deployed_key = "storlet_deployed:AUTH_" + str(account) + ":" + str(filter_data["filter_name"])
+    deployed = json.dumps({"etag": etag, "metadata": metadata}, sort_keys=True)
+
+    if etag:
+        if r.get(deployed_key) == deployed:
+            logger.debug("Storlet " + filter_data["filter_name"] + " already deployed to AUTH_" + str(account) + " (cached)")
+            return False
         try:
-            storlet_file = open(filter_data["path"], 'r')
-            swift_client.put_object(url, token, "storlet", filter_data["filter_name"], storlet_file, None,
-                                    None, None, "application/octet-stream", metadata, None, None, None, swift_response)
-        except ClientException as e:
-            logging.error(str(e))
-            raise SwiftClientError("A problem occurred accessing Swift")
+            with timed('swift'):
+                headers = swift_client.head_object(url, token, "storlet", filter_data["filter_name"], http_conn=http_conn)
+            if _is_storlet_deployed(headers, etag, metadata):
+                logger.debug("Storlet " + filter_data["filter_name"] + " already deployed to AUTH_" + str(account))
+                r.setex(deployed_key, deployed, settings.STORLET_DEPLOYED_CACHE_TTL)
+                return False
+        except Exception as e:
+            # Usually a 404: the storlet is not in the account yet
+            logger.debug("HEAD storlet " + filter_data["filter_name"] + " in AUTH_" + str(account) + ": " + str(e))
 
-        finally:
-            storlet_file.close()
+    swift_response = dict()
+
+    try:
+        with open(filter_data["path"], 'r') as storlet_file:
+            with timed('swift'):
+                swift_client.put_object(url, token, "storlet", filter_data["filter_name"], storlet_file, None,
+                                        etag, None, "application/octet-stream", metadata, http_conn, None, None, swift_response)
+    except (ClientException, IOError) as e:
+        logging.error(str(e))
+        raise SwiftClientError("A problem occurred accessing Swift")
+
+    if swift_response.get("status") != status.HTTP_201_CREATED:
+        raise SwiftClientError("A problem occurred uploading Storlet to Swift")
 
-        swift_status = swift_response.get("status")
+    if etag:
+        r.setex(deployed_key, deployed, settings.STORLET_DEPLOYED_CACHE_TTL)
+    return True
 
-        if swift_status != status.HTTP_201_CREATED:
-            raise SwiftClientError("A problem occurred uploading Storlet to Swift")
+
+def upload_storlet_to_accounts(token, filter_data, accounts):
+    """
+    Uploads a storlet to several accounts concurrently, using up to settings.SWIFT_DEPLOY_MAX_WORKERS threads
+    and one Swift connection per account.
+
+    :return: Dict of account -> True if uploaded, False if it was already there
+    :raises SwiftClientError: if the upload fails for some account (the other accounts are still uploaded)
+    """
+    accounts = sorted(set(accounts))
+    if not accounts:
+        return {}
+
+    def upload(account):
+        try:
+            return upload_storlet(account, token, filter_data), None
+        except SwiftClientError as e:
+            return None, e
+
+    pool = ThreadPool(min(settings.SWIFT_DEPLOY_MAX_WORKERS, len(accounts)))
+    try:
+        results = pool.map(upload, accounts)
+    finally:
+        pool.close()
+        pool.join()
+
+    failed = [account for account, (_, error) in zip(accounts, results) if error]
+    if failed:
+        raise SwiftClientError("A problem occurred uploading Storlet to Swift accounts: " + ', '.join(failed))
+    return dict((account, uploaded) for account, (uploaded, _) in zip(accounts, results))
+
+
+def deploy_filter(r, filter_id, target, params, token):
+    """
+    Deploys a filter to a target (account[/container[/object]]) as a new static policy.
+    This is the internal API behind the deploy view, also used by the dynamic policy
+    rules when the activation URL of their DSL filter is this controller.
+
+    :param params: The policy parameters: object_type, object_size, params and
+                   optionally execution_server and execution_server_reverse
+    :param token: Used to upload the storlet to the account, if the filter is a storlet
+    :return: The id of the new static policy
+    :raises FilterNotFoundException: If the filter does not exist
+    """
+    filter_data = r.hgetall("filter:" + str(filter_id))
+    if not filter_data:
+        raise FilterNotFoundException('Filter does not exist')
+
+    # Get an identifier of this new policy
+    policy_id = r.incr("policies:id")
+
+    # Set the policy data
+    policy_data = {
+        "policy_id": policy_id,
+        "object_type": params['object_type'],
+        "object_size": params['object_size'],
+        "execution_order": policy_id,
+        "params": params['params'],
+        "callable": False
+    }
+
+    if params.get('execution_server', 'default') != 'default':
+        policy_data['execution_server'] = params['execution_server']
+
+    if params.get('execution_server_reverse', 'default') != 'default':
+        policy_data['execution_server_reverse'] = params['execution_server_reverse']
+
+    logger.debug(str(policy_data))
+
+    set_filter(r, target, filter_data, policy_data, token)
+    return policy_id
+
+
+def undeploy_filter(r, filter_id, target, token):
+    """
+    Removes the static policies of a filter from a target (account[/container[/object]]).
+    Internal API behind the undeploy view, also used by the dynamic policy rules.
+
+    :raises FilterNotFoundException: If the filter does not exist or is not deployed to the target
+    :raises SwiftClientError: If the storlet could not be deleted from the account
+    """
+    filter_data = r.hgetall("filter:" + str(filter_id))
+    if not filter_data:
+        raise FilterNotFoundException('Filter does not exist')
+
+    if not get_filter_policies(r, filter_data["filter_name"], str(target).replace('/', ':')):
+        raise FilterNotFoundException('Filter ' + str(filter_data["filter_name"]) + ' has not been deployed already')
+
+    swift_status = unset_filter(r, target, filter_data, token)
+    if swift_status is not None:
+        raise SwiftClientError('A problem occurred deleting the storlet from Swift: ' + str(swift_status))
+
+
+def delete_static_policy(r, target, policy_id):
+    """
+    Deletes a static policy from the pipeline of a target (account[:container[:object]]).
+
+    :return: If the policy existed
+    """
+    policy_redis = r.hget('pipeline:AUTH_' + target, policy_id)
+    if not policy_redis:
+        return False
+    filter_name = json.loads(policy_redis)['filter_name']
+    pipe = r.pipeline()
+    pipe.hdel('pipeline:AUTH_' + target, policy_id)
+    pipe.srem("filter_policies:" + str(filter_name), target + ":" + policy_id)
+    pipe.execute()
+    pipeline_doc = compile_pipeline(r, target)
+    publish_event(r, 'static_policy', policy_id, target, pipeline_doc['version'])
+    return True
+
+
+def set_filter(r, target, filter_data, parameters, token, upload=True):
+    """
+    Deploys a filter to a target (account[/container[/object]]): uploads the storlet to the account (unless
+    upload is False, when it has already been uploaded with upload_storlet_to_accounts) and adds the policy
+    to the pipeline of the target.
+    """
+    if filter_data['filter_type'] == 'storlet' and upload:
+        upload_storlet(target.split('/', 3)[0], token, filter_data)
 
     if not parameters:
         parameters = {}
@@ -642,7 +917,30 @@ def set_filter(r, target, filter_data, parameters, token):
 
     data_dumped = json.dumps(data).replace('"True"', 'true').replace('"False"', 'false')
 
-    r.hset("pipeline:AUTH_" + str(target), policy_id, data_dumped)
+    pipe = r.pipeline()
+    pipe.hset("pipeline:AUTH_" + str(target), policy_id, data_dumped)
+    pipe.sadd("filter_policies:" + str(data["filter_name"]), str(target) + ":" + str(policy_id))
+    pipe.execute()
+    pipeline_doc = compile_pipeline(r, target)
+    publish_event(r, 'static_policy', policy_id, target, pipeline_doc['version'])
+
+
+def get_filter_policies(r, filter_name, target=None):
+    """
+    Returns the static policies that use a filter, as a list of (target, policy_id) tuples.
+    The 'filter_policies:<filter_name>' sets are a reverse index of the pipeline:AUTH_* hashes,
+    so no pipeline entry needs to be decoded.
+
+    :param r: Redis connection
+    :param filter_name: The name of the filter (e.g. "compression-1.0.jar")
+    :param target: If given, only the policies of this target are returned
+    """
+    policies = []
+    for entry in r.smembers("filter_policies:" + str(filter_name)):
+        policy_target, policy_id = entry.rsplit(':', 1)
+        if target is None or policy_target == target:
+            policies.append((policy_target, policy_id))
+    return policies
 
 
 # FOR TENANT:4f0279da74ef4584a29dc72c835fe2c9 DO DELETE compression
@@ -652,16 +950,94 @@ def unset_filter(r, target, filter_data, token):
         try:
             target_list = target.split('/', 3)
             url = settings.SWIFT_URL + settings.SWIFT_API_VERSION + "/AUTH_" + str(target_list[0])
-            swift_client.delete_object(url, token, "storlet", filter_data["filter_name"], None, None, None, None, swift_response)
+            r.delete("storlet_deployed:AUTH_" + str(target_list[0]) + ":" + str(filter_data["filter_name"]))
+            with timed('swift'):
+                swift_client.delete_object(url, token, "storlet", filter_data["filter_name"], None, None, None, None, swift_response)
         except ClientException as e:
-            print swift_response + str(e)
+            logger.error('Error deleting storlet ' + str(filter_data['filter_name']) + ': ' + str(e))
             return swift_response.get("status")
 
-    keys = r.hgetall("pipeline:AUTH_" + str(target))
-    for key, value in keys.items():
-        json_value = json.loads(value)
-        if json_value["filter_name"] == filter_data["filter_name"]:
-            r.hdel("pipeline:AUTH_" + str(target), key)
+    target = str(target).replace('/', ':')
+    policies = get_filter_policies(r, filter_data["filter_name"], target)
+    if policies:
+        pipe = r.pipeline()
+        for policy_target, policy_id in policies:
+            pipe.hdel("pipeline:AUTH_" + policy_target, policy_id)
+            pipe.srem("filter_policies:" + str(filter_data["filter_name"]), policy_target + ":" + policy_id)
+        pipe.execute()
+        pipeline_doc = compile_pipeline(r, target)
+        for policy_target, policy_id in policies:
+            publish_event(r, 'static_policy', policy_id, policy_target, pipeline_doc['version'])
+
+
+def _policy_stages(policy):
+    """
+    Returns the (method, server, reverse) stages where a static policy is executed.
+    A filter runs on the methods flagged by its is_pre/post_put/get keys (PUT if none is set)
+    on its execution_server. Filters with has_reverse also run on the opposite method on
+    their execution_server_reverse.
+    """
+    methods = []
+    if policy.get('is_pre_put') or policy.get('is_post_put'):
+        methods.append('PUT')
+    if policy.get('is_pre_get') or policy.get('is_post_get'):
+        methods.append('GET')
+    if not methods:
+        methods.append('PUT')
+
+    server = policy.get('execution_server') or 'proxy'
+    stages = [(method, server, False) for method in methods]
+    if policy.get('has_reverse'):
+        reverse_server = policy.get('execution_server_reverse') or server
+        for method in methods:
+            stages.append(('GET' if method == 'PUT' else 'PUT', reverse_server, True))
+    return stages
+
+
+def compile_pipeline(r, target):
+    """
+    Builds the precompiled pipeline document of a target from its pipeline:AUTH_<target> hash and
+    stores it in pipeline_doc:AUTH_<target>. The document is already split into GET/PUT stages and
+    proxy/object servers, and each stage is sorted by execution_order, so the Swift middleware only
+    has to decode one JSON string per request. The version is also stored in
+    pipeline_version:AUTH_<target>, so readers can cache the document and revalidate it with one GET.
+
+    :param r: Redis connection
+    :param target: The target, with ':' as separator (e.g. "0123456789abcdef:container1")
+    :return: The new pipeline document
+    """
+    pipeline_key = "pipeline:AUTH_" + str(target)
+    version_key = "pipeline_version:AUTH_" + str(target)
+    doc_key = "pipeline_doc:AUTH_" + str(target)
+
+    with r.pipeline() as pipe:
+        while True:
+            try:
+                # Retry if another policy write for this target happens while compiling
+                pipe.watch(pipeline_key, version_key)
+                policies = pipe.hgetall(pipeline_key)
+                version = int(pipe.get(version_key) or 0) + 1
+
+                document = {'version': version,
+                            'GET': {'proxy': [], 'object': []},
+                            'PUT': {'proxy': [], 'object': []}}
+                for policy_id, policy_dumped in policies.items():
+                    policy = json.loads(policy_dumped)
+                    policy['policy_id'] = policy_id
+                    for method, server, reverse in _policy_stages(policy):
+                        entry = dict(policy, reverse=reverse)
+                        document[method].setdefault(server, []).append(entry)
+                for method in ('GET', 'PUT'):
+                    for server in document[method]:
+                        document[method][server].sort(key=lambda p: int(p.get('execution_order') or 0))
+
+                pipe.multi()
+                pipe.set(version_key, version)
+                pipe.set(doc_key, json.dumps(document))
+                pipe.execute()
+                return document
+            except WatchError:
+                continue
 
 
 def make_sure_path_exists(path):
@@ -676,17 +1052,50 @@ def save_file(file_, path=''):
     """
     Little helper to save a file
     """
-    filename = file_.name
-    fd = open(str(path) + "/" + str(filename), 'wb')
-    for chunk in file_.chunks():
-        fd.write(chunk)
-    fd.close()
-    return str(path) + "/" + str(filename)
+    return store_file(file_, path)[0]
 
 
-def md5(fname):
+def check_upload_size(request):
+    """
+    Raises FileTooLargeException if the request announces a body bigger than settings.MAX_UPLOAD_SIZE,
+    so too large uploads are rejected before they are read.
+    """
+    content_length = request.META.get('CONTENT_LENGTH')
+    if content_length and int(content_length) > settings.MAX_UPLOAD_SIZE:
+        raise FileTooLargeException('Files cannot be bigger than ' + str(settings.MAX_UPLOAD_SIZE) + ' bytes')
+
+
+def store_file(file_, path=''):
+    """
+    Saves an uploaded file computing its md5 while it is written, so it does not need to be read again.
+    The file is written to a temporary file in the same directory and then renamed, so readers never
+    see a partially written file.
+
+    :param file_: The uploaded file (django UploadedFile)
+    :param path: The destination directory
+    :return: (file path, md5, size in bytes)
+    :raises FileTooLargeException: if the file is bigger than settings.MAX_UPLOAD_SIZE
+    """
+    if file_.size is not None and file_.size > settings.MAX_UPLOAD_SIZE:
+        raise FileTooLargeException('Files cannot be bigger than ' + str(settings.MAX_UPLOAD_SIZE) + ' bytes')
+
+    file_path = str(path) + "/" + str(file_.name)
     hash_md5 = hashlib.md5()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+    size = 0
+    fd = tempfile.NamedTemporaryFile(dir=str(path), prefix='.' + str(file_.name) + '.', delete=False)
+    try:
+        for chunk in file_.chunks(settings.UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > settings.MAX_UPLOAD_SIZE:
+                raise FileTooLargeException('Files cannot be bigger than ' + str(settings.MAX_UPLOAD_SIZE) + ' bytes')
             hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+            fd.write(chunk)
+        fd.close()
+        # Temporary files are created with 0600, give the file the usual permissions (it is also synced to the nodes)
+        os.chmod(fd.name, 0644)
+        os.rename(fd.name, file_path)
+    except:
+        fd.close()
+        os.remove(fd.name)
+        raise
+    return file_path, hash_md5.hexdigest(), size
@@ -0,0 +1,135 @@
+"""
+Background job handlers of the swift app (see api/jobs.py and settings.JOB_HANDLERS).
+"""
+import logging
+import time
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+from api.common_utils import get_redis_connection
+from api.exceptions import JobFailedException
+from api.process import ProcessRunner
+
+import sds_project
+import storage_policies_utils
+
+logger = logging.getLogger(__name__)
+
+
+def create_storage_policy(job):
+    storage_policies_utils.create(job.data, job.log_lines, job.cancelled, job.set_progress)
+
+
+def create_project(job):
+    sds_project.add_new_sds_project(job.data['tenant_name'], job.log_lines, job.cancelled)
+
+
+def restart_node(job):
+    r = get_redis_connection()
+    node = r.hgetall('node:' + str(job.data['node_id']))
+    if not node:
+        raise Exception('Node ' + str(job.data['node_id']) + ' not found')
+
+    job.log('Restarting ' + node['ip'])
+    _restart_node(node, job.log_lines, job.cancelled)
+    logger.debug('Node ' + str(job.data['node_id']) + ' was restarted!')
+
+
+def _restart_node(node, log, cancelled=None):
+    restart_command = ['sshpass', '-p', node['ssh_password'], 'ssh', node['ssh_username'] + '@' + node['ip'],
+                       'sudo', 'swift-init', 'main', 'restart']
+    ProcessRunner(restart_command, on_output=log, timeout=settings.NODE_RESTART_TIMEOUT, cancelled=cancelled).run()
+
+
+def restart_batches(nodes, batch_size, strategy):
+    """
+    Splits the nodes in the batches restarted together. Storage nodes go before
+    proxies, so that the API is the last to go down.
+    With the 'zone' strategy a batch never mixes nodes of different zones, and
+    zones are restarted one after the other.
+    """
+    nodes = sorted(nodes, key=lambda node: (node.get('type') == 'proxy', node['name']))
+    if strategy == 'zone':
+        groups = dict()
+        for node in nodes:
+            groups.setdefault(node.get('zone', ''), []).append(node)
+        # Zones with only proxies go last too
+        groups = sorted(groups.values(), key=lambda group: (group[0].get('type') == 'proxy', group[0].get('zone', '')))
+    else:
+        groups = [nodes]
+
+    batches = []
+    for group in groups:
+        batches.extend(group[i:i + batch_size] for i in range(0, len(group), batch_size))
+    return batches
+
+
+def wait_for_heartbeat(r, node_name, since, timeout):
+    """
+    Waits until the node sends a heartbeat (the last_ping of its node:<name> hash) after `since`.
+    Returns the seconds it took, or None if it did not within `timeout` seconds.
+    """
+    deadline = since + timeout
+    while True:
+        last_ping = r.hget('node:' + node_name, 'last_ping')
+        if last_ping and float(last_ping) > since:
+            return round(time.time() - since, 3)
+        if time.time() > deadline:
+            return None
+        time.sleep(settings.NODE_HEALTH_CHECK_INTERVAL)
+
+
+def restart_cluster(job):
+    """
+    Rolling restart of the Swift nodes. Each batch is restarted in parallel and
+    the next one starts only when all its nodes have sent a heartbeat again;
+    the rollout stops at the first batch with a failed or unhealthy node.
+
+    Returns the per-node report: status (restarted, failed, unhealthy or skipped),
+    the duration of the restart command and the time until the first heartbeat
+    after it. A stopped rollout fails the job, with the report as its result.
+    """
+    r = get_redis_connection()
+    nodes = []
+    for node_name in job.data['nodes']:
+        node = r.hgetall('node:' + node_name)
+        if not node:
+            raise Exception('Node ' + node_name + ' not found')
+        nodes.append(node)
+
+    batches = restart_batches(nodes, job.data['batch_size'], job.data['strategy'])
+    report = dict((node['name'], {'status': 'skipped', 'batch': i + 1}) for i, batch in enumerate(batches) for node in batch)
+
+    def restart(node):
+        result = report[node['name']]
+        start = time.time()
+        try:
+            _restart_node(node, lambda lines: job.log_lines([node['name'] + ': ' + line for line in lines]), job.cancelled)
+        except Exception as e:
+            result.update({'status': 'failed', 'error': str(e), 'restart_time': round(time.time() - start, 3)})
+            return
+        restarted = time.time()
+        result['restart_time'] = round(restarted - start, 3)
+        healthy_after = wait_for_heartbeat(r, node['name'], restarted, settings.NODE_HEALTH_CHECK_TIMEOUT)
+        if healthy_after is None:
+            result['status'] = 'unhealthy'
+        else:
+            result.update({'status': 'restarted', 'healthy_after': healthy_after})
+
+    pool = ThreadPool(job.data['batch_size'])
+    try:
+        for i, batch in enumerate(batches):
+            job.check_cancelled()
+            names = [node['name'] for node in batch]
+            job.set_progress('Batch ' + str(i + 1) + '/' + str(len(batches)) + ': ' + ', '.join(names))
+            job.log('Restarting ' + ', '.join(names))
+            pool.map(restart, batch)
+            failed = [name for name in names if report[name]['status'] != 'restarted']
+            if failed:
+                raise JobFailedException('Rollout stopped at batch ' + str(i + 1) + ': ' + ', '.join(failed) + ' did not come back', report)
+    finally:
+        pool.close()
+
+    job.set_progress('Restarted ' + str(len(report)) + ' nodes')
+    return report
@@ -1,5 +1,7 @@
 import json
+import time
 
+import mock
 import redis
 from django.conf import settings
 from django.test import TestCase, override_settings
@@ -7,7 +9,10 @@ from django.test.client import RequestFactory
 from rest_framework import status
 from rest_framework.test import APIRequestFactory
 
-from .views import tenants_list, storage_policy_list, storage_policies, locality_list, sort_list, sort_detail, node_list, node_detail
+from .views import tenants_list, storage_policy_list, storage_policies, locality_list, sort_list, sort_detail, node_list, node_detail, \
+    node_restart, cluster_restart, decoded_devices
+from .jobs import restart_batches, restart_cluster, wait_for_heartbeat
+from api.exceptions import JobFailedException
 
 
 # Tests use database=10 instead of 0.
@@ -198,6 +203,29 @@ class SwiftTestCase(TestCase):
         a_device = nodes[0]['devices'].keys()[0]
         self.assertIsNotNone(nodes[0]['devices'][a_device]['free'])
 
+    def test_list_nodes_by_status(self):
+        self.r.zadd('nodes:heartbeat', storagenode2=time.time())
+        request = self.api_factory.get('/swift/nodes', {'status': 'up'})
+        response = node_list(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([node['name'] for node in json.loads(response.content)], ['storagenode2'])
+
+        request = self.api_factory.get('/swift/nodes', {'status': 'down'})
+        response = node_list(request)
+        self.assertEqual([node['name'] for node in json.loads(response.content)], ['controller', 'storagenode1'])
+
+        request = self.api_factory.get('/swift/nodes', {'status': 'unknown'})
+        response = node_list(request)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_decoded_devices_are_cached(self):
+        node = self.r.hgetall('node:storagenode1')
+        devices = decoded_devices(node)
+        self.assertEqual(devices['sdb1']['size'], 16832880640)
+        self.assertIs(decoded_devices(node), devices)
+        node['devices'] = '{"sdb1": {"free": 1, "size": 16832880640}}'
+        self.assertEqual(decoded_devices(node)['sdb1']['free'], 1)
+
     def test_node_detail_with_method_not_allowed(self):
         node_name = 'storagenode1'
         # POST is not supported
@@ -230,6 +258,90 @@ class SwiftTestCase(TestCase):
         response = node_detail(request, node_name)
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_node_restart_queues_a_job(self):
+        request = self.api_factory.put('/swift/nodes/storagenode1/restart')
+        response = node_restart(request, 'storagenode1')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        job_id = json.loads(response.content)['job_id']
+        self.assertEqual(response['Location'], '/controller/jobs/' + str(job_id))
+        self.assertEqual(self.r.hget('job:' + str(job_id), 'type'), 'restart_node')
+        self.assertEqual(self.r.lrange('jobs:queue', 0, -1), [str(job_id)])
+
+        # The node is locked until the job finishes
+        response = node_restart(request, 'storagenode1')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(json.loads(response.content)['job_id'], str(job_id))
+
+    def test_node_restart_with_non_existent_node_name(self):
+        request = self.api_factory.put('/swift/nodes/storagenode1000/restart')
+        response = node_restart(request, 'storagenode1000')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_create_tenant_queues_a_job(self):
+        request = self.api_factory.post('/swift/tenants', {'tenant_name': 'tenant1'}, format='json')
+        request.META['HTTP_X_AUTH_TOKEN'] = 'fake_token'
+        response = tenants_list(request)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        job_id = json.loads(response.content)['job_id']
+        self.assertEqual(json.loads(self.r.hget('job:' + str(job_id), 'data')), {'tenant_name': 'tenant1'})
+
+    def test_cluster_restart_queues_a_job(self):
+        request = self.api_factory.put('/swift/nodes/restart', {'batch_size': 3, 'strategy': 'zone'}, format='json')
+        response = cluster_restart(request)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        job_id = json.loads(response.content)['job_id']
+        self.assertEqual(json.loads(self.r.hget('job:' + str(job_id), 'data')),
+                         {'nodes': ['controller', 'storagenode1', 'storagenode2'], 'batch_size': 3, 'strategy': 'zone'})
+
+    def test_cluster_restart_with_invalid_request(self):
+        request = self.api_factory.put('/swift/nodes/restart', {'batch_size': 0}, format='json')
+        response = cluster_restart(request)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        request = self.api_factory.put('/swift/nodes/restart', {'nodes': ['storagenode1000']}, format='json')
+        response = cluster_restart(request)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        # An empty list does not mean all the nodes
+        request = self.api_factory.put('/swift/nodes/restart', {'nodes': []}, format='json')
+        response = cluster_restart(request)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(self.r.keys('job:*'))
+
+    def test_cluster_restart_restarts_each_node_once(self):
+        request = self.api_factory.put('/swift/nodes/restart', {'nodes': ['storagenode2', 'storagenode1', 'storagenode2']}, format='json')
+        response = cluster_restart(request)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        job_id = json.loads(response.content)['job_id']
+        self.assertEqual(json.loads(self.r.hget('job:' + str(job_id), 'data'))['nodes'], ['storagenode1', 'storagenode2'])
+
+    def test_restart_batches(self):
+        nodes = [{'name': 'proxy1', 'type': 'proxy'}, {'name': 'node3', 'type': 'object', 'zone': '2'},
+                 {'name': 'node1', 'type': 'object', 'zone': '1'}, {'name': 'node2', 'type': 'object', 'zone': '2'}]
+        names = lambda batches: [[node['name'] for node in batch] for batch in batches]
+        self.assertEqual(names(restart_batches(nodes, 2, 'rolling')), [['node1', 'node2'], ['node3', 'proxy1']])
+        self.assertEqual(names(restart_batches(nodes, 2, 'zone')), [['node1'], ['node2', 'node3'], ['proxy1']])
+
+    @mock.patch('swift.jobs.wait_for_heartbeat')
+    @mock.patch('swift.jobs._restart_node')
+    def test_restart_cluster_stops_at_unhealthy_batch(self, mock_restart_node, mock_wait_for_heartbeat):
+        mock_wait_for_heartbeat.side_effect = lambda r, name, since, timeout: None if name == 'storagenode1' else 1.5
+        job = mock.Mock(data={'nodes': ['controller', 'storagenode1', 'storagenode2'], 'batch_size': 1, 'strategy': 'rolling'})
+        job.cancelled.return_value = False
+        with self.assertRaises(JobFailedException) as cm:
+            restart_cluster(job)
+        report = cm.exception.result
+        self.assertEqual(report['storagenode1']['status'], 'unhealthy')
+        self.assertEqual(report['storagenode2']['status'], 'skipped')
+        self.assertEqual(report['controller']['status'], 'skipped')
+        self.assertEqual(mock_restart_node.call_count, 1)
+
+    @override_settings(NODE_HEALTH_CHECK_INTERVAL=0.01)
+    def test_wait_for_heartbeat(self):
+        since = time.time()
+        self.assertIsNone(wait_for_heartbeat(self.r, 'storagenode1', since, 0.05))
+        # The nodes only update their hash
+        self.r.hset('node:storagenode1', 'last_ping', since + 1)
+        self.assertIsNotNone(wait_for_heartbeat(self.r, 'storagenode1', since, 0.05))
+
     #
     # Aux functions
     #
@@ -257,3 +369,4 @@ class SwiftTestCase(TestCase):
         self.r.hmset('node:storagenode2',
                      {'ip': '192.168.2.3', 'last_ping': '1467623304.332646', 'type': 'object', 'name': 'storagenode2',
                       'devices': '{"sdb1": {"free": 16832876544, "size": 16832880640}}'})
+        self.r.zadd('nodes:heartbeat', controller=1467623304.332646, storagenode1=1467623304.332646, storagenode2=1467623304.332646)
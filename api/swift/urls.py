@@ -12,6 +12,7 @@ urlpatterns = [
 
     # Node status
     url(r'^/nodes/?$', views.node_list),
+    url(r'^/nodes/restart/?$', views.cluster_restart),
     url(r'^/nodes/(?P<node_id>[^/]+)/?$', views.node_detail),
     url(r'^/nodes/(?P<node_id>[^/]+)/restart/?$', views.node_restart)
 ]
@@ -1,6 +1,5 @@
 import json
 import logging
-import os
 import redis
 import requests
 from django.conf import settings
@@ -12,13 +11,35 @@ from rest_framework.exceptions import ParseError
 from rest_framework.parsers import JSONParser
 from operator import itemgetter
 
-import sds_project
-import storage_policies_utils
-from api.common_utils import JSONResponse, get_redis_connection, get_token_connection
-from api.exceptions import FileSynchronizationException
+from api.common_utils import JSONResponse, get_redis_connection, get_token_connection, get_nodes, get_up_node_names, \
+    record_node_heartbeat, NODE_HEARTBEAT_KEY
+from api.exceptions import JobLockedException
+from api.instrumentation import timed
+from api.jobs import submit_job
 
 logger = logging.getLogger(__name__)
 
+# Decoded 'devices' of each node: node name -> (devices JSON, devices dict)
+devices_cache = dict()
+
+
+def job_accepted(job_type, data, resource):
+    """
+    Submits a background job and returns the 202 response with its id,
+    or 409 if another job holds the resource.
+    """
+    try:
+        r = get_redis_connection()
+        job_id = submit_job(r, job_type, data, resource)
+    except RedisError:
+        return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    except JobLockedException as e:
+        return JSONResponse({'message': str(e), 'job_id': e.job_id}, status=status.HTTP_409_CONFLICT)
+    response = JSONResponse({'job_id': job_id, 'status': 'queued'}, status=status.HTTP_202_ACCEPTED)
+    response['Location'] = '/controller/jobs/' + str(job_id)
+    return response
+
+
 @csrf_exempt
 def tenants_list(request):
     """
@@ -27,18 +48,18 @@ def tenants_list(request):
     token = get_token_connection(request)
 
     if request.method == 'GET':
-        r = requests.get(settings.KEYSTONE_URL + "/tenants", headers={'X-Auth-Token': token})
+        with timed('keystone'):
+            r = requests.get(settings.KEYSTONE_URL + "/tenants", headers={'X-Auth-Token': token})
         return HttpResponse(r.content, content_type='application/json', status=r.status_code)
 
     if request.method == "POST":
-        data = JSONParser().parse(request)
-
         try:
-            sds_project.add_new_sds_project(data["tenant_name"])
-        except Exception:
-            return JSONResponse('Error creating a new project.', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            data = JSONParser().parse(request)
+            tenant_name = data["tenant_name"]
+        except (ParseError, KeyError, TypeError):
+            return JSONResponse("Invalid format or empty request", status=status.HTTP_400_BAD_REQUEST)
 
-        return JSONResponse('Account created successfully', status=status.HTTP_201_CREATED)
+        return job_accepted('create_project', {'tenant_name': tenant_name}, 'project:' + str(tenant_name))
 
     return JSONResponse('Only HTTP GET /tenants/ requests allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
@@ -78,10 +99,8 @@ def storage_policies(request):
             for k, v in data["storage_node"].items():
                 storage_nodes_list.extend([k, v])
             data["storage_node"] = ','.join(map(str, storage_nodes_list))
-            try:
-                storage_policies_utils.create(data)
-            except Exception as e:
-                return JSONResponse('Error creating the Storage Policy: ' + e, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            # Rings are rebuilt and distributed one storage policy at a time
+            return job_accepted('create_storage_policy', data, 'storage_policies')
 
         return JSONResponse('Account created successfully', status=status.HTTP_201_CREATED)
     return JSONResponse('Only HTTP POST requests allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
@@ -95,12 +114,13 @@ def locality_list(request, account, container=None, swift_object=None):
     """
 
     if request.method == 'GET':
-        if not container:
-            r = requests.get(settings.SWIFT_URL + "/endpoints/v2/" + account)
-        elif not swift_object:
-            r = requests.get(settings.SWIFT_URL + "/endpoints/v2/" + account + "/" + container)
-        elif container and swift_object:
-            r = requests.get(settings.SWIFT_URL + "/endpoints/v2/" + account + "/" + container + "/" + swift_object)
+        with timed('swift'):
+            if not container:
+                r = requests.get(settings.SWIFT_URL + "/endpoints/v2/" + account)
+            elif not swift_object:
+                r = requests.get(settings.SWIFT_URL + "/endpoints/v2/" + account + "/" + container)
+            elif container and swift_object:
+                r = requests.get(settings.SWIFT_URL + "/endpoints/v2/" + account + "/" + container + "/" + swift_object)
         return HttpResponse(r.content, content_type='application/json', status=r.status_code)
     return JSONResponse('Only HTTP GET /locality/ requests allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
@@ -174,10 +194,21 @@ def sort_detail(request, sort_id):
 # Node part
 #
 
+def decoded_devices(node):
+    """
+    The 'devices' of a node as a dict. The JSON is only decoded when it changes.
+    """
+    cached = devices_cache.get(node['name'])
+    if cached is None or cached[0] != node['devices']:
+        cached = (node['devices'], json.loads(node['devices']))
+        devices_cache[node['name']] = cached
+    return cached[1]
+
+
 @csrf_exempt
 def node_list(request):
     """
-    GET: List all nodes ordered by name
+    GET: List all nodes ordered by name. ?status=up lists only the nodes with a recent heartbeat, ?status=down the rest.
     """
 
     try:
@@ -186,14 +217,22 @@ def node_list(request):
         return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     if request.method == 'GET':
-        keys = r.keys("node:*")
-        nodes = []
-        for key in keys:
-            node = r.hgetall(key)
+        node_status = request.GET.get('status')
+        if node_status == 'up':
+            node_names = get_up_node_names(r)
+        elif node_status == 'down':
+            up_node_names = set(get_up_node_names(r))
+            node_names = [key.split(':', 1)[1] for key in r.keys("node:*") if key.split(':', 1)[1] not in up_node_names]
+        elif node_status is None:
+            node_names = [key.split(':', 1)[1] for key in r.keys("node:*")]
+        else:
+            return JSONResponse("Invalid status, it must be 'up' or 'down'", status=status.HTTP_400_BAD_REQUEST)
+
+        nodes = get_nodes(r, node_names)
+        for node in nodes:
             node.pop("ssh_username", None)  # username & password are not returned in the list
             node.pop("ssh_password", None)
-            node['devices'] = json.loads(node['devices'])
-            nodes.append(node)
+            node['devices'] = decoded_devices(node)
         sorted_list = sorted(nodes, key=itemgetter('name'))
         return JSONResponse(sorted_list, status=status.HTTP_200_OK)
 
@@ -219,7 +258,7 @@ def node_detail(request, node_id):
         if r.exists(key):
             node = r.hgetall(key)
             node.pop("ssh_password", None)  # password is not returned
-            node['devices'] = json.loads(node['devices'])
+            node['devices'] = decoded_devices(node)
             return JSONResponse(node, status=status.HTTP_200_OK)
         else:
             return JSONResponse('Node not found.', status=status.HTTP_404_NOT_FOUND)
@@ -228,7 +267,10 @@ def node_detail(request, node_id):
         if r.exists(key):
             data = JSONParser().parse(request)
             try:
-                r.hmset(key, data)
+                if 'last_ping' in data:
+                    record_node_heartbeat(r, node_id, data)
+                else:
+                    r.hmset(key, data)
                 return JSONResponse("Data updated", status=status.HTTP_201_CREATED)
             except RedisError:
                 return JSONResponse("Error updating data", status=status.HTTP_400_BAD_REQUEST)
@@ -238,7 +280,11 @@ def node_detail(request, node_id):
     if request.method == 'DELETE':
         # Deletes the key. If the node is alive, the metric middleware will recreate this key again.
         if r.exists(key):
-            node = r.delete(key)
+            pipe = r.pipeline()
+            pipe.delete(key)
+            pipe.zrem(NODE_HEARTBEAT_KEY, node_id)
+            pipe.execute()
+            devices_cache.pop(node_id, None)
             return JSONResponse('Node has been deleted', status=status.HTTP_204_NO_CONTENT)
         else:
             return JSONResponse('Node not found.', status=status.HTTP_404_NOT_FOUND)
@@ -256,20 +302,47 @@ def node_restart(request, node_id):
     logger.debug('Node id: ' + str(node_id))
 
     if request.method == 'PUT':
-        node = r.hgetall('node:' + str(node_id))
-        logger.debug('Node data: ' + str(node))
+        if not r.exists('node:' + str(node_id)):
+            return JSONResponse('Node not found.', status=status.HTTP_404_NOT_FOUND)
+        return job_accepted('restart_node', {'node_id': node_id}, 'node:' + str(node_id))
+
+    logger.error('Method ' + str(request.method) + ' not allowed.')
+    return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
-        data = {'node_ip': node['ip'], 'ssh_username': node['ssh_username'], 'ssh_password': node['ssh_password']}
-        restart_command = 'sshpass -p {ssh_password} ssh {ssh_username}@{node_ip} sudo swift-init main restart'.format(**data)
-        logger.debug('Command: ' + str(restart_command))
 
-        ret = os.system(restart_command)
-        if ret != 0:
-            logger.error('An error occurred restarting Swift nodes')
-            raise FileSynchronizationException("An error occurred restarting Swift nodes")
+@csrf_exempt
+def cluster_restart(request):
+    """
+    PUT: Rolling restart of the Swift nodes, as a background job:
+    {"nodes": [<node_id>, ...], "batch_size": <n>, "strategy": "rolling" | "zone"}
+    All the nodes are restarted when "nodes" is not given, CLUSTER_RESTART_BATCH_SIZE at a time.
+    """
+    try:
+        r = get_redis_connection()
+    except RedisError:
+        return JSONResponse('Error connecting with DB', status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        logger.debug('Node ' + str(node_id) + ' was restarted!')
-        return JSONResponse('The node was restarted successfully.', status=status.HTTP_200_OK)
+    if request.method == 'PUT':
+        try:
+            data = JSONParser().parse(request) if request.body else {}
+            if 'nodes' in data:
+                nodes = set(str(node_id) for node_id in data['nodes'])
+            else:
+                nodes = set(key.split(':', 1)[1] for key in r.keys('node:*'))
+            batch_size = int(data.get('batch_size', settings.CLUSTER_RESTART_BATCH_SIZE))
+            strategy = data.get('strategy', 'rolling')
+        except (ParseError, AttributeError, TypeError, ValueError):
+            return JSONResponse("Invalid format or empty request", status=status.HTTP_400_BAD_REQUEST)
+        if 'nodes' in data and not nodes:
+            return JSONResponse('The list of nodes to restart is empty.', status=status.HTTP_400_BAD_REQUEST)
+        if batch_size < 1 or strategy not in ('rolling', 'zone'):
+            return JSONResponse("batch_size must be positive and strategy 'rolling' or 'zone'", status=status.HTTP_400_BAD_REQUEST)
+        if not nodes:
+            return JSONResponse('There are no nodes to restart.', status=status.HTTP_404_NOT_FOUND)
+        for node_id in nodes:
+            if not r.exists('node:' + node_id):
+                return JSONResponse('Node ' + node_id + ' not found.', status=status.HTTP_404_NOT_FOUND)
+
+        return job_accepted('restart_cluster', {'nodes': sorted(nodes), 'batch_size': batch_size, 'strategy': strategy}, 'cluster')
 
-    logger.error('Method ' + str(request.method) + ' not allowed.')
-    return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)
\ No newline at end of file
+    return JSONResponse('Method ' + str(request.method) + ' not allowed.', status=status.HTTP_405_METHOD_NOT_ALLOWED)